@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import asyncio
+import os
+import re
+import ssl as ssl_module
+import zlib
+from contextlib import asynccontextmanager
+from mailboxresource import MAX_RETRIES, MAX_THROTTLED_RETRIES, HEADER_BATCH, STREAM_CHUNK, COMPRESS_READ, RawMessageFile, is_streamed, stream_chunk, uid_set, search_windows, parse_esearch, expand_uid_set, parse_fetch_response, fetch_attribute, sync_criterion, open_folder_state, split_archived, plan_batches, save_message, filter_folders, header_items, parse_headers, header_metadata
+from scheduler import interleave_by_host
+from throttle import throttles, is_throttling
+from pipeline import message_pipeline
+from catalog import catalog_target
+from messageindex import MessageIndex
+from utilities import errorHandler, log, set_log_prefix, get_log_prefix, imaputf7decode
+
+# longest response line (without literals) accepted from the server
+LINE_LIMIT = 1024 * 1024
+
+literal_re = re.compile(rb'\{(\d+)\}\r\n$')
+untagged_re = re.compile(rb'\* (?:(?P<number>\d+) )?(?P<name>[A-Za-z-]+) ?(?P<data>.*)', re.S)
+response_code_re = re.compile(rb'\[(?P<code>[A-Z-]+) (?P<value>\d+)\]')
+
+
+class AsyncImapError(Exception):
+    pass
+
+
+class Literal:
+    """A command argument that has to be sent as literal (ex: a non-ASCII password)"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+def quote(value):
+    """Quote a string argument, or wrap it as literal if it cannot be quoted"""
+    try:
+        value.encode('ascii')
+        if '\r' not in value and '\n' not in value:
+            return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    except UnicodeEncodeError:
+        pass
+    return Literal(value.encode('utf-8'))
+
+
+class AsyncImapClient:
+    """A minimal IMAP client on asyncio streams, for the commands imapbox uses (LOGIN, LIST, EXAMINE, UID SEARCH, UID FETCH)"""
+
+    def __init__(self, host, port, username, password, ssl, compress=True, gmail_dedup=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.ssl = ssl
+        self.compress = compress
+        self.gmail_dedup = gmail_dedup
+        self.gmail = False
+        self.compressor = None
+        self.inflater = None
+        self.throttle = throttles.get(host)
+        self.tag_counter = 0
+        self.selected_folder = None
+        self.capabilities = ()
+        self.condstore = False
+        self.esearch = False
+        self.exists = 0
+        self.uidnext = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        """Open the connection and log in, after the backoff of the host. Like MailboxClient.connect_to_imap, dropped
+        connections and throttled logins are retried"""
+        retries = 0
+        while True:
+            await sleep(self.throttle.backoffDelay())
+            try:
+                await self.open()
+                return
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self.close()
+                errorHandler(None, f"Connection error: {e}. Will retry ...", exitCode=None)
+            except AsyncImapError as e:
+                if not is_throttling(e):
+                    raise
+                errorHandler(None, f"Throttled: {e}. Will retry ...", exitCode=None)
+            retries += 1
+            if retries >= MAX_RETRIES:
+                raise AsyncImapError('Maximum retries reached while connecting')
+
+    async def open(self):
+        context = None
+        if self.ssl:
+            # same (unverified) context imaplib.IMAP4_SSL uses by default
+            context = ssl_module._create_stdlib_context()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=context, limit=LINE_LIMIT)
+        except ConnectionError as e:
+            # a refused connection is often the way a server throttles, like a dropped one
+            self.noteThrottled(e)
+            raise
+
+        greeting = await self.reader.readline()
+        if not greeting:
+            self.close()
+            self.noteThrottled('connection closed before the greeting')
+            raise ConnectionResetError('Connection closed before the greeting')
+        if not greeting.startswith(b'* OK') and not greeting.startswith(b'* PREAUTH'):
+            self.close()
+            if is_throttling(greeting):
+                self.noteThrottled(greeting)
+            raise AsyncImapError(f'Unexpected greeting: {greeting}')
+
+        typ, untagged, text = await self.command('LOGIN', quote(self.username), quote(self.password))
+        if typ != 'OK':
+            self.close()
+            raise AsyncImapError(f'Login failed: {text}')
+
+        await self.enableExtensions()
+
+    async def enableExtensions(self):
+        """Enable COMPRESS and CONDSTORE if the server supports them.
+        Capabilities are asked for after the login, since servers often only announce them then"""
+        typ, untagged, text = await self.command('CAPABILITY')
+        self.capabilities = tuple(capability.decode('ascii', 'replace').upper() for name, parts in untagged if name == 'CAPABILITY' for capability in parts[-1].split())
+
+        if self.compress and 'COMPRESS=DEFLATE' in self.capabilities:
+            if not await self.enableCompression():
+                errorHandler(None, "Warning: The server refused COMPRESS=DEFLATE", exitCode=None)
+
+        self.esearch = 'ESEARCH' in self.capabilities
+        self.gmail = self.gmail_dedup and 'X-GM-EXT-1' in self.capabilities
+        await self.enableCondstore()
+
+    async def enableCompression(self):
+        """Switch the connection to COMPRESS=DEFLATE (RFC 4978), responses are inflated by a task feeding a new reader"""
+        typ, untagged, text = await self.command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+
+        compressed = self.reader
+        self.reader = asyncio.StreamReader(limit=LINE_LIMIT)
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.inflater = asyncio.create_task(self.inflate(compressed, zlib.decompressobj(-15), self.reader))
+        return True
+
+    @staticmethod
+    async def inflate(compressed, decompressor, reader):
+        try:
+            while True:
+                data = await compressed.read(COMPRESS_READ)
+                if not data:
+                    break
+                reader.feed_data(decompressor.decompress(data))
+        except Exception as e:
+            reader.set_exception(e)
+            return
+        reader.feed_eof()
+
+    async def enableCondstore(self):
+        """Enable CONDSTORE if the server supports it (QRESYNC implies it), so EXAMINE reports the HIGHESTMODSEQ"""
+        self.condstore = 'CONDSTORE' in self.capabilities or 'QRESYNC' in self.capabilities
+        if self.condstore and 'ENABLE' in self.capabilities:
+            typ, untagged, text = await self.command('ENABLE', 'CONDSTORE')
+            if typ != 'OK':
+                errorHandler(None, f"Warning: Could not enable CONDSTORE: {text}", exitCode=None)
+                self.condstore = False
+
+    async def reconnect(self):
+        """Connect again (after the backoff of the host) and select the previously selected folder"""
+        self.close()
+        await self.connect()
+        if self.selected_folder:
+            await self.examine(self.selected_folder)
+
+    def close(self):
+        if self.inflater:
+            self.inflater.cancel()
+            self.inflater = None
+        self.compressor = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(data)
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except Exception:
+            pass
+        self.close()
+
+    async def readResponse(self):
+        """Read a response line with its literals, as list in the format of imaplib: (line, literal) tuples followed by the rest of the line"""
+        parts = []
+        line = await self.reader.readline()
+        while True:
+            if not line:
+                raise ConnectionResetError('Connection closed by the server')
+            match = literal_re.search(line)
+            if not match:
+                break
+            literal = await self.reader.readexactly(int(match.group(1)))
+            parts.append((line[:-2], literal))
+            line = await self.reader.readline()
+        parts.append(line.rstrip(b'\r\n'))
+        return parts
+
+    async def send(self, args):
+        line = b''
+        for arg in args:
+            if isinstance(arg, Literal):
+                self.write(line + b' {%d}\r\n' % len(arg.data))
+                await self.writer.drain()
+                parts = await self.readResponse()
+                if not parts[0].startswith(b'+'):
+                    raise AsyncImapError(f'Literal was not accepted: {parts[0]}')
+                line = arg.data
+            else:
+                if isinstance(arg, str):
+                    arg = arg.encode('utf-8')
+                line += (b' ' if line else b'') + arg
+        self.write(line + b'\r\n')
+        await self.writer.drain()
+
+    async def command(self, name, *args):
+        """Send a command and read its responses. Returns (typ, untagged, text), untagged is a list of (name, data) like imaplib uses"""
+        await sleep(self.throttle.command())
+        try:
+            typ, untagged, text = await self.readCommand(name, *args)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            # a dropped connection is often the way a server throttles
+            self.noteThrottled(e)
+            raise
+
+        if typ == 'OK':
+            self.throttle.succeeded()
+        elif is_throttling(text):
+            self.noteThrottled(text)
+        return (typ, untagged, text)
+
+    async def readCommand(self, name, *args):
+        self.tag_counter += 1
+        tag = b'A%d' % self.tag_counter
+        await self.send([tag, name] + list(args))
+
+        untagged = []
+        while True:
+            parts = await self.readResponse()
+            await sleep(self.throttle.received(response_size(parts)))
+            first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+
+            if first.startswith(tag + b' '):
+                typ, _, text = first[len(tag) + 1:].partition(b' ')
+                return (typ.decode('ascii').upper(), untagged, text)
+
+            match = untagged_re.match(first)
+            if not match:
+                continue
+            if match.group('name').upper() == b'BYE' and name != 'LOGOUT':
+                raise ConnectionResetError(f'Server closed the connection: {first}')
+
+            # imaplib style: '* 5 FETCH (...)' => ('FETCH', '5 (...)')
+            data = match.group('data')
+            if match.group('number'):
+                data = match.group('number') + b' ' + data
+            if isinstance(parts[0], tuple):
+                parts[0] = (data, parts[0][1])
+            else:
+                parts[0] = data
+            untagged.append((match.group('name').upper().decode('ascii'), parts))
+
+    def noteThrottled(self, reason):
+        delay = self.throttle.throttled(reason)
+        errorHandler(None, f"Warning: Throttled by {self.throttle.host} ({reason}), backing off {delay:.0f}s ({self.throttle.status()})", exitCode=None)
+
+    async def list(self):
+        typ, untagged, text = await self.command('LIST', '""', '*')
+        if typ != 'OK':
+            raise AsyncImapError(f'Could not list folders: {text}')
+
+        folder_list = []
+        for name, parts in untagged:
+            if name != 'LIST':
+                continue
+            if isinstance(parts[0], tuple):
+                # folder name sent as literal
+                folder_list.append(parts[0][0].rsplit(b' ', 1)[0] + b' "' + parts[0][1] + b'"')
+            else:
+                folder_list.append(parts[0])
+        return folder_list
+
+    async def examine(self, folder):
+        """Select a folder read only. Returns its (UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ), or None if it could not be selected"""
+        typ, untagged, text = await self.command('EXAMINE', folder)
+        if typ != 'OK':
+            return None
+
+        self.selected_folder = folder
+        self.exists = 0
+        codes = {}
+        for name, parts in untagged:
+            if name == 'EXISTS':
+                self.exists = int(parts[0].split()[0])
+            elif name == 'OK' and not isinstance(parts[0], tuple):
+                match = response_code_re.search(parts[0])
+                if match:
+                    codes[match.group('code').decode('ascii')] = int(match.group('value'))
+        self.uidnext = codes.get('UIDNEXT')
+        # HIGHESTMODSEQ is None if the folder has no persistent mod-sequences (NOMODSEQ)
+        return (codes.get('UIDVALIDITY'), codes.get('UIDNEXT'), codes.get('HIGHESTMODSEQ') if self.condstore else None)
+
+    async def search(self, criterion, first_uid=1, changed_since=None):
+        """Search for the UIDs matching the criterion from first_uid on, and with a MODSEQ above changed_since if it is set.
+        Returns the number of matches (an estimate if the server has no ESEARCH) and an async generator of the UIDs in ascending order"""
+        if changed_since is not None:
+            criterion = f'MODSEQ {changed_since + 1} {criterion}'
+
+        if self.esearch:
+            result = await self.esearchUids(f'UID {first_uid}:* {criterion}', 'MIN MAX COUNT')
+            # 'n:*' always matches the last message, even if its UID is lower than n
+            if not result.get('COUNT') or result['MAX'] < first_uid:
+                return (0, self.iterUids(criterion, 1, 0))
+            first = max(first_uid, result['MIN'])
+            last = result['MAX']
+            total = result['COUNT']
+        else:
+            first = first_uid
+            last = self.uidnext - 1 if self.uidnext is not None else None
+            total = self.exists
+            if last is not None:
+                total = min(total, last - first + 1)
+
+        return (total, self.iterUids(criterion, first, last))
+
+    async def iterUids(self, criterion, first, last):
+        """Yield the UIDs matching the criterion between first and last, searching window by window of UIDs"""
+        for start, end in search_windows(first, last):
+            window = f'UID {start}:{end} {criterion}'
+            if self.esearch:
+                uids = expand_uid_set((await self.esearchUids(window, 'ALL')).get('ALL', b''))
+            else:
+                typ, untagged, text = await self.command('UID SEARCH', window)
+                if typ != 'OK':
+                    raise AsyncImapError(f'Error on searching emails ({window}: "{typ}" => {text}).')
+                uids = sorted(int(uid) for name, parts in untagged if name == 'SEARCH' for uid in parts[-1].split())
+
+            for uid in uids:
+                if uid >= first:
+                    yield uid
+
+    async def esearchUids(self, criterion, returns):
+        """Run an ESEARCH (RFC 4731), returns a dict of the requested results (MIN, MAX, COUNT as int, ALL as UID set)"""
+        typ, untagged, text = await self.command('UID SEARCH', f'RETURN ({returns})', criterion)
+        if typ != 'OK':
+            raise AsyncImapError(f'Error on searching emails ({criterion}: "{typ}" => {text}).')
+        result = {}
+        for name, parts in untagged:
+            if name == 'ESEARCH':
+                result = parse_esearch(parts[-1])
+        return result
+
+    async def fetch(self, uids, items):
+        typ, untagged, text = await self.command('UID FETCH', uid_set(uids), items)
+        if typ != 'OK':
+            raise AsyncImapError(f'Error on fetching emails: "{typ}" => {text}.')
+
+        data = []
+        for name, parts in untagged:
+            if name == 'FETCH':
+                data.extend(parts)
+        return parse_fetch_response(data)
+
+    async def fetchHeaders(self, uids):
+        return parse_headers(await self.fetch(uids, header_items(self.gmail)), self.gmail)
+
+    async def fetchMessages(self, uids):
+        messages = {}
+        for attributes, literal in await self.fetch(uids, '(UID BODY.PEEK[])'):
+            uid = fetch_attribute(attributes, b'UID')
+            if uid is not None and literal is not None:
+                messages[uid] = literal
+        return messages
+
+    async def streamMessage(self, uid, local_folder):
+        """Fetch a single message in chunks into a temporary file, returns a dict of uid => RawMessageFile"""
+        loop = asyncio.get_running_loop()
+        raw_file = RawMessageFile(local_folder, uid)
+        try:
+            while True:
+                chunk = stream_chunk(uid, await self.fetch([uid], f'(UID BODY.PEEK[]<{raw_file.size}.{STREAM_CHUNK}>)'))
+                if chunk:
+                    # compressing is done outside of the event loop
+                    await loop.run_in_executor(None, raw_file.write, chunk)
+                if not chunk or len(chunk) < STREAM_CHUNK:
+                    break
+        except BaseException:
+            raw_file.discard()
+            raise
+
+        return raw_file.finish()
+
+
+def response_size(parts):
+    """Number of bytes of a response read by readResponse"""
+    return sum(len(part[0]) + len(part[1]) if isinstance(part, tuple) else len(part) for part in parts)
+
+
+async def sleep(seconds):
+    if seconds > 0:
+        await asyncio.sleep(seconds)
+
+
+class AsyncHostLimiter:
+    """Limits the number of simultaneous connections per IMAP host, for tasks of one event loop"""
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.semaphores = {}
+
+    @asynccontextmanager
+    async def slot(self, host, cancel=None):
+        """Wait for a free connection slot for the host, gives False if cancel() returned True while waiting"""
+        if self.limit <= 0:
+            yield True
+            return
+
+        host = str(host).lower()
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.limit)
+        semaphore = self.semaphores[host]
+
+        while True:
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout=1)
+                break
+            except asyncio.TimeoutError:
+                if cancel is not None and cancel():
+                    yield False
+                    return
+        try:
+            yield True
+        finally:
+            semaphore.release()
+
+
+async def retry_fetch(client, state, fetch, uids):
+    """Run a fetch coroutine for a list of UIDs, reconnecting on connection errors. Returns None if it was skipped"""
+    fetch_retries = 0
+    throttled_retries = 0
+    while fetch_retries < MAX_RETRIES and throttled_retries < MAX_THROTTLED_RETRIES:
+        try:
+            return await fetch(uids)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            # the reconnect waits for the backoff of the host
+            errorHandler(None, f"Connection error while fetching email: {e}. Retrying ...", exitCode=None)
+            if is_throttling(e):
+                throttled_retries += 1
+            else:
+                fetch_retries += 1
+            try:
+                await client.reconnect()
+            except Exception as e:
+                # without a connection, every later fetch of the folder would fail as well
+                state.save()
+                raise AsyncImapError(f'Could not reconnect: {e}') from e
+        except AsyncImapError as e:
+            if not is_throttling(e):
+                errorHandler(None, f"Error while fetching email: {e}. Skipping ...", exitCode=None)
+                return None
+            # the next command waits for the backoff of the host
+            errorHandler(None, f"Throttled while fetching email: {e}. Retrying ...", exitCode=None)
+            throttled_retries += 1
+        except Exception as e:
+            errorHandler(None, f"Error while fetching email: {e}. Skipping ...", exitCode=None)
+            return None
+
+    # only this folder fails, the other folders and accounts on the event loop go on
+    state.save()
+    raise AsyncImapError('Maximum retries reached while fetching emails')
+
+
+async def copy_emails(client, folder_entry, local_folder, options):
+    """Copy the emails of a remote folder, returns (saved, existing) or None if the folder could not be selected"""
+    loop = asyncio.get_running_loop()
+
+    selected = await client.examine(folder_entry)
+    if selected is None:
+        # Handle case where Exchange/Outlook uses '.' path separator when
+        # reporting subfolders. Adjust to use '/' on remote.
+        selected = await client.examine(re.sub(r'\.', '/', folder_entry))
+        if selected is None:
+            errorHandler(folder_entry, 'AsyncImapClient: Could not select remote folder', exitCode=None)
+            return None
+    uidvalidity, uidnext, highestmodseq = selected
+
+    n_saved = 0
+    n_exists = 0
+    state = open_folder_state(local_folder, uidvalidity, options['days'], options['full_sync'])
+    if state.unchanged(uidnext, highestmodseq):
+        # nothing new since the last run
+        return (n_saved, n_exists)
+
+    # the segment store has an index of its own
+    index = await loop.run_in_executor(None, MessageIndex, local_folder, options['full_sync']) if not options['segment_dir'] else None
+    batch_size = max(1, options['batch_size'])
+    batch_bytes = max(1, options['batch_mb']) * 1024 * 1024
+    stream_bytes = max(0, options['stream_mb']) * 1024 * 1024
+
+    changed_since = state.highestmodseq if highestmodseq is not None else None
+    total, uids = await client.search(sync_criterion(options['days']), first_uid=state.last_uid + 1, changed_since=changed_since)
+    # the failed messages of the last runs first
+    retry_uids = state.retryUids()
+    total += len(retry_uids)
+    uids = async_chain(retry_uids, uids)
+    if total:
+        log("- Copying emails ...")
+
+    async for header_chunk in async_chunks(uids, HEADER_BATCH):
+        headers = await retry_fetch(client, state, client.fetchHeaders, header_chunk) or {}
+
+        # uid => True if it is archived (or was expunged), False if it failed
+        outcomes, sizes, download = await loop.run_in_executor(None, split_archived, local_folder, header_chunk, headers, options['segment_dir'], index)
+        n_exists += len(outcomes)
+        pos = state.advance(header_chunk, outcomes, 0)
+
+        # the next batch is fetched while the previous one is still being saved
+        saving = None
+        for batch in plan_batches(download, sizes, batch_size, batch_bytes, stream_bytes):
+            if is_streamed(batch, sizes, stream_bytes):
+                messages = await retry_fetch(client, state, lambda uids: client.streamMessage(uids[0], local_folder), batch)
+            else:
+                messages = await retry_fetch(client, state, client.fetchMessages, batch)
+            if saving:
+                n_saved, n_exists = await finish_batch(saving, outcomes, n_saved, n_exists)
+                pos = state.advance(header_chunk, outcomes, pos)
+
+            saving = []
+            for uid in batch:
+                if messages is None:
+                    outcomes[uid] = False
+                elif uid in messages:
+                    saving.append((uid, asyncio.ensure_future(message_pipeline.run(save_message, local_folder, messages[uid], options['pdf_queue'], header_metadata(headers, uid), options['blob_dir'], options['raw_only'], options['segment_dir'], options['catalog_target']))))
+                else:
+                    # expunged in the meantime, nothing to archive
+                    outcomes[uid] = True
+
+        if saving:
+            n_saved, n_exists = await finish_batch(saving, outcomes, n_saved, n_exists)
+        state.advance(header_chunk, outcomes, pos)
+
+    state.complete(highestmodseq)
+    state.save()
+    if index:
+        await loop.run_in_executor(None, index.save)
+    return (n_saved, n_exists)
+
+
+async def async_chain(items, more):
+    """Yield the items of a list, then of an async iterator"""
+    for item in items:
+        yield item
+    async for item in more:
+        yield item
+
+
+async def async_chunks(items, size):
+    """Split an async iterator into lists of up to size items"""
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def finish_batch(saving, outcomes, n_saved, n_exists):
+    for uid, future in saving:
+        try:
+            saved = await future
+        except Exception as e:
+            # ex: an I/O error, only this message is skipped and retried on the next run
+            errorHandler(e, f'Error: Could not save email {uid}', exitCode=None)
+            outcomes[uid] = False
+            continue
+        if saved:
+            n_saved += 1
+        else:
+            n_exists += 1
+        outcomes[uid] = True
+    return (n_saved, n_exists)
+
+
+async def save_account(account, options, rootDir, limiter):
+    log('\n{}/{} (on {})'.format(account['name'], account['remote_folder'], account['host']))
+
+    if options['specific_folders']:
+        basedir = os.path.join(rootDir, account['name'])
+    else:
+        basedir = rootDir
+
+    total = [0, 0]
+    folder_queue = asyncio.Queue()
+    account_prefix = get_log_prefix()
+
+    async def save_folders(client, parallel):
+        while True:
+            try:
+                folder_entry = folder_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            folder_entry_decoded = imaputf7decode(folder_entry)
+            if parallel:
+                set_log_prefix(account_prefix + '[' + folder_entry_decoded.replace('"', '') + '] ')
+                log('Saving folder')
+            else:
+                log("Saving folder: " + folder_entry_decoded)
+
+            try:
+                local_folder = os.path.join(basedir, folder_entry_decoded.replace('"', ''))
+                folder_options = dict(options, catalog_target=catalog_target(options['catalog_path'], account, folder_entry_decoded.replace('"', '')))
+                stats = await copy_emails(client, folder_entry, local_folder, folder_options)
+            except Exception as e:
+                errorHandler(e, ' - FAILED', exitCode=None)
+                try:
+                    await client.reconnect()
+                except Exception as e:
+                    # the remaining folders are left to the other connections of the account
+                    errorHandler(e, 'Could not reconnect', exitCode=None)
+                    return
+                continue
+
+            if stats is not None:
+                total[0] += stats[0]
+                total[1] += stats[1]
+                if stats[0] == 0 and stats[1] == 0:
+                    log('- Done. No new emails')
+                else:
+                    log('- Done. {} emails created, {} emails already exist'.format(stats[0], stats[1]))
+
+    async def worker(parallel):
+        async with limiter.slot(account['host'], folder_queue.empty) as acquired:
+            if not acquired or folder_queue.empty():
+                return
+            client = AsyncImapClient(account['host'], account['port'], account['username'], account['password'], account['ssl'], account.get('compress', True), account.get('gmail_dedup', False))
+            try:
+                await client.connect()
+            except Exception as e:
+                # the folders are left to the connections that logged in
+                client.close()
+                errorHandler(e, 'Could not open another connection', exitCode=None)
+                return
+            try:
+                await save_folders(client, parallel)
+            finally:
+                await client.logout()
+
+    try:
+        async with limiter.slot(account['host']):
+            client = AsyncImapClient(account['host'], account['port'], account['username'], account['password'], account['ssl'], account.get('compress', True), account.get('gmail_dedup', False))
+            await client.connect()
+            try:
+                if account['remote_folder'] == "__ALL__":
+                    folders = filter_folders(account, await client.list(), client.gmail)
+                else:
+                    folders = str.split(account['remote_folder'], ',')
+                for folder_entry in folders:
+                    folder_queue.put_nowait(folder_entry)
+
+                workers = min(options['parallel_folders'], len(folders))
+                parallel = workers > 1
+                # the listing connection is used by the first worker, it is only logged out once all workers ended
+                results = await asyncio.gather(save_folders(client, parallel), *[worker(parallel) for i in range(workers - 1)], return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        errorHandler(result, ' - FAILED', exitCode=None)
+            finally:
+                await client.logout()
+    except Exception as e:
+        errorHandler(e, ' - FAILED', exitCode=None)
+        return
+
+    if len(folders) > 1:
+        log('- All {} folders done. {} emails created, {} emails already exist'.format(len(folders), total[0], total[1]))
+
+
+async def do_accounts_async(options, rootDir):
+    """Backup all accounts on a single event loop, with up to parallel_accounts accounts at a time"""
+    limiter = AsyncHostLimiter(options['host_connections'])
+    accounts = asyncio.Semaphore(max(1, options['parallel_accounts']))
+    parallel = options['parallel_accounts'] > 1 and len(options['accounts']) > 1
+
+    async def run(account):
+        async with accounts:
+            if parallel:
+                set_log_prefix('[' + account['name'] + '] ')
+            await save_account(account, options, rootDir, limiter)
+
+    await asyncio.gather(*[run(account) for account in interleave_by_host(options['accounts'])])
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import hashlib
+import os
+import shutil
+import sys
+import uuid
+from utilities import errorHandler
+
+# folder of the blobs, within the local folder
+BLOB_FOLDER = '.imapbox-blobs'
+# size of the chunks written (and hashed) at once
+WRITE_CHUNK = 1024 * 1024
+
+# ioctl to share the data of a file with another one on copy-on-write file systems (Linux: Btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+class BlobStore:
+    """Content-addressed store of attachments: each distinct content is stored once as a blob named by its SHA-256,
+    the attachments of the messages are hardlinks to the blobs (or reflinks / copies, where links are not possible)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def blobPath(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def write(self, payload):
+        """Store a payload, hashing it while it is written. Returns the path of its blob"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f'.{uuid.uuid4().hex}.tmp')
+        digest = hashlib.sha256()
+        view = memoryview(payload)
+        try:
+            with open(tmp_path, 'wb') as fp:
+                for start in range(0, len(view), WRITE_CHUNK):
+                    chunk = view[start:start + WRITE_CHUNK]
+                    digest.update(chunk)
+                    fp.write(chunk)
+
+            blob_path = self.blobPath(digest.hexdigest())
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_path
+
+    def writeFile(self, source):
+        """Store the content of a file, moving the file as its blob (or removing it if the blob exists). Returns the path of its blob"""
+        digest = hashlib.sha256()
+        with open(source, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(WRITE_CHUNK), b''):
+                digest.update(chunk)
+
+        blob_path = self.blobPath(digest.hexdigest())
+        if os.path.exists(blob_path):
+            os.remove(source)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.move(source, blob_path)
+        return blob_path
+
+    def save(self, payload, path):
+        """Save a payload as the file at path, linked to its blob"""
+        self.link(self.write(payload), path)
+
+    def saveFile(self, source, path):
+        """Save the content of the file source as the file at path, linked to its blob. source is moved or removed"""
+        self.link(self.writeFile(source), path)
+
+    def link(self, blob_path, path):
+        if os.path.lexists(path):
+            os.remove(path)
+
+        try:
+            os.link(blob_path, path)
+            return
+        except OSError:
+            # another file system, no hardlinks or too many links to the blob
+            pass
+        copy_file(blob_path, path)
+
+
+def copy_file(source, destination):
+    """Copy a file, sharing its data (reflink) if the file system supports it"""
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, destination)
+
+
+def do_dedup_report(options):
+    """Show how much space the blob store of the local folder saves, from the link counts of its blobs"""
+    directory = os.path.join(options['local_folder'], BLOB_FOLDER)
+    if not os.path.isdir(directory):
+        errorHandler(None, f'No attachment store found in {directory} (see the dedup_attachments option)')
+
+    blobs = 0
+    links = 0
+    unused = 0
+    stored = 0
+    linked = 0
+    saved = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file.endswith('.tmp'):
+                continue
+            stat = os.stat(os.path.join(root, file))
+            # one link is the blob itself, reflinked or copied attachments are not counted
+            references = stat.st_nlink - 1
+            blobs += 1
+            links += references
+            stored += stat.st_size
+            linked += stat.st_size * references
+            if references == 0:
+                unused += 1
+            else:
+                saved += stat.st_size * (references - 1)
+
+    print('Attachment store: ' + directory)
+    print('Blobs: {} ({}), {} not used by any email'.format(blobs, format_size(stored), unused))
+    print('Attachments linked to the blobs: {} ({})'.format(links, format_size(linked)))
+    print('Saved by deduplication: {}'.format(format_size(saved)))
+    sys.exit(0)
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import json
+import multiprocessing.util
+import os
+import sqlite3
+import struct
+import sys
+import threading
+from utilities import errorHandler
+
+# catalog file, within the local folder
+CATALOG_FILE = '.imapbox-catalog.sqlite'
+# emails written to the catalog with a single transaction
+CATALOG_BATCH = 200
+# seconds an email may wait for the rest of its batch
+CATALOG_DELAY = 5.0
+# seconds to wait for the writers of other processes
+BUSY_TIMEOUT = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    path TEXT PRIMARY KEY,
+    id TEXT,
+    account TEXT,
+    folder TEXT,
+    date TEXT,
+    utc TEXT,
+    subject TEXT,
+    size INTEGER,
+    attachments TEXT,
+    with_html INTEGER,
+    with_text INTEGER
+);
+CREATE TABLE IF NOT EXISTS addresses (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    address TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_utc ON messages (utc);
+CREATE INDEX IF NOT EXISTS messages_id ON messages (id);
+CREATE INDEX IF NOT EXISTS addresses_address ON addresses (address, kind);
+CREATE INDEX IF NOT EXISTS addresses_path ON addresses (path);
+'''
+
+# the account, folder and size of an email are kept if they are not known (ex: a --rebuild)
+UPSERT_MESSAGE = '''
+INSERT INTO messages (path, id, account, folder, date, utc, subject, size, attachments, with_html, with_text)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path) DO UPDATE SET
+    id = excluded.id,
+    account = COALESCE(excluded.account, account),
+    folder = COALESCE(excluded.folder, folder),
+    date = excluded.date,
+    utc = excluded.utc,
+    subject = excluded.subject,
+    size = COALESCE(excluded.size, size),
+    attachments = excluded.attachments,
+    with_html = excluded.with_html,
+    with_text = excluded.with_text
+'''
+
+
+def connect(path):
+    """Open the catalog in WAL mode, so it is read while other processes write to it"""
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def catalog_target(catalog_path, account, folder):
+    """Where the emails of a folder are cataloged, for save_message. None without a catalog"""
+    if not catalog_path:
+        return None
+    return {'path': catalog_path, 'account': account['name'], 'folder': folder}
+
+
+class Catalog:
+    """SQLite catalog of the saved emails, with the main entries of their metadata.json and an index on their date and
+    addresses. The emails are written in batches, each one with a transaction, by every process saving emails"""
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.lock = threading.Lock()
+        self.connection = None
+        self.rows = []
+        self.timer = None
+
+    def add(self, directory, metadata, size=None, account=None, folder=None):
+        """Add (or update) an email by its folder in the folder layout, and the content of its metadata.json"""
+        path = os.path.relpath(os.path.abspath(directory), self.root).replace(os.sep, '/')
+        if folder is None:
+            # <folder>/<year>/<email>, with the account in front for specific_folders
+            folder = path.rsplit('/', 2)[0] if path.count('/') >= 2 else ''
+        row = (path, metadata.get('Id'), account, folder, metadata.get('Date'), metadata.get('Utc'), metadata.get('Subject'), size,
+               json.dumps(metadata.get('Attachments', []), ensure_ascii=False), metadata.get('WithHtml'), metadata.get('WithText'))
+        addresses = [(path, kind.lower(), address) for kind in ('From', 'To', 'Cc') for address in metadata_addresses(metadata, kind)]
+
+        with self.lock:
+            self.rows.append((row, addresses))
+            if len(self.rows) >= CATALOG_BATCH:
+                self.write()
+            elif self.timer is None:
+                self.timer = threading.Timer(CATALOG_DELAY, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.rows:
+            return
+
+        rows = self.rows
+        self.rows = []
+        try:
+            if self.connection is None:
+                self.connection = connect(self.path)
+            # the write lock right away, instead of upgrading a read lock while another process writes
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for row, addresses in rows:
+                    self.connection.execute(UPSERT_MESSAGE, row)
+                    self.connection.execute('DELETE FROM addresses WHERE path = ?', (row[0],))
+                    self.connection.executemany('INSERT INTO addresses (path, kind, address) VALUES (?, ?, ?)', addresses)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        except Exception as e:
+            errorHandler(e, f'Error while writing {len(rows)} emails to the catalog {self.path}', exitCode=None)
+
+
+def metadata_addresses(metadata, kind):
+    """The addresses of From, To or Cc of a metadata.json, in lower case. From is a single (name, address), the others are lists of them"""
+    pairs = metadata.get(kind) or []
+    if kind == 'From':
+        pairs = [pairs]
+    return {pair[1].lower() for pair in pairs if len(pair) == 2 and pair[1]}
+
+
+# one catalog per file and process, flushed when the process ends
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+
+def open_catalog(path):
+    with catalogs_lock:
+        key = (os.getpid(), path)
+        if key not in catalogs:
+            catalogs[key] = Catalog(path)
+            # also run in the worker processes of multiprocessing, unlike atexit
+            multiprocessing.util.Finalize(catalogs[key], catalogs[key].flush, exitpriority=10)
+        return catalogs[key]
+
+
+def catalog_message(catalog, directory, metadata, size=None):
+    """Add an email to the catalog of a catalog_target, if any"""
+    if catalog:
+        open_catalog(catalog['path']).add(directory, metadata, size, catalog['account'], catalog['folder'])
+
+
+def flush_catalogs():
+    """Write the waiting emails of the catalogs of this process"""
+    with catalogs_lock:
+        current = [catalog for (pid, path), catalog in catalogs.items() if pid == os.getpid()]
+    for catalog in current:
+        catalog.flush()
+
+
+def raw_size(raw_path):
+    """The size of a message from the end of its .eml.gz file (modulo 4 GB), without decompressing it"""
+    with open(raw_path, 'rb') as fp:
+        fp.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', fp.read(4))[0]
+
+
+def do_rebuild_catalog(options):
+    """Create the catalog of the local folder again, from the metadata.json files and the segments"""
+    # placed here, since they are only needed for the rebuild
+    from rebuild import find_messages
+    from segmentstore import SEGMENT_FOLDER, SegmentStore
+
+    local_folder = options['local_folder']
+    path = os.path.join(local_folder, CATALOG_FILE)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    print('Creating the catalog ' + path)
+    catalog = Catalog(path)
+    count = 0
+    for directory in find_messages(local_folder):
+        try:
+            with open(os.path.join(directory, 'metadata.json'), 'r', encoding='utf8') as json_file:
+                metadata = json.load(json_file)
+        except (OSError, ValueError):
+            # ex: saved with raw_only, cataloged by --rebuild
+            continue
+        catalog.add(directory, metadata, raw_size(os.path.join(directory, 'raw.eml.gz')))
+        count += 1
+
+    store = SegmentStore(os.path.join(local_folder, SEGMENT_FOLDER))
+    for key, metadata, size in store.records():
+        directory = os.path.join(local_folder, *key.split('/'))
+        catalog.add(directory, metadata, size)
+        count += 1
+    catalog.flush()
+
+    print('- Done. {} emails in the catalog'.format(count))
+    sys.exit(0)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import codecs
+import threading
+import time
+from collections import OrderedDict
+from importlib.util import find_spec
+
+import chardet
+
+# use cchardet (C implementation of chardet) if its loader is available
+has_cchardet = find_spec('cchardet') is not None
+if has_cchardet: import cchardet
+
+# only the beginning of a payload is used for the detection
+SAMPLE_BYTES = 64 * 1024
+# seconds of detection per message, afterwards the cached or the fallback charset is used
+TIME_BUDGET = 2.0
+# charset of text that is not ASCII nor UTF-8 and could not be detected, it decodes any bytes
+FALLBACK_CHARSET = 'ISO-8859-1'
+# number of senders / mailing lists with a remembered charset
+CACHE_SIZE = 1000
+
+
+def detect_sample(sample):
+    """Detect the charset of some bytes with the fastest installed detector, None if it is unknown"""
+    if has_cchardet:
+        return cchardet.detect(sample)['encoding']
+    return chardet.detect(sample)['encoding']
+
+
+def is_decodable(data, charset, final=True):
+    """Tell if data decodes with a charset without errors, final=False for a sample that may end within a character"""
+    try:
+        codecs.getincrementaldecoder(charset)().decode(data, final)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
+def is_known(charset):
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return False
+    return True
+
+
+class CharsetCache:
+    """The last detected charset per sender or mailing list, shared by the messages of a run"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.charsets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            charset = self.charsets.get(key)
+            if charset is not None:
+                self.charsets.move_to_end(key)
+            return charset
+
+    def set(self, key, charset):
+        with self.lock:
+            self.charsets[key] = charset
+            self.charsets.move_to_end(key)
+            while len(self.charsets) > self.size:
+                self.charsets.popitem(last=False)
+
+
+charset_cache = CharsetCache()
+
+
+class CharsetDetector:
+    """Detects the charset of the parts of a message without a declared one.
+
+    ASCII and UTF-8 are checked strictly first, which covers most parts. Other parts try the charset that was detected
+    last for the same key (the List-Id or the sender), then a detector on the first SAMPLE_BYTES, within the TIME_BUDGET
+    of the message."""
+
+    def __init__(self, key=None, budget=TIME_BUDGET):
+        self.key = key
+        self.budget = budget
+
+    def detect(self, payload):
+        if not payload:
+            return 'ascii'
+
+        for charset in ('ascii', 'utf-8'):
+            if is_decodable(payload, charset):
+                return charset
+
+        sample = payload[:SAMPLE_BYTES]
+        cached = charset_cache.get(self.key) if self.key else None
+        if cached and is_decodable(sample, cached, final=False):
+            return cached
+
+        if self.budget <= 0:
+            return FALLBACK_CHARSET
+
+        started = time.monotonic()
+        charset = detect_sample(sample)
+        self.budget -= time.monotonic() - started
+
+        if not charset or not is_known(charset):
+            return FALLBACK_CHARSET
+        if self.key:
+            charset_cache.set(self.key, charset)
+        return charset
@@ -47,6 +47,9 @@ def get_account(dsn, name=None):
     - password: The password to login with
     - remote_folder: A string containing a comma separated list of folders to archive
     - ssl: A boolean indicating whether to use SSL or not
+    - compress: A boolean indicating whether to use COMPRESS=DEFLATE if the server supports it
+    - gmail_dedup: A boolean indicating whether to archive Gmail's "All Mail" instead of each label folder
+    - idle_folders: A string containing a comma separated list of folders to watch in the "idle" server mode
 
     The function will also set the name, either by the name parameter provided or generate one of the username and host.
     """
@@ -59,6 +62,9 @@ def get_account(dsn, name=None):
         'remote_folder': 'INBOX',
         'exclude_folder': None,
         'ssl': False,
+        'compress': True,
+        'gmail_dedup': False,
+        'idle_folders': None,
     }
 
     parsed_url = urllib.parse.urlparse(dsn)
@@ -107,6 +113,12 @@ def get_account(dsn, name=None):
             
             elif key == 'ssl':
                 account['ssl'] = value[0].lower() == 'true'
+
+            elif key == 'compress':
+                account['compress'] = value[0].lower() != 'false'
+
+            elif key == 'gmail_dedup':
+                account['gmail_dedup'] = value[0].lower() == 'true'
             
             # merge all others params, to be able to overwrite username, password, ... and future account options
             else:
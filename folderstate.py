@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import json
+import os
+import time
+from utilities import errorHandler
+
+STATE_FILENAME = '.imapbox-state.json'
+# seconds between the saves of the checkpoint while a folder is copied
+SAVE_INTERVAL = 10
+
+
+class FolderState:
+    """Sync checkpoint of a remote folder, stored within its local folder.
+    The UIDs up to last_uid were handled, except failed_uids, which are retried on the next run"""
+
+    def __init__(self, local_folder):
+        self.path = os.path.join(local_folder, STATE_FILENAME)
+        self.uidvalidity = None
+        self.last_uid = 0
+        # HIGHESTMODSEQ of the last complete run, if the server supports CONDSTORE
+        self.highestmodseq = None
+        # a frozen checkpoint is not moved and not saved (ex: only some days were checked)
+        self.frozen = False
+        self.failed_uids = set()
+        self.saved = time.monotonic()
+        self.load()
+
+    @property
+    def failed(self):
+        return bool(self.failed_uids)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as state_file:
+                state = json.load(state_file)
+            self.uidvalidity = state.get('uidvalidity')
+            self.last_uid = int(state.get('last_uid', 0))
+            self.highestmodseq = state.get('highestmodseq')
+            self.failed_uids = set(int(uid) for uid in state.get('failed_uids', []))
+        except Exception as e:
+            errorHandler(e, f'Warning: Could not read sync state {self.path}, doing a full sync', exitCode=None)
+            self.reset()
+
+    def reset(self):
+        self.last_uid = 0
+        self.highestmodseq = None
+        self.failed_uids = set()
+
+    def save(self):
+        self.saved = time.monotonic()
+        if self.frozen:
+            return
+
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # write to a temp file first, so a crash never leaves a half written state behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump({
+                'uidvalidity': self.uidvalidity,
+                'last_uid': self.last_uid,
+                'highestmodseq': self.highestmodseq,
+                'failed_uids': sorted(self.failed_uids),
+            }, state_file)
+            # on disk before the rename, so the state survives a crash of the system as well
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def validate(self, uidvalidity):
+        """Reset the checkpoint if the server's UIDVALIDITY changed, returns False in that case"""
+        if self.uidvalidity is not None and self.uidvalidity != uidvalidity:
+            self.uidvalidity = uidvalidity
+            self.reset()
+            return False
+
+        self.uidvalidity = uidvalidity
+        return True
+
+    def unchanged(self, uidnext, highestmodseq):
+        """Tell from the UIDNEXT and HIGHESTMODSEQ of a SELECT if the folder has nothing new since the last run"""
+        if self.failed_uids:
+            return False
+        if highestmodseq is not None and self.highestmodseq == highestmodseq:
+            return True
+        return uidnext is not None and self.last_uid >= uidnext - 1
+
+    def complete(self, highestmodseq):
+        """Remember the HIGHESTMODSEQ of a run, only if no message failed, so failed ones are retried next run"""
+        if not self.failed:
+            self.highestmodseq = highestmodseq
+
+    def retryUids(self):
+        """The UIDs that failed on the last runs, to copy them again"""
+        return sorted(self.failed_uids)
+
+    def advance(self, uids, outcomes, pos):
+        """Move the checkpoint over the UIDs with a known outcome, in order, and save it every SAVE_INTERVAL seconds.
+        Returns the position of the first open UID"""
+        while pos < len(uids) and uids[pos] in outcomes:
+            uid = uids[pos]
+            # a failed message is remembered, to retry only these on the next run
+            if outcomes[uid]:
+                self.failed_uids.discard(uid)
+            else:
+                self.failed_uids.add(uid)
+            if not self.frozen:
+                self.last_uid = max(self.last_uid, uid)
+            pos += 1
+
+        if time.monotonic() - self.saved >= SAVE_INTERVAL:
+            self.save()
+        return pos
@@ -2,7 +2,7 @@
 # -*- coding:utf-8 -*-
 
 
-from mailboxresource import save_emails, get_folders
+from mailboxresource import save_emails, get_folders, open_session
 from dsn import get_account, input_dsn
 import argparse
 import configparser
@@ -10,9 +10,19 @@ import os
 import sys
 import signal
 import getpass
-from utilities import errorHandler, get_version, is_docker, imaputf7decode
+import asyncio
+import threading
+from utilities import errorHandler, get_version, is_docker, imaputf7decode, log, set_log_prefix, get_log_prefix
 from search import do_search
+from blobstore import BLOB_FOLDER, do_dedup_report
+from pdfqueue import PDF_QUEUE_FOLDER, PDF_TIMEOUT, pdf_renderer, do_render_pdfs
+from rebuild import do_rebuild
+from segmentstore import SEGMENT_FOLDER, do_export_segments, do_migrate_segments
+from catalog import CATALOG_FILE, catalog_target, flush_catalogs, do_rebuild_catalog
 from server import start_server
+from scheduler import connection_limiter, interleave_by_host, run_parallel
+from throttle import throttles
+from pipeline import message_pipeline
 
 
 def load_configuration(args):
@@ -27,12 +37,36 @@ def load_configuration(args):
         'days': None,
         'local_folder': '.',
         'wkhtmltopdf': None,
+        'pdf_workers': 0,
+        'pdf_timeout': PDF_TIMEOUT,
+        'render_pdfs': False,
         'specific_folders': False,
         'test_only': False,
         'search_filter': None,
         'search_output': None,
         'input_dsn': False,
         'server': None,
+        'reconcile': '0 3 * * *',
+        'full_sync': False,
+        'batch_size': 200,
+        'batch_mb': 16,
+        'stream_mb': 0,
+        'parallel_folders': 1,
+        'parallel_accounts': 1,
+        'host_connections': 0,
+        'rate_commands': 0,
+        'rate_mb': 0,
+        'processes': 0,
+        'dedup_attachments': False,
+        'dedup_report': False,
+        'raw_only': False,
+        'rebuild': False,
+        'storage': 'folders',
+        'migrate_segments': False,
+        'export_segments': None,
+        'catalog': False,
+        'rebuild_catalog': False,
+        'engine': 'imaplib',
         'accounts': []
     }
 
@@ -50,6 +84,12 @@ def load_configuration(args):
         if config.has_option('imapbox', 'wkhtmltopdf'):
             options['wkhtmltopdf'] = os.path.expanduser(config.get('imapbox', 'wkhtmltopdf'))
 
+        if config.has_option('imapbox', 'pdf_workers'):
+            options['pdf_workers'] = config.getint('imapbox', 'pdf_workers')
+
+        if config.has_option('imapbox', 'pdf_timeout'):
+            options['pdf_timeout'] = config.getint('imapbox', 'pdf_timeout')
+
         if config.has_option('imapbox', 'specific_folders'):
             options['specific_folders'] = config.getboolean('imapbox', 'specific_folders')
 
@@ -60,7 +100,55 @@ def load_configuration(args):
                 options['test_only'] = config.getboolean('imapbox', 'test_only')
 
         if config.has_option('imapbox', 'server'):
-            options['server'] = config.getboolean('imapbox', 'server')
+            options['server'] = config.get('imapbox', 'server')
+
+        if config.has_option('imapbox', 'reconcile'):
+            options['reconcile'] = config.get('imapbox', 'reconcile')
+
+        if config.has_option('imapbox', 'full_sync'):
+            options['full_sync'] = config.getboolean('imapbox', 'full_sync')
+
+        if config.has_option('imapbox', 'batch_size'):
+            options['batch_size'] = config.getint('imapbox', 'batch_size')
+
+        if config.has_option('imapbox', 'batch_mb'):
+            options['batch_mb'] = config.getint('imapbox', 'batch_mb')
+
+        if config.has_option('imapbox', 'stream_mb'):
+            options['stream_mb'] = config.getint('imapbox', 'stream_mb')
+
+        if config.has_option('imapbox', 'parallel_folders'):
+            options['parallel_folders'] = config.getint('imapbox', 'parallel_folders')
+
+        if config.has_option('imapbox', 'parallel_accounts'):
+            options['parallel_accounts'] = config.getint('imapbox', 'parallel_accounts')
+
+        if config.has_option('imapbox', 'host_connections'):
+            options['host_connections'] = config.getint('imapbox', 'host_connections')
+
+        if config.has_option('imapbox', 'rate_commands'):
+            options['rate_commands'] = config.getfloat('imapbox', 'rate_commands')
+
+        if config.has_option('imapbox', 'rate_mb'):
+            options['rate_mb'] = config.getfloat('imapbox', 'rate_mb')
+
+        if config.has_option('imapbox', 'processes'):
+            options['processes'] = config.getint('imapbox', 'processes')
+
+        if config.has_option('imapbox', 'dedup_attachments'):
+            options['dedup_attachments'] = config.getboolean('imapbox', 'dedup_attachments')
+
+        if config.has_option('imapbox', 'raw_only'):
+            options['raw_only'] = config.getboolean('imapbox', 'raw_only')
+
+        if config.has_option('imapbox', 'storage'):
+            options['storage'] = config.get('imapbox', 'storage')
+
+        if config.has_option('imapbox', 'catalog'):
+            options['catalog'] = config.getboolean('imapbox', 'catalog')
+
+        if config.has_option('imapbox', 'engine'):
+            options['engine'] = config.get('imapbox', 'engine')
 
     if args.specific_dsn:
         for dsn in args.specific_dsn:
@@ -93,6 +181,9 @@ def load_configuration(args):
                 'remote_folder': 'INBOX', # String (might contain a comma separated list of folders)
                 'exclude_folder': None,   # String (might contain a comma separated list of folders)
                 'ssl': False,
+                'compress': True,
+                'gmail_dedup': False,
+                'idle_folders': None,     # String (might contain a comma separated list of folders)
             }
 
             if config.has_option(section, 'dsn'):
@@ -120,12 +211,21 @@ def load_configuration(args):
                 if config.get(section, 'ssl').lower() == "true":
                     account['ssl'] = True
 
+            if config.has_option(section, 'compress'):
+                account['compress'] = config.get(section, 'compress').lower() != "false"
+
+            if config.has_option(section, 'gmail_dedup'):
+                account['gmail_dedup'] = config.get(section, 'gmail_dedup').lower() == "true"
+
             if config.has_option(section, 'remote_folder'):
                 account['remote_folder'] = config.get(section, 'remote_folder')
 
             if config.has_option(section, 'exclude_folder'):
                 account['exclude_folder'] = config.get(section, 'exclude_folder')
 
+            if config.has_option(section, 'idle_folders'):
+                account['idle_folders'] = config.get(section, 'idle_folders')
+
             if None == account['host'] or None == account['username'] or None == account['password']:
                 errorHandler(section, 'Invalid account')
                 continue
@@ -141,6 +241,15 @@ def load_configuration(args):
     if args.wkhtmltopdf:
         options['wkhtmltopdf'] = args.wkhtmltopdf
 
+    if args.pdf_workers:
+        options['pdf_workers'] = args.pdf_workers
+
+    if args.pdf_timeout:
+        options['pdf_timeout'] = args.pdf_timeout
+
+    if args.render_pdfs:
+        options['render_pdfs'] = True
+
     if args.specific_folders:
         options['specific_folders'] = True
 
@@ -162,6 +271,87 @@ def load_configuration(args):
     if args.server:
         options['server'] = args.server
 
+    if args.reconcile:
+        options['reconcile'] = args.reconcile
+
+    if args.full_sync:
+        options['full_sync'] = True
+
+    if args.batch_size:
+        options['batch_size'] = args.batch_size
+
+    if args.batch_mb:
+        options['batch_mb'] = args.batch_mb
+
+    if args.stream_mb:
+        options['stream_mb'] = args.stream_mb
+
+    if args.parallel_folders:
+        options['parallel_folders'] = args.parallel_folders
+
+    if args.parallel_accounts:
+        options['parallel_accounts'] = args.parallel_accounts
+
+    if args.host_connections:
+        options['host_connections'] = args.host_connections
+
+    if args.rate_commands:
+        options['rate_commands'] = args.rate_commands
+
+    if args.rate_mb:
+        options['rate_mb'] = args.rate_mb
+
+    if args.processes:
+        options['processes'] = args.processes
+
+    if args.engine:
+        options['engine'] = args.engine
+
+    if args.dedup_attachments:
+        options['dedup_attachments'] = True
+
+    if args.dedup_report:
+        options['dedup_report'] = True
+
+    if args.raw_only:
+        options['raw_only'] = True
+
+    if args.rebuild:
+        options['rebuild'] = args.rebuild
+
+    if args.storage:
+        options['storage'] = args.storage
+
+    if args.migrate_segments:
+        options['migrate_segments'] = True
+
+    if args.export_segments:
+        options['export_segments'] = args.export_segments
+
+    if args.catalog:
+        options['catalog'] = True
+
+    if args.rebuild_catalog:
+        options['rebuild_catalog'] = True
+
+    # one attachment store for all accounts and folders
+    options['blob_dir'] = os.path.join(options['local_folder'], BLOB_FOLDER) if options['dedup_attachments'] else None
+    # one PDF queue for all accounts and folders
+    options['pdf_queue'] = os.path.join(options['local_folder'], PDF_QUEUE_FOLDER) if options['wkhtmltopdf'] else None
+    # one segment store for all accounts and folders
+    options['segment_dir'] = os.path.join(options['local_folder'], SEGMENT_FOLDER) if options['storage'] == 'segments' else None
+    # one catalog for all accounts and folders
+    options['catalog_path'] = os.path.join(options['local_folder'], CATALOG_FILE) if options['catalog'] else None
+
+    if options['engine'] not in ['imaplib', 'asyncio']:
+        errorHandler(options['engine'], 'Invalid engine (use "imaplib" or "asyncio")')
+
+    if options['storage'] not in ['folders', 'segments']:
+        errorHandler(options['storage'], 'Invalid storage (use "folders" or "segments")')
+
+    if options['rebuild'] not in [False, True, 'all']:
+        errorHandler(options['rebuild'], 'Invalid rebuild parameter (use "all" or no parameter)')
+
     if args.show_version:
         print(get_version())
         sys.exit(0)
@@ -179,19 +369,61 @@ def main():
     argparser.add_argument('-a', '--account', dest='specific_account', metavar='ACCOUNT', help='Select a specific account section from the config to backup')
     argparser.add_argument('-f', '--folders', dest='specific_folders', help='Backup into specific account subfolders', action='store_true')
     argparser.add_argument('-w', '--wkhtmltopdf', dest='wkhtmltopdf', metavar='PATH', help='The location of the wkhtmltopdf binary. By default it will be located automatically if no path is provided.', default='', nargs='?')
+    argparser.add_argument('--pdf-workers', dest='pdf_workers', metavar='NUMBER', help='Number of wkhtmltopdf processes rendering the queued PDFs at once (default: 0, the number of cores)', type=int)
+    argparser.add_argument('--pdf-timeout', dest='pdf_timeout', metavar='SECONDS', help='Seconds a wkhtmltopdf process may run before it is killed (default: 120)', type=int)
+    argparser.add_argument('--render-pdfs', dest='render_pdfs', help='Render the queued PDFs of the local folder, also the failed ones, and exit', action='store_true')
     argparser.add_argument('-t', '--test', dest='test_only', nargs='?', const=True, default=False, metavar='"folders"', help='Only a connection and folder retrival test will be performed, adding the optional "folders" as parameter will also show the found folders')
     argparser.add_argument('-c', '--config', dest='specific_config', metavar='PATH', help='Path to a config file to use')
     argparser.add_argument('-v', '--version', dest='show_version', help='Show the current version', action='store_true')
     argparser.add_argument('-s', '--search', dest='search_filter', metavar='FILTER', help='Search in backuped emails (Filter: `Keyword,\"fnmatch syntax\"`)')
     argparser.add_argument('-so', '--search-output', dest='search_output', metavar='"text"|"json"', help='Search result output type (default: "text")', default="text", choices=['text', 'json'])
     argparser.add_argument('-i', '--input-dsn', dest='input_dsn', nargs='?', const=True, default=False, metavar='"gui"', help='Helper to generate a DSN string, adding the optional "gui" parameter will open the DSN generator in a GUI, can be used with --test')
-    argparser.add_argument('--server', dest='server', metavar='CRONTABSTRING', help='Starts as a server, triggering with the specified cron string')
+    argparser.add_argument('--server', dest='server', metavar='CRONTABSTRING', help='Starts as a server, triggering with the specified cron string, or "idle" to save new emails as they arrive')
+    argparser.add_argument('--reconcile', dest='reconcile', metavar='CRONTABSTRING', help='Cron string of the full backup in the "idle" server mode (default: "0 3 * * *")')
+    argparser.add_argument('--full-sync', dest='full_sync', help='Ignore the saved sync state and check all emails of the folders', action='store_true')
+    argparser.add_argument('--batch-size', dest='batch_size', metavar='NUMBER', help='Maximum number of emails to fetch with a single command (default: 200)', type=int)
+    argparser.add_argument('--batch-mb', dest='batch_mb', metavar='NUMBER', help='Maximum size in MB of the emails to fetch with a single command (default: 16)', type=int)
+    argparser.add_argument('--stream-mb', dest='stream_mb', metavar='NUMBER', help='Emails bigger than this size in MB are downloaded in chunks straight to disk (default: 0, disabled)', type=int)
+    argparser.add_argument('--parallel-folders', dest='parallel_folders', metavar='NUMBER', help='Number of folders of an account to backup in parallel, each using its own connection (default: 1)', type=int)
+    argparser.add_argument('--parallel-accounts', dest='parallel_accounts', metavar='NUMBER', help='Number of accounts to backup in parallel (default: 1)', type=int)
+    argparser.add_argument('--host-connections', dest='host_connections', metavar='NUMBER', help='Maximum number of simultaneous connections to the same IMAP host (default: no limit)', type=int)
+    argparser.add_argument('--rate-commands', dest='rate_commands', metavar='NUMBER', help='Maximum number of IMAP commands per second to the same IMAP host, lowered automatically when the server throttles (default: no limit)', type=float)
+    argparser.add_argument('--rate-mb', dest='rate_mb', metavar='NUMBER', help='Maximum MB per second downloaded from the same IMAP host, lowered automatically when the server throttles (default: no limit)', type=float)
+    argparser.add_argument('--processes', dest='processes', metavar='NUMBER', help='Number of worker processes saving the fetched emails while the next ones are downloaded (default: 0, saved by the fetching thread)', type=int)
+    argparser.add_argument('--dedup-attachments', dest='dedup_attachments', help='Store each attachment content once in the local folder, the attachments of the emails are linked to it', action='store_true')
+    argparser.add_argument('--dedup-report', dest='dedup_report', help='Show how much space the attachment store saves', action='store_true')
+    argparser.add_argument('--raw-only', dest='raw_only', help='Only save the raw.eml.gz of the emails, their other files are created by --rebuild', action='store_true')
+    argparser.add_argument('--rebuild', dest='rebuild', nargs='?', const=True, default=False, metavar='"all"', help='Create the missing and outdated files of the saved emails from their raw.eml.gz and exit, adding the optional "all" parameter will create them for all emails')
+    argparser.add_argument('--storage', dest='storage', metavar='"folders"|"segments"', help='Save each email into a folder of its own, or append them to segment files (default: "folders")', choices=['folders', 'segments'])
+    argparser.add_argument('--migrate-segments', dest='migrate_segments', help='Move the email folders of the local folder into its segment files and exit', action='store_true')
+    argparser.add_argument('--export-segments', dest='export_segments', metavar='PATH', help='Export the emails of the segment files of the local folder into email folders below PATH and exit')
+    argparser.add_argument('--catalog', dest='catalog', help='Also add the saved emails to an SQLite catalog in the local folder', action='store_true')
+    argparser.add_argument('--rebuild-catalog', dest='rebuild_catalog', help='Create the SQLite catalog of the local folder again from the saved emails and exit', action='store_true')
+    argparser.add_argument('--engine', dest='engine', metavar='"imaplib"|"asyncio"', help='IMAP engine to use, "asyncio" runs all connections on a single event loop (default: "imaplib")', choices=['imaplib', 'asyncio'])
     args = argparser.parse_args()
     options = load_configuration(args)
 
     if options['search_filter']:
         do_search(options)
 
+    if options['dedup_report']:
+        do_dedup_report(options)
+
+    if options['render_pdfs']:
+        do_render_pdfs(options)
+
+    if options['rebuild']:
+        do_rebuild(options)
+
+    if options['migrate_segments']:
+        do_migrate_segments(options)
+
+    if options['export_segments']:
+        do_export_segments(options)
+
+    if options['rebuild_catalog']:
+        do_rebuild_catalog(options)
+
     if options['input_dsn']:
         if options['input_dsn'] == 'gui':
             try:
@@ -210,48 +442,144 @@ def main():
         sys.exit(1)
 
     if options['server']:
-        start_server(options, do_accounts)
+        start_server(options, do_accounts, idle_watches)
         sys.exit(0)
 
     do_accounts(options)
+    message_pipeline.stop()
+    flush_catalogs()
+    if pdf_renderer.threads:
+        log('Waiting for the queued PDFs')
+        pdf_renderer.wait()
+        pdf_renderer.stop()
 
 
 def do_accounts(options):
     rootDir = options['local_folder']
+    connection_limiter.limit = options['host_connections']
+    throttles.commands_per_second = options['rate_commands']
+    throttles.bytes_per_second = options['rate_mb'] * 1024 * 1024
+    if not options['test_only']:
+        message_pipeline.start(options['processes'])
+        if options['pdf_queue']:
+            pdf_renderer.start(options['pdf_queue'], options['wkhtmltopdf'], options['pdf_workers'] or os.cpu_count() or 1, options['pdf_timeout'])
+
+    if options['engine'] == 'asyncio' and not options['test_only']:
+        from asyncimap import do_accounts_async # placed here, because it might not be needed on load, so loading speeds up
+        asyncio.run(do_accounts_async(options, rootDir))
+        return
+
+    workers = min(options['parallel_accounts'], len(options['accounts']))
+    if workers > 1:
+        def handle(account, resource):
+            set_log_prefix('[' + account['name'] + '] ')
+            try:
+                do_account(account, options, rootDir)
+            except SystemExit:
+                # the error was already shown, continue with the next account
+                errorHandler(None, ' - FAILED', exitCode=None)
 
-    for account in options['accounts']:
-
-        print('\n{}/{} (on {})'.format(account['name'], account['remote_folder'], account['host']))
+        run_parallel(interleave_by_host(options['accounts']), workers, handle)
+    else:
+        for account in options['accounts']:
+            do_account(account, options, rootDir)
 
-        if options['test_only']:
-            try:
-                folders = get_folders(account)
-                if options['test_only'] == 'folders':
-                    folder_entries_decoded = imaputf7decode( ', '.join(folders) )
-                    print(' - Folders:', folder_entries_decoded)
-                print(' - SUCCESS: Login and folder retrival')
-            except:
-                errorHandler(None, ' - FAILED: Login and folder retrival.', exitCode=None)
-            continue
 
-        if options['specific_folders']:
-            basedir = os.path.join(rootDir, account['name'])
-        else:
-            basedir = rootDir
+def do_account(account, options, rootDir):
+    log('\n{}/{} (on {})'.format(account['name'], account['remote_folder'], account['host']))
 
+    if options['test_only']:
         try:
+            folders = get_folders(account)
+            if options['test_only'] == 'folders':
+                folder_entries_decoded = imaputf7decode( ', '.join(folders) )
+                log(' - Folders:', folder_entries_decoded)
+            log(' - SUCCESS: Login and folder retrival')
+        except:
+            errorHandler(None, ' - FAILED: Login and folder retrival.', exitCode=None)
+        return
+
+    if options['specific_folders']:
+        basedir = os.path.join(rootDir, account['name'])
+    else:
+        basedir = rootDir
+
+    try:
+        # one session for the folder list and all folders (of the first worker)
+        with open_session(account, options) as session:
             if account['remote_folder'] == "__ALL__":
-                folders = get_folders(account)
+                folders = get_folders(account, session)
             else:
                 folders = str.split(account['remote_folder'], ',')
-            for folder_entry in folders:
-                folder_entry_decoded = imaputf7decode(folder_entry);
-                print("Saving folder: " + folder_entry_decoded) 
-                account['remote_folder'] = folder_entry
-                options['local_folder'] = os.path.join(basedir, folder_entry_decoded.replace('"', ''))
-                save_emails(account, options)
-        except Exception as e:
-            errorHandler(e, ' - FAILED')
+            save_folders(account, options, basedir, folders, session)
+    except Exception as e:
+        errorHandler(e, ' - FAILED')
+
+
+def idle_watches(options):
+    """The folders to watch with IDLE in the "idle" server mode, as (account, folder, sync) with sync(session) saving the new emails.
+    Defaults to the folders of the account, INBOX for __ALL__"""
+    watches = []
+    # the saved sync state is always used, --full-sync only applies to the full passes
+    watch_options = dict(options, full_sync=False)
+    for account in options['accounts']:
+        folders = account.get('idle_folders')
+        if not folders:
+            folders = 'INBOX' if account['remote_folder'] == '__ALL__' else account['remote_folder']
+
+        if options['specific_folders']:
+            basedir = os.path.join(options['local_folder'], account['name'])
+        else:
+            basedir = options['local_folder']
+
+        for folder_entry in str.split(folders, ','):
+            sync = lambda session, account=account, folder_entry=folder_entry, basedir=basedir: save_folder(account, watch_options, basedir, folder_entry, session)
+            watches.append((account, folder_entry, sync))
+    return watches
+
+
+def save_folder(account, options, basedir, folder_entry, session):
+    folder_entry_decoded = imaputf7decode(folder_entry)
+    # copies, so parallel folders (and the next server run) do not share them
+    folder_account = dict(account, remote_folder=folder_entry)
+    folder_options = dict(options, local_folder=os.path.join(basedir, folder_entry_decoded.replace('"', '')), catalog_target=catalog_target(options['catalog_path'], account, folder_entry_decoded.replace('"', '')))
+    return save_emails(folder_account, folder_options, session)
+
+
+def save_folders(account, options, basedir, folders, session):
+    total = [0, 0]
+    stats_lock = threading.Lock()
+
+    def add_stats(stats):
+        if stats:
+            with stats_lock:
+                total[0] += stats[0]
+                total[1] += stats[1]
+
+    workers = min(options['parallel_folders'], len(folders))
+    if workers > 1:
+        account_prefix = get_log_prefix()
+
+        def handle(folder_entry, worker_session):
+            set_log_prefix(account_prefix + '[' + imaputf7decode(folder_entry).replace('"', '') + '] ')
+            log('Saving folder')
+            try:
+                add_stats(save_folder(account, options, basedir, folder_entry, worker_session))
+            except SystemExit:
+                # the error was already shown, continue with the next folder
+                errorHandler(None, ' - FAILED', exitCode=None)
+            except Exception as e:
+                errorHandler(e, ' - FAILED', exitCode=None)
+
+        # each worker keeps its own session for all its folders
+        run_parallel(folders, workers, handle, lambda cancel: open_session(account, options, cancel), session)
+    else:
+        for folder_entry in folders:
+            log("Saving folder: " + imaputf7decode(folder_entry))
+            add_stats(save_folder(account, options, basedir, folder_entry, session))
+
+    if len(folders) > 1:
+        log('- All {} folders done. {} emails created, {} emails already exist'.format(len(folders), total[0], total[1]))
 
 
 def sigint_handler(signal, frame):
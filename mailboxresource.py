@@ -4,18 +4,177 @@
 from __future__ import print_function
 
 import imaplib, email
+import email.parser
+import email.policy
 import re
 import os
-from message import Message
+import gzip
+import hashlib
+import zlib
+import itertools
+import threading
+import time
+from message import Message, is_archived
+from folderstate import FolderState
+from scheduler import connection_limiter
+from throttle import throttles, is_throttling
+from pipeline import message_pipeline
+from segmentstore import save_message_segment, is_stored, refresh_store
+from catalog import catalog_message
+from messageindex import MessageIndex, record_message
+from mimespool import spool_message, discard_spooled
 import datetime
-from utilities import errorHandler, imaputf7encode, createReliableFoldername, createReliableMessageId, hasTTY
+from contextlib import contextmanager, nullcontext
+from utilities import errorHandler, imaputf7encode, imaputf7decode, createReliableFoldername, createReliableMessageId, showProgress, log
 
 MAX_RETRIES = 5
+# retries after throttling are counted separately, they wait for the (growing) backoff of the host
+MAX_THROTTLED_RETRIES = 10
+# special-use flags (RFC 6154) of the Gmail folders archived with gmail_dedup, all other folders are labels within "All Mail"
+GMAIL_FOLDER_FLAGS = ('\\All', '\\Trash', '\\Junk')
+
+labels_re = re.compile(rb'X-GM-LABELS \(((?:[^()"]|"(?:\\.|[^"\\])*")*)\)')
+label_re = re.compile(rb'"(?P<quoted>(?:\\.|[^"\\])*)"|(?P<atom>[^\s"]+)')
+folder_flags_re = re.compile(rb'^\(([^)]*)\)')
+# number of UIDs per header request, used to skip archived messages and to plan the message batches
+HEADER_BATCH = 1000
+# size of the partial fetches of streamed messages
+STREAM_CHUNK = 4 * 1024 * 1024
+# number of UIDs per SEARCH, and the maximum number of SEARCH commands per folder
+SEARCH_WINDOW = 5000
+MAX_SEARCHES = 1000
+# size of the slices of a raw message fed to the parser
+PARSE_CHUNK = 64 * 1024
+# maximum number of compressed bytes read from the socket at once
+COMPRESS_READ = 64 * 1024
+# IDLE is restarted before the 30 minutes servers may drop an idle connection after (RFC 2177)
+IDLE_TIMEOUT = 29 * 60
+# servers without IDLE are checked this often
+IDLE_POLL = 60
+idle_response_re = re.compile(rb'^\* (\d+) (EXISTS|EXPUNGE)\b', re.I)
+
+# imaplib only sends commands it knows
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class CompressedConnection:
+    """Adds COMPRESS=DEFLATE (RFC 4978) to an imaplib connection, active once enableCompression() succeeded"""
+
+    compressor = None
+    decompressor = None
+
+    def enableCompression(self):
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.inflated = bytearray()
+        return True
+
+    def fill(self):
+        data = self.file.read1(COMPRESS_READ)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self.inflated += self.decompressor.decompress(data)
+
+    def read(self, size):
+        if self.decompressor is None:
+            return super().read(size)
+
+        while len(self.inflated) < size:
+            self.fill()
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def readline(self):
+        if self.decompressor is None:
+            return super().readline()
+
+        start = 0
+        while True:
+            end = self.inflated.find(b'\n', start)
+            if end >= 0:
+                break
+            if len(self.inflated) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            start = len(self.inflated)
+            self.fill()
+        line = bytes(self.inflated[:end + 1])
+        del self.inflated[:end + 1]
+        return line
+
+    def send(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+
+class ThrottledConnection:
+    """Applies the rate limits and backoff of a HostThrottle (set as throttle) to an imaplib connection"""
+
+    throttle = None
+
+    def _command(self, name, *args):
+        if self.throttle is not None:
+            sleep(self.throttle.command())
+        return super()._command(name, *args)
+
+    def _command_complete(self, name, tag):
+        try:
+            typ, data = super()._command_complete(name, tag)
+        except (self.abort, OSError) as e:
+            # a dropped connection is often the way a server throttles
+            self.noteThrottled(e)
+            raise
+        except self.error as e:
+            if is_throttling(e):
+                self.noteThrottled(e)
+            raise
+
+        if self.throttle is not None:
+            if typ == 'OK':
+                self.throttle.succeeded()
+            elif is_throttling(data[-1] if data else b''):
+                self.noteThrottled(data[-1])
+        return typ, data
+
+    def read(self, size):
+        data = super().read(size)
+        if self.throttle is not None:
+            sleep(self.throttle.received(len(data)))
+        return data
+
+    def readline(self):
+        line = super().readline()
+        if self.throttle is not None:
+            sleep(self.throttle.received(len(line)))
+        return line
+
+    def noteThrottled(self, reason):
+        if self.throttle is not None:
+            delay = self.throttle.throttled(reason)
+            errorHandler(None, f"Warning: Throttled by {self.throttle.host} ({reason}), backing off {delay:.0f}s ({self.throttle.status()})", exitCode=None)
+
+
+class IMAP4(ThrottledConnection, CompressedConnection, imaplib.IMAP4):
+    pass
+
+
+class IMAP4_SSL(ThrottledConnection, CompressedConnection, imaplib.IMAP4_SSL):
+    pass
+
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
 
 class MailboxClient:
     """Operations on a mailbox"""
 
-    def __init__(self, host, port, username, password, remote_folder, ssl):
+    def __init__(self, host, port, username, password, remote_folder, ssl, batch_size=200, batch_mb=16, stream_mb=0, compress=True, gmail_dedup=False):
 
         self.host = host
         self.port = port
@@ -23,7 +182,22 @@ class MailboxClient:
         self.password = password
         self.remote_folder = remote_folder
         self.ssl = ssl
+        self.compress = compress
+        self.gmail_dedup = gmail_dedup
+        self.gmail = False
         self.selected_folder = False
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestmodseq = None
+        self.exists = 0
+        self.condstore = False
+        self.esearch = False
+        self.batch_size = max(1, batch_size)
+        self.batch_bytes = max(1, batch_mb) * 1024 * 1024
+        # messages bigger than this are streamed to disk in chunks, 0 to disable
+        self.stream_bytes = max(0, stream_mb) * 1024 * 1024
+        self.state = None
+        self.throttle = throttles.get(host)
 
         self.connect_to_imap()
 
@@ -31,203 +205,925 @@ class MailboxClient:
         retries = 0
         while retries < MAX_RETRIES:
             try:
+                sleep(self.throttle.backoffDelay())
                 if not self.ssl:
-                    self.mailbox = imaplib.IMAP4(self.host, self.port)
+                    self.mailbox = IMAP4(self.host, self.port)
                 else:
-                    self.mailbox = imaplib.IMAP4_SSL(self.host, self.port)
+                    self.mailbox = IMAP4_SSL(self.host, self.port)
+                self.mailbox.throttle = self.throttle
                 self.mailbox.login(self.username, self.password)
-                typ, data = self.mailbox.select(self.remote_folder, readonly=True)
-                if typ != 'OK':
-                    # Handle case where Exchange/Outlook uses '.' path separator when
-                    # reporting subfolders. Adjust to use '/' on remote.
-                    adjust_remote_folder = re.sub(r'\.', '/', self.remote_folder)
-                    typ, data = self.mailbox.select(adjust_remote_folder, readonly=True)
-                    if typ != 'OK':
-                        errorHandler(self.remote_folder, 'MailboxClient: Could not select remote folder', exitCode=None)
-                        self.selected_folder = False
-                    else:
-                        self.selected_folder = True   
-                else:
-                    self.selected_folder = True
+                self.enable_extensions()
+
+                # reselect the current folder on reconnects
+                if self.remote_folder:
+                    self.select_folder(self.remote_folder)
                 break
             except ConnectionResetError as e:
                 errorHandler(None, f"MailboxClient: Connection error: {e}. Will retry ...", exitCode=None)
                 retries += 1
+            except imaplib.IMAP4.error as e:
+                if not is_throttling(e):
+                    errorHandler(None, f"MailboxClient: The following error happened: {e}. Will NOT retry.")
+                errorHandler(None, f"MailboxClient: Throttled: {e}. Will retry ...", exitCode=None)
+                retries += 1
             except Exception as e:
                 errorHandler(None, f"MailboxClient: The following error happened: {e}. Will NOT retry.")
 
         if retries == MAX_RETRIES:
             errorHandler(None, 'MailboxClient: Maximum retries reached. Exiting.')
 
-    def search_emails(self, criterion, batch_size=5000):
-        all_uids = []
-        last_num = 0
-        loop = True
+    def enable_extensions(self):
+        """Enable COMPRESS and CONDSTORE if the server supports them.
+        Capabilities are asked for again, since servers often only announce them after the login"""
+        typ, data = self.mailbox.capability()
+        if typ == 'OK' and data and data[-1]:
+            self.mailbox.capabilities = tuple(data[-1].decode('ascii', 'replace').upper().split())
+
+        if self.compress and 'COMPRESS=DEFLATE' in self.mailbox.capabilities:
+            try:
+                if not self.mailbox.enableCompression():
+                    errorHandler(None, "Warning: The server refused COMPRESS=DEFLATE", exitCode=None)
+            except imaplib.IMAP4.error as e:
+                errorHandler(None, f"Warning: Could not enable COMPRESS=DEFLATE: {e}", exitCode=None)
+
+        self.esearch = 'ESEARCH' in self.mailbox.capabilities
+        self.gmail = self.gmail_dedup and 'X-GM-EXT-1' in self.mailbox.capabilities
+        self.enable_condstore()
+
+    def enable_condstore(self):
+        """Enable CONDSTORE if the server supports it (QRESYNC implies it), so SELECT reports the HIGHESTMODSEQ"""
+        capabilities = self.mailbox.capabilities
+        self.condstore = 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities
+        if self.condstore and 'ENABLE' in capabilities:
+            try:
+                self.mailbox.enable('CONDSTORE')
+            except Exception as e:
+                errorHandler(None, f"Warning: Could not enable CONDSTORE: {e}", exitCode=None)
+                self.condstore = False
+
+    def select_folder(self, remote_folder):
+        """Switch the session to another remote folder (read only)"""
+        self.remote_folder = remote_folder
+        self.selected_folder = False
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestmodseq = None
+        self.exists = 0
 
-        while loop:
-            typ, data = self.mailbox.search(None, criterion, f'{last_num+1}:{last_num + batch_size}')
+        typ, data = self.mailbox.select(self.remote_folder, readonly=True)
+        if typ != 'OK':
+            # Handle case where Exchange/Outlook uses '.' path separator when
+            # reporting subfolders. Adjust to use '/' on remote.
+            adjust_remote_folder = re.sub(r'\.', '/', self.remote_folder)
+            typ, data = self.mailbox.select(adjust_remote_folder, readonly=True)
             if typ != 'OK':
-                # fallback if range is not supported
-                errorHandler(None, f"Warning: Batch range might not be supported by IMAP server. Retrying without ...", exitCode=None)
-                loop = False
-                typ, data = self.mailbox.search(None, criterion)
+                errorHandler(self.remote_folder, 'MailboxClient: Could not select remote folder', exitCode=None)
+                self.selected_folder = False
+            else:
+                self.selected_folder = True   
+        else:
+            self.selected_folder = True
 
-                if typ != 'OK':
-                    raise imaplib.IMAP4.error(f"Error on searching emails ({criterion}: \"{typ}\" => {data}).")
+        if self.selected_folder:
+            self.exists = int(data[-1]) if data and data[-1] else 0
+            self.uidvalidity = self.getResponseCode('UIDVALIDITY')
+            self.uidnext = self.getResponseCode('UIDNEXT')
+            if self.condstore:
+                # None if the folder has no persistent mod-sequences (NOMODSEQ)
+                self.highestmodseq = self.getResponseCode('HIGHESTMODSEQ')
+
+        return self.selected_folder
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        """Wait for new emails in the selected folder with IDLE (RFC 2177), up to timeout seconds.
+        Returns True if the server reported new emails, False if the timeout passed.
+        Without IDLE support, it waits IDLE_POLL seconds and returns True, to check the folder again"""
+        if 'IDLE' not in self.mailbox.capabilities:
+            time.sleep(min(timeout, IDLE_POLL))
+            return True
 
-            if data and len(data) > 0 and data[0]: 
-                batch_uids = data[0].split()
+        mailbox = self.mailbox
+        tag = mailbox._new_tag()
+        mailbox.send(tag + b' IDLE\r\n')
+        arrived = False
+        line = mailbox._get_line()
+        while line.startswith(b'* '):
+            arrived = self.idleResponse(line) or arrived
+            line = mailbox._get_line()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE refused: {line}")
+
+        # DONE ends the IDLE, sent on the first new email or by a timer, while the responses are read until the tagged one
+        done = []
+        done_lock = threading.Lock()
+
+        def finish():
+            with done_lock:
+                if not done:
+                    done.append(True)
+                    mailbox.send(b'DONE\r\n')
+
+        timer = threading.Timer(timeout, finish)
+        timer.daemon = True
+        timer.start()
+        try:
+            if arrived:
+                finish()
+            while True:
+                line = mailbox._get_line()
+                if line.startswith(tag):
+                    break
+                if self.idleResponse(line):
+                    arrived = True
+                    finish()
+        finally:
+            timer.cancel()
+
+        if not line[len(tag):].strip().upper().startswith(b'OK'):
+            raise imaplib.IMAP4.error(f"IDLE failed: {line}")
+        return arrived
+
+    def idleResponse(self, line):
+        """Track the message count of an untagged response while idling, returns True if there are new emails"""
+        if line.startswith(b'* BYE'):
+            raise imaplib.IMAP4.abort(line.decode('utf-8', 'replace'))
+
+        match = idle_response_re.match(line)
+        if not match:
+            return False
+        if match.group(2).upper() == b'EXPUNGE':
+            self.exists = max(0, self.exists - 1)
+            return False
+        count = int(match.group(1))
+        arrived = count > self.exists
+        self.exists = count
+        return arrived
+
+    def list_folders(self):
+        return self.mailbox.list()[1]
+
+    def getResponseCode(self, code):
+        """Get a numeric response code (like UIDVALIDITY) of the last SELECT, None if the server did not send it"""
+        typ, data = self.mailbox.response(code)
+        if data and data[0]:
+            try:
+                return int(data[-1])
+            except ValueError:
+                pass
+        return None
+
+    def search_emails(self, criterion, first_uid=1, changed_since=None):
+        """Search for the UIDs matching the criterion from first_uid on, and with a MODSEQ above changed_since if it is set.
+        Returns the number of matches (an estimate if the server has no ESEARCH) and a generator of the UIDs in ascending order"""
+        if changed_since is not None:
+            criterion = f'MODSEQ {changed_since + 1} {criterion}'
+
+        if self.esearch:
+            result = self.esearchUids(f'UID {first_uid}:* {criterion}', 'MIN MAX COUNT')
+            # 'n:*' always matches the last message, even if its UID is lower than n
+            if not result.get('COUNT') or result['MAX'] < first_uid:
+                return (0, iter(()))
+            first = max(first_uid, result['MIN'])
+            last = result['MAX']
+            total = result['COUNT']
+        else:
+            first = first_uid
+            last = self.uidnext - 1 if self.uidnext is not None else None
+            total = self.exists
+            if last is not None:
+                total = min(total, last - first + 1)
+
+        return (total, self.iterUids(criterion, first, last))
+
+    def iterUids(self, criterion, first, last):
+        """Yield the UIDs matching the criterion between first and last, searching window by window of UIDs"""
+        for start, end in search_windows(first, last):
+            window = f'UID {start}:{end} {criterion}'
+            if self.esearch:
+                uids = expand_uid_set(self.esearchUids(window, 'ALL').get('ALL', b''))
             else:
-                batch_uids = []
+                typ, data = self.mailbox.uid('search', None, window)
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error(f"Error on searching emails ({window}: \"{typ}\" => {data}).")
+                uids = sorted(int(uid) for uid in (data[0] or b'').split()) if data else []
 
-            if not batch_uids:
-                break
+            for uid in uids:
+                if uid >= first:
+                    yield uid
 
-            all_uids.extend(batch_uids)
-            last_num = last_num + batch_size
+    def esearchUids(self, criterion, returns):
+        """Run an ESEARCH (RFC 4731), returns a dict of the requested results (MIN, MAX, COUNT as int, ALL as UID set)"""
+        typ, data = self.mailbox.uid('search', None, f'RETURN ({returns})', criterion)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"Error on searching emails ({criterion}: \"{typ}\" => {data}).")
+        typ, data = self.mailbox.response('ESEARCH')
+        return parse_esearch(data[-1] if data and data[-1] else b'')
 
-        return all_uids
-    
-    def copy_emails(self, days, local_folder, wkhtmltopdf):
+    def copy_emails(self, days, local_folder, pdf_queue, full_sync=False, blob_dir=None, raw_only=False, segment_dir=None, catalog=None):
 
         n_saved = 0
         n_exists = 0
 
         self.local_folder = local_folder
-        self.wkhtmltopdf = wkhtmltopdf
-        criterion = 'ALL'
-
-        if days:
-            date = (datetime.date.today() - datetime.timedelta(days)).strftime("%d-%b-%Y")
-            criterion = '(SENTSINCE {date})'.format(date=date)
-
-        uids = self.search_emails(criterion)
-        if uids is not None and uids is not []:
-            print("- Copying emails ...")
-            total = len(uids)
-            for idx, num in enumerate(uids):
-                fetch_retries = 0
-                while fetch_retries < MAX_RETRIES:
-                    try:
-                        typ, data = self.mailbox.fetch(num, '(BODY.PEEK[])')
-
-                        if hasTTY():
-                            print('\r{0:.2f}% '.format(idx*100/total), end='')
-
-                        if self.saveEmail(data):
-                            n_saved += 1
+        self.pdf_queue = pdf_queue
+        self.blob_dir = blob_dir
+        self.raw_only = raw_only
+        self.segment_dir = segment_dir
+        self.catalog = catalog
+        criterion = sync_criterion(days)
+
+        state = self.state = open_folder_state(local_folder, self.uidvalidity, days, full_sync)
+        if state.unchanged(self.uidnext, self.highestmodseq):
+            # nothing new since the last run
+            return (n_saved, n_exists)
+
+        # the segment store has an index of its own
+        index = MessageIndex(local_folder, full_sync) if not segment_dir else None
+        changed_since = state.highestmodseq if self.highestmodseq is not None else None
+        total, uids = self.search_emails(criterion, first_uid=state.last_uid + 1, changed_since=changed_since)
+        # the failed messages of the last runs first
+        retry_uids = state.retryUids()
+        total += len(retry_uids)
+        uids = itertools.chain(retry_uids, uids)
+        if total:
+            log("- Copying emails ...")
+            idx = 0
+            for header_chunk in chunks(uids, HEADER_BATCH):
+                headers = self.retryFetch(self.fetchHeaders, header_chunk) or {}
+
+                # uid => True if it is archived (or was expunged), False if it failed
+                outcomes, sizes, download = split_archived(local_folder, header_chunk, headers, segment_dir, index)
+                n_exists += len(outcomes)
+                idx += len(outcomes)
+                pos = state.advance(header_chunk, outcomes, 0)
+
+                # the next batch is fetched while the worker processes still save the previous one
+                saving = None
+                for batch in plan_batches(download, sizes, self.batch_size, self.batch_bytes, self.stream_bytes):
+                    if is_streamed(batch, sizes, self.stream_bytes):
+                        messages = self.retryFetch(self.streamMessage, batch)
+                    else:
+                        messages = self.retryFetch(self.fetchMessages, batch)
+                    if saving:
+                        n_saved, n_exists = finish_saving(saving, outcomes, n_saved, n_exists)
+                        pos = state.advance(header_chunk, outcomes, pos)
+
+                    saving = []
+                    for uid in batch:
+                        if showProgress():
+                            print('\r{0:.2f}% {1}   '.format(min(idx*100/total, 100), self.throttle.status()), end='')
+                        idx += 1
+
+                        if messages is None:
+                            outcomes[uid] = False
+                        elif uid in messages:
+                            saving.append((uid, self.saveEmail(messages[uid], header_metadata(headers, uid))))
                         else:
-                            n_exists += 1
-                        break
-                    except ConnectionResetError as e:
-                        errorHandler(None, f"Connection error while fetching email: {e}. Retrying ...", exitCode=None)
-                        self.connect_to_imap()
-                        fetch_retries += 1
-                    except imaplib.IMAP4.abort as e:
-                        errorHandler(None, f"Abort error while fetching email: {e}. Skipping ...", exitCode=None)
-                        self.connect_to_imap()
-                        break
-                    except Exception as e:
-                        errorHandler(None, f"Error while fetching email: {e}. Skipping ...", exitCode=None)
-                        break
-                if fetch_retries == MAX_RETRIES:
-                    errorHandler(None, '\nMaximum retries reached. Exiting.', 1)
+                            # expunged in the meantime, nothing to archive
+                            outcomes[uid] = True
+
+                if saving:
+                    n_saved, n_exists = finish_saving(saving, outcomes, n_saved, n_exists)
+                state.advance(header_chunk, outcomes, pos)
                     
             # print("\r- ... done")
+
+        state.complete(self.highestmodseq)
+        state.save()
+        if index:
+            index.save()
         return (n_saved, n_exists)
 
+    def retryFetch(self, fetch, uids):
+        """Run a fetch method for a list of UIDs, reconnecting on connection errors. Returns None if it was skipped"""
+        fetch_retries = 0
+        throttled_retries = 0
+        while fetch_retries < MAX_RETRIES and throttled_retries < MAX_THROTTLED_RETRIES:
+            try:
+                return fetch(uids)
+            except ConnectionResetError as e:
+                # the reconnect waits for the backoff of the host
+                errorHandler(None, f"Connection error while fetching email: {e}. Retrying ...", exitCode=None)
+                self.connect_to_imap()
+                fetch_retries += 1
+            except imaplib.IMAP4.abort as e:
+                if is_throttling(e):
+                    errorHandler(None, f"Throttled while fetching email: {e}. Retrying ...", exitCode=None)
+                    self.connect_to_imap()
+                    throttled_retries += 1
+                    continue
+                errorHandler(None, f"Abort error while fetching email: {e}. Skipping ...", exitCode=None)
+                self.connect_to_imap()
+                return None
+            except imaplib.IMAP4.error as e:
+                if is_throttling(e):
+                    # the next command waits for the backoff of the host
+                    errorHandler(None, f"Throttled while fetching email: {e}. Retrying ...", exitCode=None)
+                    throttled_retries += 1
+                    continue
+                errorHandler(None, f"Error while fetching email: {e}. Skipping ...", exitCode=None)
+                return None
+            except Exception as e:
+                errorHandler(None, f"Error while fetching email: {e}. Skipping ...", exitCode=None)
+                return None
+
+        if self.state:
+            self.state.save()
+        errorHandler(None, '\nMaximum retries reached. Exiting.', 1)
+
+    def fetchHeaders(self, uids):
+        """Get the RFC822.SIZE and the Message-Id and Date headers for a list of UIDs, returns a dict of uid => (size, header, metadata)"""
+        typ, data = self.mailbox.uid('fetch', uid_set(uids), header_items(self.gmail))
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"Error on fetching email headers: \"{typ}\" => {data}.")
+
+        return parse_headers(parse_fetch_response(data), self.gmail)
+
+    def fetchMessages(self, uids):
+        """Fetch the full messages for a list of UIDs with a single command, returns a dict of uid => raw message"""
+        typ, data = self.mailbox.uid('fetch', uid_set(uids), '(UID BODY.PEEK[])')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"Error on fetching emails: \"{typ}\" => {data}.")
+
+        messages = {}
+        for attributes, literal in parse_fetch_response(data):
+            uid = fetch_attribute(attributes, b'UID')
+            if uid is not None and literal is not None:
+                messages[uid] = literal
+        return messages
+
+    def streamMessage(self, uids):
+        """Fetch a single message in chunks into a temporary file, returns a dict of uid => RawMessageFile"""
+        uid = uids[0]
+        raw_file = RawMessageFile(self.local_folder, uid)
+        try:
+            while True:
+                typ, data = self.mailbox.uid('fetch', str(uid), f'(UID BODY.PEEK[]<{raw_file.size}.{STREAM_CHUNK}>)')
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error(f"Error on fetching email: \"{typ}\" => {data}.")
+
+                chunk = stream_chunk(uid, parse_fetch_response(data))
+                if chunk:
+                    raw_file.write(chunk)
+                if not chunk or len(chunk) < STREAM_CHUNK:
+                    break
+        except BaseException:
+            raw_file.discard()
+            raise
+
+        return raw_file.finish()
+
     def cleanup(self):
-        self.mailbox.close()
+        if self.mailbox.state == 'SELECTED':
+            self.mailbox.close()
         self.mailbox.logout()
 
 
     def getEmailFolder(self, msg, data):
-        # 255is the max filename length on all systems
-        foldername = createReliableFoldername(msg['Message-Id'], data)
-
-        year = 'None'
-        if msg['Date']:
-            match = re.search(r'\d{1,2}\s\w{3}\s(\d{4})', msg['Date'])
-            if match:
-                year = match.group(1)
-
-        return os.path.join(self.local_folder, year, foldername)
-
-
-    def saveEmail(self, data):
-        for response_part in data:
-            if isinstance(response_part, tuple):
-                msg = ""
-                # Handle Python version differences:
-                # Python 2 imaplib returns bytearray, Python 3 imaplib
-                # returns str.
-                if isinstance(response_part[1], str):
-                    msg = email.message_from_string(response_part[1])
-                else:
-                    try:
-                        msg = email.message_from_string(response_part[1].decode("utf-8"))
-                    except:
-                        # print("couldn't decode message with utf-8 - trying 'ISO-8859-1'")
-                        msg = email.message_from_string(response_part[1].decode("ISO-8859-1"))
-                
-                msg['Message-Id'] = message_id = createReliableMessageId(msg['Message-Id'], data)
-                directory = self.getEmailFolder(msg, data[0][1])
-
-                # we might retrying it, so check if directory exists and continue
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-
-                try:
-                    message = Message(directory, msg, message_id)
-                    if message.checkIfExists(): return False
-                    message.createRawFile(data[0][1])
-                    message.createMetaFile()
-                    message.extractAttachments()
-
-                    if self.wkhtmltopdf:
-                        message.createPdfFile(self.wkhtmltopdf)
-
-                except Exception as e:
-                    # ex: Unsupported charset on decode
-                    errorHandler(e, f'\rError: MailboxClient.saveEmail() failed for {directory}', exitCode=None)
+        return get_email_folder(self.local_folder, msg, data)
+
+
+    def saveEmail(self, raw, metadata=None):
+        """Save a message by the message pipeline, returns its result (get() is False if it already exists)"""
+        return message_pipeline.submit(save_message, self.local_folder, raw, self.pdf_queue, metadata, self.blob_dir, self.raw_only, self.segment_dir, self.catalog)
 
-        return True
 
+@contextmanager
+def open_session(account, options, cancel=None, limited=True):
+    """Log into an account without selecting a folder, holding a connection slot of the host while it is open.
+    Gives None if cancel() returned True while waiting for the slot.
 
-def save_emails(account, options):
-    mailbox = MailboxClient(account['host'], account['port'], account['username'], account['password'], account['remote_folder'], account['ssl'])
-    if mailbox.selected_folder is True:
-        stats = mailbox.copy_emails(options['days'], options['local_folder'], options['wkhtmltopdf'])
-        mailbox.cleanup()
+    limited: False for connections kept open (like IDLE), which would hold a slot forever
+    """
+    with (connection_limiter.slot(account['host'], cancel) if limited else nullcontext(True)) as acquired:
+        if not acquired:
+            yield None
+            return
+        session = MailboxClient(account['host'], account['port'], account['username'], account['password'], None, account['ssl'], options['batch_size'], options['batch_mb'], options['stream_mb'], account.get('compress', True), account.get('gmail_dedup', False))
+        try:
+            yield session
+        finally:
+            try:
+                session.cleanup()
+            except Exception:
+                pass
+
+
+def save_emails(account, options, session=None):
+    if session is None:
+        with open_session(account, options) as session:
+            return save_emails(account, options, session)
+
+    if session.select_folder(account['remote_folder']):
+        stats = session.copy_emails(options['days'], options['local_folder'], options['pdf_queue'], options['full_sync'], options['blob_dir'], options['raw_only'], options['segment_dir'], options['catalog_target'])
         if stats[0] == 0 and stats[1] == 0:
-            print('\r- Done. Is empty')
+            log('\r- Done. No new emails')
+        else:
+            log('\r- Done. {} emails created, {} emails already exist'.format(stats[0], stats[1]))
+        return stats
+    return None
+
+
+def finish_saving(saving, outcomes, n_saved, n_exists):
+    """Wait for the saving of a batch, (uid, result) in order, the checkpoint only moves over saved messages"""
+    for uid, result in saving:
+        try:
+            saved = result.get()
+        except Exception as e:
+            # ex: an I/O error, only this message is skipped and retried on the next run
+            errorHandler(e, f'\rError: Could not save email {uid}', exitCode=None)
+            outcomes[uid] = False
+            continue
+        if saved:
+            n_saved += 1
+        else:
+            n_exists += 1
+        outcomes[uid] = True
+    return (n_saved, n_exists)
+
+
+def sync_criterion(days):
+    criterion = 'ALL'
+    if days:
+        date = (datetime.date.today() - datetime.timedelta(days)).strftime("%d-%b-%Y")
+        criterion = '(SENTSINCE {date})'.format(date=date)
+    return criterion
+
+
+def open_folder_state(local_folder, uidvalidity, days, full_sync):
+    state = FolderState(local_folder)
+    if full_sync or uidvalidity is None:
+        state.reset()
+    elif not state.validate(uidvalidity):
+        errorHandler(None, '- UIDVALIDITY of the remote folder changed. Doing a full resync ...', exitCode=None)
+    state.uidvalidity = uidvalidity
+
+    # with a days filter, older messages are not copied, so the checkpoint must not move
+    state.frozen = bool(days) or uidvalidity is None
+    return state
+
+
+def get_email_year(msg):
+    year = 'None'
+    if msg['Date']:
+        match = re.search(r'\d{1,2}\s\w{3}\s(\d{4})', msg['Date'])
+        if match:
+            year = match.group(1)
+    return year
+
+
+def get_email_folder(local_folder, msg, data):
+    # 255is the max filename length on all systems
+    foldername = createReliableFoldername(msg['Message-Id'], data)
+    return os.path.join(local_folder, get_email_year(msg), foldername)
+
+
+def header_items(gmail=False):
+    """FETCH items of the header pre-pass, on Gmail with the message id and labels"""
+    if gmail:
+        return '(UID RFC822.SIZE X-GM-MSGID X-GM-LABELS BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)])'
+    return '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)])'
+
+
+def parse_headers(messages, gmail=False):
+    """Turn the (attributes, literal) pairs of the header pre-pass into a dict of uid => (size, header, metadata)"""
+    headers = {}
+    for attributes, literal in messages:
+        uid = fetch_attribute(attributes, b'UID')
+        if uid is not None:
+            headers[uid] = (fetch_attribute(attributes, b'RFC822.SIZE') or 0, literal or b'', gmail_metadata(attributes) if gmail else None)
+    return headers
+
+
+def header_metadata(headers, uid):
+    """Get the metadata of a UID from the header pre-pass, for its metadata.json"""
+    if uid in headers:
+        return headers[uid][2]
+    return None
+
+
+def gmail_metadata(attributes):
+    """Get the Gmail message id and labels of a FETCH response"""
+    metadata = {'Labels': fetch_labels(attributes)}
+    message_id = fetch_attribute(attributes, b'X-GM-MSGID')
+    if message_id is not None:
+        # as string, a 64 bit number is not safe in JSON
+        metadata['GmailMessageId'] = str(message_id)
+    return metadata
+
+
+def fetch_labels(attributes):
+    """Get the X-GM-LABELS of a FETCH response as list of decoded label names"""
+    match = labels_re.search(attributes)
+    if not match:
+        return []
+
+    labels = []
+    for label in label_re.finditer(match.group(1)):
+        if label.group('atom') is not None:
+            value = label.group('atom')
+        else:
+            value = re.sub(rb'\\(.)', rb'\1', label.group('quoted'))
+        value = value.decode('ascii', 'replace')
+        try:
+            labels.append(imaputf7decode(value))
+        except Exception:
+            labels.append(value)
+    return labels
+
+
+def get_header_folder(local_folder, header):
+    """Get the folder of a message from its Message-Id and Date headers, None if the full message is needed for it"""
+    msg = parse_message(header)
+    message_id = msg['Message-Id']
+
+    # without a usable Message-Id, the folder name is a hash of the full message
+    if not message_id or len(message_id.strip()) >= 255:
+        return None
+
+    return os.path.join(local_folder, get_email_year(msg), createReliableFoldername(message_id, None))
+
+
+def split_archived(local_folder, uids, headers, segment_dir=None, index=None):
+    """Split UIDs by their headers into archived ones and ones to download, in the segments of segment_dir if set,
+    else in the MessageIndex `index` (the disk is only checked for emails missing in it).
+    Returns the outcomes of the archived UIDs (uid => True), the sizes of the others and the UIDs to download"""
+    outcomes = {}
+    sizes = {}
+    download = []
+    if segment_dir:
+        # once for the UIDs, not per missing email
+        refresh_store(segment_dir)
+    for uid in uids:
+        if uid in headers:
+            size, header = headers[uid][:2]
+            directory = get_header_folder(local_folder, header)
+            if directory and (is_stored(segment_dir, directory) if segment_dir else index.isArchived(directory) if index else is_archived(directory)):
+                outcomes[uid] = True
+                continue
+            sizes[uid] = size
+        download.append(uid)
+    return (outcomes, sizes, download)
+
+
+def plan_batches(uids, sizes, batch_size, batch_bytes, stream_bytes=0):
+    """Group UIDs into batches, limited by the number of messages and the sum of their sizes.
+    Messages bigger than stream_bytes (if set) always get a batch of their own"""
+    batch = []
+    total_bytes = 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if is_streamed([uid], sizes, stream_bytes):
+            if batch:
+                yield batch
+            yield [uid]
+            batch = []
+            total_bytes = 0
+            continue
+        if batch and (len(batch) >= batch_size or total_bytes + size > batch_bytes):
+            yield batch
+            batch = []
+            total_bytes = 0
+        batch.append(uid)
+        total_bytes += size
+    if batch:
+        yield batch
+
+
+def is_streamed(batch, sizes, stream_bytes):
+    """Tell if a batch is a single message to stream to disk instead of fetching it at once"""
+    return bool(stream_bytes) and len(batch) == 1 and sizes.get(batch[0], 0) > stream_bytes
+
+
+def stream_chunk(uid, messages):
+    """Get the literal of a partial fetch of a message, None if the server did not send one (ex: expunged)"""
+    for attributes, literal in messages:
+        if fetch_attribute(attributes, b'UID') == uid:
+            return literal
+    return None
+
+
+class RawMessageFile:
+    """A message streamed in chunks into a temporary gzip file, keeping its hash and its header for the folder name"""
+
+    def __init__(self, local_folder, uid):
+        if not os.path.exists(local_folder):
+            os.makedirs(local_folder, exist_ok=True)
+        self.uid = uid
+        self.path = os.path.join(local_folder, f'.imapbox-{uid}.eml.gz.tmp')
+        self.file = gzip.open(self.path, 'wb')
+        self.hash = hashlib.sha224()
+        self.header = b''
+        self.header_done = False
+        self.size = 0
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+        if not self.header_done:
+            self.header += chunk
+            for separator in (b'\r\n\r\n', b'\n\n'):
+                end = self.header.find(separator)
+                if end >= 0:
+                    self.header = self.header[:end + len(separator)]
+                    self.header_done = True
+                    break
+
+    def finish(self):
+        """Close the file, returns a dict of uid => self like fetchMessages, or an empty one if nothing was received"""
+        self.file.close()
+        self.digest = self.hash.hexdigest()
+        if not self.size:
+            self.discard()
+            return {}
+        return {self.uid: self}
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        # a finished file is passed to the worker processes, without its closed file and hash
+        state = dict(self.__dict__)
+        state['file'] = None
+        state['hash'] = None
+        return state
+
+
+class RawHeaderPolicy(email.policy.Compat32):
+    """compat32, but header values with raw 8-bit bytes (mostly UTF-8, against the RFCs) are given as text instead of
+    Header objects, decoded like the whole message was before: UTF-8, or ISO-8859-1 if it is not valid UTF-8"""
+
+    def header_fetch_parse(self, name, value):
+        try:
+            value.encode('utf-8')
+        except UnicodeEncodeError:
+            raw = value.encode('ascii', 'surrogateescape')
+            try:
+                return raw.decode('utf-8')
+            except UnicodeDecodeError:
+                return raw.decode('ISO-8859-1')
+        return super().header_fetch_parse(name, value)
+
+
+# policy of the parsed messages, email.policy.compat32 gives the raw 8-bit headers as Header objects
+MESSAGE_POLICY = RawHeaderPolicy()
+
+
+def parse_message(raw, policy=MESSAGE_POLICY):
+    """Parse a raw message (bytes or memoryview) slice by slice, without a decoded copy of the whole message.
+    8-bit bodies keep their bytes, get_payload(decode=True) returns them unchanged"""
+    parser = email.parser.BytesFeedParser(policy=policy)
+    view = memoryview(raw)
+    for start in range(0, len(view), PARSE_CHUNK):
+        parser.feed(view[start:start + PARSE_CHUNK].tobytes())
+    return parser.close()
+
+
+def parse_message_file(path, policy=MESSAGE_POLICY):
+    """Parse a gzipped message chunk by chunk, like parse_message"""
+    parser = email.parser.BytesFeedParser(policy=policy)
+    with gzip.open(path, 'rb') as raw:
+        for chunk in iter(lambda: raw.read(PARSE_CHUNK), b''):
+            parser.feed(chunk)
+    return parser.close()
+
+
+def parse_message_skeleton(path, spool_dir=None, policy=MESSAGE_POLICY):
+    """Parse a gzipped message without holding the bodies of its attachments in memory: they are decoded into files of
+    spool_dir, moved as the attachments by Message.extractAttachments, or skipped without spool_dir (see mimespool.py)"""
+    with gzip.open(path, 'rb') as raw:
+        return spool_message(raw, spool_dir, policy)
+
+
+def parse_header(raw):
+    """Parse only the header of a raw message"""
+    ends = [end for end in (raw.find(b'\r\n\r\n'), raw.find(b'\n\n')) if end >= 0]
+    return parse_message(raw[:min(ends) + 2] if ends else raw)
+
+
+def save_message_file(local_folder, raw_file, pdf_queue, metadata=None, blob_dir=None, raw_only=False, segment_dir=None, catalog=None):
+    """Save a streamed message into its folder below local_folder, moving its file as raw.eml.gz. Returns False if it already exists"""
+    header = parse_message(raw_file.header)
+    digest = raw_file.digest
+    message_id = createReliableMessageId(header['Message-Id'], None, digest)
+    directory = os.path.join(local_folder, get_email_year(header), createReliableFoldername(header['Message-Id'], None, digest))
+
+    if segment_dir:
+        try:
+            if is_stored(segment_dir, directory):
+                return False
+            # only the metadata is needed
+            message = Message(directory, parse_message_skeleton(raw_file.path), message_id, metadata)
+            return save_message_segment(segment_dir, directory, message, raw_file.path, catalog)
+        finally:
+            raw_file.discard()
+
+    if is_archived(directory):
+        raw_file.discard()
+        return False
+
+    os.makedirs(directory, exist_ok=True)
+    raw_path = os.path.join(directory, 'raw.eml.gz')
+    os.replace(raw_file.path, raw_path)
+
+    msg = None
+    try:
+        if raw_only:
+            Message(directory, header, message_id, metadata).createPendingFile()
+            record_message(local_folder, directory)
+            return True
+
+        msg = parse_message_skeleton(raw_path, directory)
+        msg['Message-Id'] = message_id
+        message = Message(directory, msg, message_id, metadata, blob_dir)
+        catalog_message(catalog, directory, message.createMetaFile(), raw_file.size)
+        record_message(local_folder, directory)
+        message.extractAttachments()
+
+        if pdf_queue:
+            message.queuePdfFile(pdf_queue)
+
+    except Exception as e:
+        errorHandler(e, f'\rError: save_message_file() failed for {directory}', exitCode=None)
+    finally:
+        if msg is not None:
+            discard_spooled(msg)
+
+    return True
+
+
+def save_message(local_folder, raw, pdf_queue, metadata=None, blob_dir=None, raw_only=False, segment_dir=None, catalog=None):
+    """Save a raw message into its folder below local_folder, metadata is added to its metadata.json. Returns False if it already exists.
+    pdf_queue: folder of the PDF queue, to render message.pdf afterwards
+    blob_dir: folder of the attachment store, to store each attachment content only once
+    raw_only: only save raw.eml.gz and the metadata for --rebuild (pending.json)
+    segment_dir: folder of the segment store, to append the message to a segment instead of creating its folder
+    catalog: the catalog_target of the folder, to add the message to the catalog"""
+    if isinstance(raw, RawMessageFile):
+        return save_message_file(local_folder, raw, pdf_queue, metadata, blob_dir, raw_only, segment_dir, catalog)
+
+    msg = parse_header(raw) if raw_only and not segment_dir else parse_message(raw)
+    msg['Message-Id'] = message_id = createReliableMessageId(msg['Message-Id'], raw)
+    directory = get_email_folder(local_folder, msg, raw)
+
+    if segment_dir:
+        return save_message_segment(segment_dir, directory, Message(directory, msg, message_id, metadata), raw, catalog)
+
+    # checked before the folder is created, so a skipped message leaves no empty folder
+    if is_archived(directory): return False
+    # we might retrying it, so the folder may exist
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        message = Message(directory, msg, message_id, metadata, blob_dir)
+        message.createRawFile(raw)
+        if raw_only:
+            message.createPendingFile()
+            record_message(local_folder, directory)
+            return True
+        catalog_message(catalog, directory, message.createMetaFile(), len(raw))
+        record_message(local_folder, directory)
+        message.extractAttachments()
+
+        if pdf_queue:
+            message.queuePdfFile(pdf_queue)
+
+    except Exception as e:
+        # ex: Unsupported charset on decode
+        errorHandler(e, f'\rError: save_message() failed for {directory}', exitCode=None)
+
+    return True
+
+
+def chunks(items, size):
+    """Split a list or an iterator into lists of up to size items"""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def search_windows(first, last, window=SEARCH_WINDOW):
+    """Split the UIDs from first to last into ranges for a SEARCH each, '*' as end if last is unknown.
+    Sparse UIDs get bigger windows, so there are never more than MAX_SEARCHES"""
+    if last is None:
+        yield (first, '*')
+        return
+
+    window = max(window, -(-(last - first + 1) // MAX_SEARCHES))
+    for start in range(first, last + 1, window):
+        yield (start, min(start + window - 1, last))
+
+
+def parse_esearch(data):
+    """Parse the data of an ESEARCH response into a dict of MIN, MAX, COUNT (as int) and ALL (as UID set)"""
+    result = {}
+    for name, value in re.findall(rb'\b(MIN|MAX|COUNT|ALL) (\S+)', data):
+        name = name.decode('ascii')
+        result[name] = value if name == 'ALL' else int(value)
+    return result
+
+
+def expand_uid_set(uids):
+    """Yield the UIDs of a compact UID set like b'1:5,8' in ascending order, without creating a list of them"""
+    ranges = []
+    for part in uids.split(b','):
+        if part:
+            first, _, last = part.partition(b':')
+            first = int(first)
+            last = int(last) if last else first
+            ranges.append((min(first, last), max(first, last)))
+    for first, last in sorted(ranges):
+        yield from range(first, last + 1)
+
+
+def uid_set(uids):
+    """Create a compact IMAP message set like '1:5,8,10:12' from a list of UIDs"""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
         else:
-            print('\r- Done. {} emails created, {} emails already exist'.format(stats[0], stats[1]))
+            ranges.append([uid, uid])
+    return ','.join(str(first) if first == last else f'{first}:{last}' for first, last in ranges)
+
+
+def parse_fetch_response(data):
+    """Split the data of a FETCH response into (attributes, literal) per message, literal is None if there is none"""
+    messages = []
+    for part in data:
+        if isinstance(part, tuple):
+            messages.append([part[0], part[1]])
+        elif isinstance(part, bytes):
+            if messages and not re.match(rb'\d+ \(', part):
+                # rest of the previous message, following its literal
+                messages[-1][0] += part
+            else:
+                messages.append([part, None])
+    return [(attributes, literal) for attributes, literal in messages]
+
+
+def fetch_attribute(attributes, name):
+    """Get a numeric attribute (like UID or RFC822.SIZE) from the attributes of a FETCH response"""
+    match = re.search(rb'[( ]' + re.escape(name) + rb' (\d+)', attributes)
+    if match:
+        return int(match.group(1))
+    return None
 
 
 def get_folder_fist(account):
-    if not account['ssl']:
-        mailbox = imaplib.IMAP4(account['host'], account['port'])
-    else:
-        mailbox = imaplib.IMAP4_SSL(account['host'], account['port'])
-    mailbox.login(account['username'], account['password'])
-    folder_list = mailbox.list()[1]
-    mailbox.logout()
+    with connection_limiter.slot(account['host']):
+        if not account['ssl']:
+            mailbox = imaplib.IMAP4(account['host'], account['port'])
+        else:
+            mailbox = imaplib.IMAP4_SSL(account['host'], account['port'])
+        mailbox.login(account['username'], account['password'])
+        folder_list = mailbox.list()[1]
+        mailbox.logout()
     return folder_list
 
 
-def get_folders(account):
+def get_folders(account, session=None):
+    if session is not None:
+        return filter_folders(account, session.list_folders(), session.gmail)
+    return filter_folders(account, get_folder_fist(account))
+
+
+def folder_flags(folder_entry):
+    """Get the flags of a LIST response entry, like ['\\HasNoChildren', '\\All']"""
+    match = folder_flags_re.match(folder_entry)
+    if not match:
+        return []
+    return match.group(1).decode('ascii', 'replace').split()
+
+
+def filter_folders(account, folder_list, gmail=False):
     folders = []
+    gmail_folders = []
     exclude_folder = []
 
     if account['exclude_folder']: 
         exclude_folder = [imaputf7encode(folder.strip()) for folder in account['exclude_folder'].split(',')]
     
-    for folder_entry in get_folder_fist(account):    
+    for folder_entry in folder_list:    
         folder_name = folder_entry.decode().replace('/', '.').split(' "." ')[1]
         if folder_name.replace('"', '') not in exclude_folder:
             folders.append(folder_name)
+            flags = folder_flags(folder_entry)
+            if any(flag in GMAIL_FOLDER_FLAGS for flag in flags):
+                gmail_folders.append((folder_name, flags))
     
+    # Gmail: labels are folders, so an email with several labels would be downloaded for each. "All Mail" has all of them once
+    if gmail and any('\\All' in flags for folder_name, flags in gmail_folders):
+        return [folder_name for folder_name, flags in gmail_folders]
+
     # Remove Gmail parent folder from array otherwise the script fails:
     if '"[Gmail]"' in folders: folders.remove('"[Gmail]"')
     # Remove Gmail "All Mail" folder which just duplicates emails:
@@ -6,26 +6,24 @@ import email
 from email.header import decode_header
 import re
 import os
-import signal
 import posixpath
 import json
 import io
 import mimetypes
-import chardet
 import gzip
 import html
 import time
-from importlib.util import find_spec
 
 from html.parser import HTMLParser
 
 from utilities import errorHandler
+from charset import CharsetDetector
+from blobstore import BlobStore
+from mimespool import spooled_path
+from pdfqueue import queue_pdf
 
-# import pdfkit if its loader is available
-has_pdfkit = find_spec('pdfkit') is not None
-if has_pdfkit: import pdfkit
-
-TIMEOUT_SECONDS = 120
+# marks a message saved by the raw_only mode, with the metadata of its download, until --rebuild creates its files
+PENDING_FILE = 'pending.json'
 
 # email address REGEX matching the RFC 2822 spec
 # from perlfaq9
@@ -54,31 +52,85 @@ email_address_re=re.compile('^'+addr_spec+'$')
 
 
 
-class MLStripper(HTMLParser):
-    def __init__(self):
-        self.reset()
-        self.fed = []
-    def convert_charrefs(x):
-        return x
-    def handle_data(self, d):
-        self.fed.append(d)
-    def get_data(self):
-        return ''.join(self.fed)
+cid_src_re = re.compile(r'src=["\']cid:(.*?)["\']', re.S | re.I)
+tag_re = re.compile(r'<[^>]*>')
+
+
+class HtmlProcessor(HTMLParser):
+    """Tokenizes an HTML document once, for the content of its <body> with the cid: images replaced by their paths,
+    and the plain text of it. Without a <body>, the whole document is used"""
+
+    def __init__(self, content, images):
+        super().__init__(convert_charrefs=True)
+        self.content = content
+        # lowercase content id => path of the embedded images, the cid: urls are matched case-insensitively
+        self.images = {content_id.lower(): path for content_id, path in images.items()}
+        # (start, end, text) of the tags to replace, as offsets in content
+        self.replacements = []
+        self.texts = []
+        self.body = None
+        self.body_end = None
+        # offsets of the lines, for the (line, column) positions of the parser
+        self.lines = [0] + [m.end() for m in re.finditer('\n', content)]
+
+    def position(self):
+        line, column = self.getpos()
+        return self.lines[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body' and self.body is None:
+            self.body = (self.position() + len(self.get_starttag_text()), len(self.texts))
+        elif self.images and any(name == 'src' and value and value[:4].lower() == 'cid:' for name, value in attrs):
+            start = self.position()
+            text = self.get_starttag_text()
+            replaced = cid_src_re.sub(lambda m: 'src="%s"' % self.images[m.group(1).lower()] if m.group(1).lower() in self.images else m.group(0), text)
+            if replaced != text:
+                self.replacements.append((start, start + len(text), replaced))
+
+    handle_startendtag = handle_starttag
+
+    def handle_endtag(self, tag):
+        if tag == 'body' and self.body is not None:
+            self.body_end = (self.position(), len(self.texts))
+
+    def handle_data(self, data):
+        self.texts.append(data)
 
-def strip_tags(html):
-    s = MLStripper()
-    s.feed(html)
-    return s.get_data()
+    def process(self):
+        """Returns the (rewritten) html of the body and its text"""
+        self.feed(self.content)
+        self.close()
+
+        start, text_start = 0, 0
+        end, text_end = len(self.content), len(self.texts)
+        if self.body is not None and self.body_end is not None and self.body_end[0] > self.body[0]:
+            start, text_start = self.body
+            end, text_end = self.body_end
+
+        html = []
+        position = start
+        for tag_start, tag_end, replaced in self.replacements:
+            if tag_start < start or tag_end > end:
+                continue
+            html.append(self.content[position:tag_start])
+            html.append(replaced)
+            position = tag_end
+        html.append(self.content[position:end])
+        return (''.join(html), ''.join(self.texts[text_start:text_end]))
 
 
 
 class Message:
     """Operation on a message"""
 
-    def __init__(self, directory, msg, message_id):
+    def __init__(self, directory, msg, message_id, metadata=None, blob_dir=None):
         self.msg = msg
         self.directory = directory
         self.message_id = message_id
+        # additional entries for the metadata.json (ex: Gmail labels)
+        self.metadata = metadata or {}
+        # attachments are linked to the blobs of this folder, if set
+        self.blob_store = BlobStore(blob_dir) if blob_dir else None
 
     def getmailheader(self, header_text, default="ascii"):
         """Decode header_text if needed"""
@@ -146,7 +198,7 @@ class Message:
 
         return (rfc2822, iso8601)
 
-    def createMetaFile(self):
+    def getMetadata(self):
         tos = self.getmailaddresses('to')
         ccs = self.getmailaddresses('cc')
 
@@ -161,28 +213,44 @@ class Message:
             text_content = self.getTextContent(parts['text'])
         else:
             if parts['html']:
-                text_content = strip_tags(self.getHtmlContent(parts['html']))
+                self.getHtmlContent(parts['html'], parts['embed_images'])
+                text_content = self.html_text
 
         rfc2822, iso8601 = self.normalizeDate(self.msg['Date'])
 
+        metadata = {
+            'Id': self.message_id,
+            'Subject' : self.getSubject(),
+            'From' : self.getFrom(),
+            'To' : tos,
+            'Cc' : ccs,
+            'Date' : rfc2822,
+            'Utc' : iso8601,
+            'Attachments': attachments,
+            'WithHtml': len(parts['html']) > 0,
+            'WithText': len(parts['text']) > 0,
+            'Body': text_content
+        }
+        metadata.update(self.metadata)
+        return metadata
+
+
+    def createMetaFile(self):
         with io.open(os.path.join(self.directory, 'metadata.json'), 'w', encoding='utf8') as json_file:
-            data = json.dumps({
-                'Id': self.message_id,
-                'Subject' : self.getSubject(),
-                'From' : self.getFrom(),
-                'To' : tos,
-                'Cc' : ccs,
-                'Date' : rfc2822,
-                'Utc' : iso8601,
-                'Attachments': attachments,
-                'WithHtml': len(parts['html']) > 0,
-                'WithText': len(parts['text']) > 0,
-                'Body': text_content
-            }, indent=4, ensure_ascii=False)
+            metadata = self.getMetadata()
+            data = json.dumps(metadata, indent=4, ensure_ascii=False)
 
             json_file.write(data)
 
             json_file.close()
+        return metadata
+
+
+    def createPendingFile(self):
+        pending = {'Id': self.message_id}
+        pending.update(self.metadata)
+        with io.open(os.path.join(self.directory, PENDING_FILE), 'w', encoding='utf8') as json_file:
+            json_file.write(json.dumps(pending, indent=4, ensure_ascii=False))
 
 
     def createRawFile(self, data):
@@ -191,14 +259,14 @@ class Message:
         f.close()
 
 
-    def getPartCharset(self, part):
+    def getPartCharset(self, part, payload):
+        """The declared charset of a part, or the one detected from its decoded payload bytes"""
         if part.get_content_charset() is None:
-            try:
-                return chardet.detect(part.as_bytes())['encoding']
-            except UnicodeEncodeError:
-                string = part.as_string()
-                array = bytearray(string, 'utf-8')
-                return chardet.detect(array)['encoding']
+            if not hasattr(self, 'charset_detector'):
+                # mails of a mailing list or a sender mostly use the same charset
+                key = self.msg.get('List-Id') or self.getFrom()[1]
+                self.charset_detector = CharsetDetector(str(key).strip().lower() if key else None)
+            return self.charset_detector.detect(payload)
         return part.get_content_charset()
 
 
@@ -207,7 +275,7 @@ class Message:
             self.text_content = ''
             for part in parts:
                 raw_content = part.get_payload(decode=True)
-                charset = self.getPartCharset(part)
+                charset = self.getPartCharset(part, raw_content)
                 self.text_content += raw_content.decode(charset, 'replace')
         return self.text_content
 
@@ -217,31 +285,34 @@ class Message:
         with open(os.path.join(self.directory, 'message.txt'), 'wb') as fp:
             fp.write(bytearray(utf8_content, 'utf-8'))
 
-    def getHtmlContent(self, parts):
+    def getHtmlContent(self, parts, embed=()):
+        """The html of the <body> of the parts, with the cid: images of embed replaced by their attachment path.
+        Its plain text is kept as html_text"""
         if not hasattr(self, 'html_content'):
-            self.html_content = ''
+            content = ''
 
             for part in parts:
                 raw_content = part.get_payload(decode=True)
-                charset = self.getPartCharset(part)
-                self.html_content += raw_content.decode(charset, 'replace')
+                charset = self.getPartCharset(part, raw_content)
+                content += raw_content.decode(charset, 'replace')
 
-            m = re.search(r'<body[^>]*>(.+)<\/body>', self.html_content, re.S | re.I)
-            if m != None:
-                self.html_content = m.group(1)
+            images = {content_id: posixpath.join('attachments', filename) for content_id, filename in embed}
+            try:
+                self.html_content, self.html_text = HtmlProcessor(content, images).process()
+            except Exception as e:
+                # html the parser cannot handle (ex: marked sections) is kept as it is
+                errorHandler(e, f'Could not parse the html of "{self.directory}"', exitCode=None)
+                self.html_content = content
+                self.html_text = html.unescape(tag_re.sub('', content))
 
         return self.html_content
 
 
     def createHtmlFile(self, parts, embed, isText=False):
-        utf8_content = self.getHtmlContent(parts)
         if isText:
-            utf8_content = '<pre>' + utf8_content + '</pre>'
-        for img in embed:
-            pattern = r'src=["\']cid:%s["\']' % (re.escape(img[0]))
-            path = posixpath.join('attachments', img[1])
-            utf8_content = re.sub(pattern, 'src="%s"' % (path), utf8_content, 0, re.S | re.I)
-
+            utf8_content = '<pre>' + html.escape(self.getTextContent(parts)) + '</pre>'
+        else:
+            utf8_content = self.getHtmlContent(parts, embed)
 
         subject = self.getSubject()
         fromname = self.getFrom()[0]
@@ -329,57 +400,41 @@ class Message:
             if not os.path.exists(attdir):
                 os.makedirs(attdir)
             for afile in message_parts['files']:
-                with open(os.path.join(attdir, afile[1]), 'wb') as fp:
-                    payload = afile[0].get_payload(decode=True)
+                path = os.path.join(attdir, afile[1])
+                spooled = spooled_path(afile[0])
+                if spooled:
+                    # already decoded into a file while the message was parsed
+                    if os.path.getsize(spooled) and self.blob_store is not None:
+                        self.blob_store.saveFile(spooled, path)
+                    else:
+                        os.replace(spooled, path)
+                    continue
+                payload = afile[0].get_payload(decode=True)
+                if payload and self.blob_store is not None:
+                    self.blob_store.save(payload, path)
+                    continue
+                with open(path, 'wb') as fp:
                     if payload:
                         fp.write(payload)
 
 
-    def createPdfFile(self, wkhtmltopdf):
-        if has_pdfkit:
-            html_path = os.path.join(self.directory, 'message.html')
-            pdf_path = os.path.join(self.directory, 'message.pdf')
-            config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
+    def queuePdfFile(self, pdf_queue):
+        # rendered from message.html by the PDF workers, see pdfqueue.py
+        if os.path.isfile(os.path.join(self.directory, 'message.html')):
+            queue_pdf(pdf_queue, self.directory)
 
-            # check if html file exists, to prevent wkhtmltopdf from throwing this known generic error
-            if not os.path.isfile(html_path):
-                return
-            
-            # allow local file access
-            #options = { "enable-local-file-access": None }
-
-            # allow local file access to images only
-            #'disable-local-file-access' : True, 
-            attdir = os.path.join(self.directory, 'attachments')
-            options = { 'allow': attdir }
 
-
-            def timeout_handler(signum, frame):
-                raise TimeoutError("PDF creation timed out.")
-
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(TIMEOUT_SECONDS)
-
-            try:
-                ret = pdfkit.from_file(html_path, pdf_path, configuration=config, options=options) # , verbose=True
-                #DEBUG: print(f'PDFKIT: {ret}')
-            except TimeoutError:
-                errorHandler(None, f'Timeout while creating PDF. wkhtmltopdf was terminated while creating {pdf_path}', exitCode=None)
-            except Exception as e:
-                errorHandler(e, f'Error while creating PDF. wkhtmltopdf was terminated while creating {pdf_path}', exitCode=None)
-            finally:
-                signal.alarm(0)
-        else:
-            errorHandler(None, f'Couldn\'t create PDF message, since "pdfkit" module (wrapper for wkhtmltopdf) isn\'t installed. While creating {self.directory}', exitCode=None)
+    def checkIfExists(self):
+        return is_archived(self.directory)
 
 
+def is_archived(directory):
+    # if metadata file exsits but is empty, we want to retry (there was an error during creation before)
+    metadataPath = os.path.join(directory, 'metadata.json')
+    if os.path.isfile(metadataPath):
+        # and if metadata is not empty
+        if os.stat(metadataPath).st_size != 0:
+            return True
 
-    def checkIfExists(self):
-        # if metadata file exsits but is empty, we want to retry (there was an error during creation before)
-        metadataPath = os.path.join(self.directory, 'metadata.json')
-        if os.path.isfile(metadataPath):
-            # and if metadata is not empty
-            if os.stat(metadataPath).st_size != 0:
-                return True
-
-        return False
+    # saved by the raw_only mode, the other files are created by --rebuild
+    return os.path.isfile(os.path.join(directory, PENDING_FILE))
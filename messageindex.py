@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import bisect
+import hashlib
+import heapq
+import itertools
+import os
+import sys
+import threading
+from array import array
+from message import is_archived
+
+# sorted 64 bit hashes of the archived emails of a local folder
+INDEX_FILENAME = '.imapbox-index.bin'
+# hashes of the emails saved since the index was written, appended by every process saving emails
+INDEX_LOG = '.imapbox-index.log'
+# size of a hash in both files
+HASH_SIZE = 8
+
+
+def message_hash(local_folder, directory):
+    """The 64 bit hash of an email, by the path of its folder below the local folder (ex: 2024/<id>)"""
+    prefix = os.path.join(local_folder, '')
+    # the folders of the emails are joined to the local folder, relpath is only needed for other paths
+    key = directory[len(prefix):] if directory.startswith(prefix) else os.path.relpath(directory, local_folder)
+    if os.sep != '/':
+        key = key.replace(os.sep, '/')
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=HASH_SIZE).digest(), 'little')
+
+
+def read_hashes(path):
+    """The hashes of an index file (little endian), without a torn last one. Empty if there is no file"""
+    hashes = array('Q')
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return hashes
+    hashes.frombytes(data[:len(data) - len(data) % HASH_SIZE])
+    if sys.byteorder == 'big':
+        hashes.byteswap()
+    return hashes
+
+
+class MessageIndex:
+    """Archived emails of a local folder, loaded once per run so the emails of the server are checked in memory.
+    Only emails missing in the index are checked on the disk (and added if they are archived). A hit is trusted, so
+    the index is reset by a full sync (ex: after removing emails from the backup)"""
+
+    def __init__(self, local_folder, reset=False):
+        self.local_folder = local_folder
+        self.path = os.path.join(local_folder, INDEX_FILENAME)
+        self.log_path = os.path.join(local_folder, INDEX_LOG)
+        self.lock = threading.Lock()
+        if reset:
+            remove_index(local_folder)
+        self.hashes = read_hashes(self.path)
+        # found on the disk or saved since the index was written
+        self.added = set(read_hashes(self.log_path))
+
+    def written(self, value):
+        """Tell if a hash is in the index file, by a binary search"""
+        position = bisect.bisect_left(self.hashes, value)
+        return position < len(self.hashes) and self.hashes[position] == value
+
+    def isArchived(self, directory):
+        """Tell if the email of a folder is archived, from the index or else from the disk"""
+        value = message_hash(self.local_folder, directory)
+        with self.lock:
+            if value in self.added or self.written(value):
+                return True
+        if not is_archived(directory):
+            return False
+        with self.lock:
+            self.added.add(value)
+        return True
+
+    def save(self):
+        """Write the index with the emails saved since it was loaded (by all processes), if there are any"""
+        with self.lock:
+            try:
+                log_size = os.path.getsize(self.log_path)
+            except FileNotFoundError:
+                log_size = 0
+            added = {value for value in self.added.union(read_hashes(self.log_path)) if not self.written(value)}
+            if not added and not log_size:
+                return
+
+            # merged in order, both are sorted
+            hashes = array('Q', (value for value, _ in itertools.groupby(heapq.merge(self.hashes, sorted(added)))))
+            data = hashes
+            if sys.byteorder == 'big':
+                data = array('Q', hashes)
+                data.byteswap()
+            os.makedirs(self.local_folder, exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as fp:
+                data.tofile(fp)
+            os.replace(tmp_path, self.path)
+            self.hashes = hashes
+            self.added = set()
+
+            # emails saved by another process in the meantime stay in the log, they are merged the next time
+            if log_size and os.path.getsize(self.log_path) == log_size:
+                os.truncate(self.log_path, 0)
+
+
+def record_message(local_folder, directory):
+    """Add a saved email to the index of its local folder, by the log merged at the end of the run"""
+    value = array('Q', [message_hash(local_folder, directory)])
+    if sys.byteorder == 'big':
+        value.byteswap()
+    # a single small write in append mode, so the processes saving emails do not mix their hashes
+    with open(os.path.join(local_folder, INDEX_LOG), 'ab') as fp:
+        fp.write(value.tobytes())
+
+
+def remove_index(local_folder):
+    """Remove the index of a local folder, ex: when its emails are moved elsewhere"""
+    for name in (INDEX_FILENAME, INDEX_LOG):
+        path = os.path.join(local_folder, name)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import binascii
+import email.parser
+import io
+import os
+import re
+
+# header of the parts whose body was decoded into a spool file, with the number of the file
+SPOOL_HEADER = 'X-Imapbox-Spooled'
+# longest piece of a line read at once, longer lines (ex: binary bodies) are read in pieces
+LINE_CHUNK = 64 * 1024
+
+# a header line, a continuation line or the mbox From line, like email.feedparser
+header_line_re = re.compile(rb'^(From |[\041-\071\073-\176]*:|[\t ])')
+boundary_end_re = re.compile(rb'^(?P<end>--)?[ \t]*(\r\n|\r|\n)?$')
+base64_alphabet = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+base64_junk = bytes(c for c in range(256) if c not in base64_alphabet)
+
+
+def is_attachment(part):
+    """Tell if Message.getParts saves the body of a part as an attachment file"""
+    if part.get_content_maintype() in ('multipart', 'message'):
+        return False
+    return bool(part.get_filename()) or part.get_content_type() not in ('text/plain', 'text/html')
+
+
+def strip_line_end(line):
+    if line.endswith(b'\r\n'):
+        return line[:-2]
+    return line[:-1] if line.endswith((b'\n', b'\r')) else line
+
+
+class SpooledBody:
+    """The body of a part decoded into a file while it is read, by its Content-Transfer-Encoding, like
+    get_payload(decode=True). Without a path, the body is only skipped"""
+
+    def __init__(self, path, encoding):
+        self.path = path
+        self.file = open(path, 'wb') if path else None
+        self.encoding = encoding
+        # undecoded rest: base64 characters short of a group of 4, or the start of a quoted-printable line
+        self.pending = b''
+
+    def write(self, data):
+        if self.file is None:
+            return
+        if self.encoding == 'base64':
+            data = self.pending + data.translate(None, base64_junk)
+            end = len(data) - len(data) % 4
+            self.pending = data[end:]
+            self.writeBase64(data[:end])
+        elif self.encoding == 'quoted-printable':
+            # decoded by whole lines, so soft line breaks and escapes are never split
+            self.pending += data
+            if data.endswith(b'\n'):
+                self.file.write(binascii.a2b_qp(self.pending))
+                self.pending = b''
+        else:
+            self.file.write(data)
+
+    def writeBase64(self, data):
+        try:
+            self.file.write(binascii.a2b_base64(data))
+        except binascii.Error:
+            # a broken body, the rest of it is skipped like a wrong padding
+            pass
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.pending:
+            if self.encoding == 'base64':
+                self.writeBase64(self.pending + b'==')
+            else:
+                self.file.write(binascii.a2b_qp(self.pending))
+            self.pending = b''
+        self.file.close()
+
+
+class MimeSpooler:
+    """Splits a message read line by line into a skeleton, the message without the bodies of its attachments, and
+    these bodies decoded into files of spool_dir (or skipped without it). The skeleton is parsed as usual, its parts with
+    a spooled body have the path of its file as spooled_path. So only the headers and the text and HTML bodies are held
+    in memory, whatever the size of the attachments"""
+
+    def __init__(self, spool_dir, policy):
+        self.spool_dir = spool_dir
+        self.policy = policy
+        self.skeleton = io.BytesIO()
+        self.paths = []
+        # '--' + boundary of the open multiparts, the innermost last
+        self.separators = []
+        # lines of the header being read, None within a body
+        self.header = []
+        # SpooledBody of the body being read, None if the body goes into the skeleton
+        self.body = None
+        # last line of a spooled body, its line end belongs to the boundary after it
+        self.held = None
+        self.line_start = True
+
+    def feed(self, line):
+        """Add the next line, or piece of a line"""
+        at_start = self.line_start
+        self.line_start = line.endswith((b'\n', b'\r'))
+
+        if at_start and self.separators and self.isBoundary(line):
+            return
+        if self.header is not None:
+            if not at_start or header_line_re.match(line):
+                self.header.append(line)
+                return
+            if line in (b'\r\n', b'\n', b'\r'):
+                self.header.append(line)
+                self.startBody()
+                return
+            # not a header line, the body starts without the blank line (a defect the parser handles the same way)
+            self.startBody()
+
+        if self.body is None:
+            self.skeleton.write(line)
+            return
+        if self.held is not None:
+            self.body.write(self.held)
+            self.held = None
+        if self.line_start:
+            self.held = line
+        else:
+            self.body.write(line)
+
+    def isBoundary(self, line):
+        """Handle a boundary line of an open multipart, returns False for another line"""
+        for idx in range(len(self.separators) - 1, -1, -1):
+            separator = self.separators[idx]
+            if not line.startswith(separator):
+                continue
+            match = boundary_end_re.match(line[len(separator):])
+            if not match:
+                continue
+
+            if self.header is not None:
+                # a part without a body
+                self.startBody()
+            self.endBody()
+            # the boundary of an outer multipart also ends the inner ones
+            del self.separators[idx + 1:]
+            if match.group('end'):
+                # the epilogue of the multipart follows
+                del self.separators[idx]
+                self.header = None
+            else:
+                self.header = []
+            self.skeleton.write(line)
+            return True
+        return False
+
+    def startBody(self):
+        lines = self.header
+        self.header = None
+        header = b''.join(lines)
+        part = email.parser.BytesHeaderParser(policy=self.policy).parsebytes(header)
+
+        if part.get_content_maintype() == 'multipart' and part.get_boundary():
+            self.separators.append(b'--' + part.get_boundary().encode('utf-8', 'surrogateescape'))
+        elif part.get_content_type() == 'message/rfc822':
+            # the body is a message, with a header of its own
+            self.skeleton.write(header)
+            self.header = []
+            return
+        elif is_attachment(part):
+            path = None
+            if self.spool_dir:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                path = os.path.join(self.spool_dir, '.imapbox-spool-{}.tmp'.format(len(self.paths)))
+            self.paths.append(path)
+            self.body = SpooledBody(path, str(part.get('Content-Transfer-Encoding', '')).strip().lower())
+            # the marker goes in front of the blank line
+            blank = lines.pop() if lines and lines[-1] in (b'\r\n', b'\n', b'\r') else b'\n'
+            if lines and not lines[-1].endswith((b'\n', b'\r')):
+                lines.append(blank)
+            lines.append('{}: {}'.format(SPOOL_HEADER, len(self.paths) - 1).encode('ascii') + blank)
+            header = b''.join(lines) + blank
+        self.skeleton.write(header)
+
+    def endBody(self, keep_line_end=False):
+        if self.body is None:
+            return
+        if self.held is not None:
+            self.body.write(self.held if keep_line_end else strip_line_end(self.held))
+            self.held = None
+        self.body.close()
+        self.body = None
+
+    def close(self):
+        """Parse the skeleton, returns the message"""
+        if self.header is not None:
+            self.startBody()
+        # a body ended by the end of the message keeps its last line end, like the parser does
+        self.endBody(keep_line_end=True)
+
+        msg = email.parser.BytesParser(policy=self.policy).parsebytes(self.skeleton.getvalue())
+        for part in msg.walk():
+            number = part.get(SPOOL_HEADER)
+            if number is not None:
+                del part[SPOOL_HEADER]
+                part.spooled_path = self.paths[int(number)]
+        return msg
+
+
+def spool_message(fp, spool_dir, policy):
+    """Parse a message from a binary file, with the bodies of its attachments decoded into files of spool_dir, or skipped
+    if spool_dir is None. See MimeSpooler"""
+    spooler = MimeSpooler(spool_dir, policy)
+    for line in iter(lambda: fp.readline(LINE_CHUNK), b''):
+        spooler.feed(line)
+    return spooler.close()
+
+
+def spooled_path(part):
+    """The file of the spooled body of a part, None if its body is in the part"""
+    return getattr(part, 'spooled_path', None)
+
+
+def discard_spooled(msg):
+    """Remove the spool files of a message which were not moved as attachments"""
+    for part in msg.walk():
+        path = spooled_path(part)
+        if path and os.path.exists(path):
+            os.remove(path)
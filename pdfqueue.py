@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import hashlib
+import os
+import signal
+import subprocess
+import sys
+import threading
+import uuid
+from importlib.util import find_spec
+from utilities import errorHandler
+
+# import pdfkit if its loader is available
+has_pdfkit = find_spec('pdfkit') is not None
+if has_pdfkit: import pdfkit
+
+# folder of the queued PDFs, within the local folder
+PDF_QUEUE_FOLDER = '.imapbox-pdf-queue'
+# seconds a wkhtmltopdf process may run, before it is killed
+PDF_TIMEOUT = 120
+# seconds between the checks of an empty queue, jobs are also queued by the worker processes saving the emails
+QUEUE_POLL = 1.0
+
+# a job is a file holding the path of a message folder, its extension tells its state
+JOB = '.job'
+RUNNING = '.running'
+FAILED = '.failed'
+
+
+def queue_pdf(queue_dir, directory):
+    """Queue the rendering of message.pdf of a message folder, queuing the same folder again keeps a single job"""
+    directory = os.path.abspath(directory)
+    name = hashlib.sha1(directory.encode('utf-8', 'surrogateescape')).hexdigest()
+    os.makedirs(queue_dir, exist_ok=True)
+    tmp_path = os.path.join(queue_dir, f'.{uuid.uuid4().hex}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8', errors='surrogateescape') as fp:
+        fp.write(directory)
+    os.replace(tmp_path, os.path.join(queue_dir, name + JOB))
+
+
+def rename_jobs(queue_dir, old, new):
+    """Change the state of all jobs in old state, returns their number"""
+    count = 0
+    for file in os.listdir(queue_dir):
+        if file.endswith(old):
+            try:
+                os.replace(os.path.join(queue_dir, file), os.path.join(queue_dir, file[:-len(old)] + new))
+                count += 1
+            except FileNotFoundError:
+                pass
+    return count
+
+
+def kill_process(process):
+    """Kill a wkhtmltopdf process, with the processes it started"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+class PdfRenderer:
+    """Renders the queued PDFs with up to `workers` wkhtmltopdf processes at once, each one killed after its timeout.
+    The queue is a folder of job files (see queue_pdf), so it survives a stop and is drained by the next run:
+    NAME.job waits, NAME.running is rendered, NAME.failed is only retried by --render-pdfs"""
+
+    def __init__(self):
+        self.queue_dir = None
+        self.config = None
+        self.timeout = PDF_TIMEOUT
+        self.threads = []
+        self.stopping = threading.Event()
+        self.changed = threading.Condition()
+        self.pending = []
+        self.active = 0
+        self.processes = set()
+        self.rendered = 0
+        self.failed = 0
+
+    def start(self, queue_dir, wkhtmltopdf, workers, timeout=PDF_TIMEOUT):
+        """Start the worker threads, each one running a wkhtmltopdf process at a time"""
+        if self.threads:
+            return
+        if not has_pdfkit:
+            errorHandler(None, f'Couldn\'t create PDF messages, since "pdfkit" module (wrapper for wkhtmltopdf) isn\'t installed. They stay queued in {queue_dir}', exitCode=None)
+            return
+        try:
+            self.config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf or '')
+        except Exception as e:
+            errorHandler(e, f'Couldn\'t create PDF messages, they stay queued in {queue_dir}', exitCode=None)
+            return
+
+        self.queue_dir = queue_dir
+        self.timeout = timeout
+        self.rendered = 0
+        self.failed = 0
+        self.stopping.clear()
+        os.makedirs(queue_dir, exist_ok=True)
+        # jobs of an interrupted run
+        rename_jobs(queue_dir, RUNNING, JOB)
+
+        for _ in range(max(workers, 1)):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop the worker threads, killing the running wkhtmltopdf processes. Their jobs stay queued"""
+        if not self.threads:
+            return
+        self.stopping.set()
+        with self.changed:
+            for process in list(self.processes):
+                kill_process(process)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.pending = []
+
+    def wait(self):
+        """Wait until the queue is drained"""
+        with self.changed:
+            while self.threads and (self.active or self.hasJobs()):
+                self.changed.wait(QUEUE_POLL)
+
+    def hasJobs(self):
+        return self.pending or any(file.endswith(JOB) for file in os.listdir(self.queue_dir))
+
+    def claim(self):
+        """Take the next waiting job, returns the path of its running file or None"""
+        with self.changed:
+            if not self.pending:
+                self.pending = [file for file in os.listdir(self.queue_dir) if file.endswith(JOB)]
+            while self.pending:
+                job_path = os.path.join(self.queue_dir, self.pending.pop())
+                running_path = job_path[:-len(JOB)] + RUNNING
+                try:
+                    os.replace(job_path, running_path)
+                except FileNotFoundError:
+                    # taken by another renderer
+                    continue
+                self.active += 1
+                return running_path
+        return None
+
+    def work(self):
+        while not self.stopping.is_set():
+            running_path = self.claim()
+            if running_path is None:
+                self.stopping.wait(QUEUE_POLL)
+                continue
+            try:
+                self.renderJob(running_path)
+            finally:
+                with self.changed:
+                    self.active -= 1
+                    self.changed.notify_all()
+
+    def renderJob(self, running_path):
+        base_path = running_path[:-len(RUNNING)]
+        try:
+            with open(running_path, 'r', encoding='utf-8', errors='surrogateescape') as fp:
+                directory = fp.read()
+            success = self.render(directory)
+        except Exception as e:
+            errorHandler(e, f'Error while creating PDF for {running_path}', exitCode=None)
+            success = False
+
+        with self.changed:
+            if self.stopping.is_set() and not success:
+                # killed by stop(), rendered by the next run
+                os.replace(running_path, base_path + JOB)
+            elif success:
+                os.remove(running_path)
+                self.rendered += 1
+            else:
+                os.replace(running_path, base_path + FAILED)
+                self.failed += 1
+
+    def render(self, directory):
+        """Render message.pdf from message.html of a message folder. Returns False if it failed"""
+        html_path = os.path.join(directory, 'message.html')
+        pdf_path = os.path.join(directory, 'message.pdf')
+
+        # check if html file exists, to prevent wkhtmltopdf from throwing this known generic error
+        if not os.path.isfile(html_path):
+            return True
+
+        # allow local file access to images only
+        attdir = os.path.join(directory, 'attachments')
+        options = { 'allow': attdir }
+        command = pdfkit.PDFKit(html_path, 'file', options=options, configuration=self.config).command(pdf_path)
+
+        with self.changed:
+            if self.stopping.is_set():
+                return False
+            # its own process group, so a kill also ends the processes it started
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+            self.processes.add(process)
+        try:
+            stderr = process.communicate(timeout=self.timeout)[1]
+        except subprocess.TimeoutExpired:
+            kill_process(process)
+            process.communicate()
+            errorHandler(None, f'Timeout while creating PDF. wkhtmltopdf was killed after {self.timeout}s while creating {pdf_path}', exitCode=None)
+            return False
+        finally:
+            with self.changed:
+                self.processes.discard(process)
+
+        if process.returncode != 0:
+            if not self.stopping.is_set():
+                message = stderr.decode('utf-8', 'replace').strip().splitlines()
+                errorHandler(message[-1] if message else process.returncode, f'Error while creating PDF. wkhtmltopdf failed while creating {pdf_path}', exitCode=None)
+            return False
+        return True
+
+
+# shared by all accounts and folders, started from the options
+pdf_renderer = PdfRenderer()
+
+
+def do_render_pdfs(options):
+    """Render the queued PDFs of the local folder on all cores (or pdf_workers), retrying the failed ones"""
+    queue_dir = os.path.join(options['local_folder'], PDF_QUEUE_FOLDER)
+    if not os.path.isdir(queue_dir):
+        print('No queued PDFs found in ' + queue_dir)
+        sys.exit(0)
+
+    retried = rename_jobs(queue_dir, FAILED, JOB)
+    workers = options['pdf_workers'] or os.cpu_count() or 1
+    print('Rendering the queued PDFs of {} with {} workers ({} failed ones retried)'.format(queue_dir, workers, retried))
+
+    pdf_renderer.start(queue_dir, options['wkhtmltopdf'], workers, options['pdf_timeout'])
+    if not pdf_renderer.threads:
+        sys.exit(1)
+    pdf_renderer.wait()
+    pdf_renderer.stop()
+
+    print('{} PDFs created, {} failed (retried by the next --render-pdfs)'.format(pdf_renderer.rendered, pdf_renderer.failed))
+    sys.exit(1 if pdf_renderer.failed else 0)
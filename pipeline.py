@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import asyncio
+import multiprocessing
+import signal
+import threading
+
+# messages waiting for a worker process, per process, before fetching waits
+PENDING_PER_PROCESS = 4
+
+
+def ignore_sigint():
+    # Ctrl+C stops the main process, the workers end with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class DoneResult:
+    """The result of a function run right away, with the get() of multiprocessing's AsyncResult"""
+
+    def __init__(self, function, *args):
+        self.value = None
+        self.error = None
+        try:
+            self.value = function(*args)
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class MessagePipeline:
+    """Saves fetched messages (parsing, attachments, PDFs) in worker processes, so it runs on all cores while the IMAP
+    connections go on fetching. Without worker processes, messages are saved right away by the fetching thread"""
+
+    def __init__(self):
+        self.pool = None
+        self.slots = None
+
+    def start(self, processes):
+        """Start the worker processes. Done before other threads are started, since the workers are forked"""
+        if processes > 0 and self.pool is None:
+            self.pool = multiprocessing.Pool(processes, initializer=ignore_sigint)
+            self.slots = threading.BoundedSemaphore(processes * PENDING_PER_PROCESS)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, function, *args):
+        """Run function(*args) in a worker process, returns a result with get(). Waits while too many are pending"""
+        if self.pool is None:
+            return DoneResult(function, *args)
+
+        self.slots.acquire()
+        try:
+            return self.pool.apply_async(function, args, callback=self.release, error_callback=self.release)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, result):
+        self.slots.release()
+
+    async def run(self, function, *args):
+        """Run function(*args) in a worker process for an event loop, or in its default executor without workers"""
+        loop = asyncio.get_running_loop()
+        if self.pool is None:
+            return await loop.run_in_executor(None, function, *args)
+
+        future = loop.create_future()
+
+        def done(result):
+            if not future.done():
+                future.set_result(result)
+
+        def failed(error):
+            if not future.done():
+                future.set_exception(error)
+
+        self.pool.apply_async(function, args, callback=lambda result: loop.call_soon_threadsafe(done, result), error_callback=lambda error: loop.call_soon_threadsafe(failed, error))
+        return await future
+
+
+# shared by all accounts and folders, started from the options
+message_pipeline = MessagePipeline()
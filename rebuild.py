@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import functools
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+from message import Message, PENDING_FILE
+from mailboxresource import PARSE_CHUNK, parse_message_file, parse_message_skeleton
+from mimespool import discard_spooled
+from pdfqueue import pdf_renderer
+from pipeline import ignore_sigint
+from utilities import errorHandler, createReliableMessageId, showProgress
+from catalog import open_catalog, raw_size
+
+# entries of metadata.json created from the raw message, the other ones were added at the download (ex: Gmail labels)
+MESSAGE_KEYS = ('Id', 'Subject', 'From', 'To', 'Cc', 'Date', 'Utc', 'Attachments', 'WithHtml', 'WithText', 'Body')
+# files created from raw.eml.gz, besides metadata.json, removed before they are created again
+DERIVED_FILES = ('message.txt', 'message.html')
+# message folders handed to a worker process at once
+REBUILD_CHUNK = 16
+
+
+def find_messages(local_folder):
+    """The message folders below local_folder (with a raw.eml.gz)"""
+    for root, dirs, files in os.walk(local_folder):
+        if 'raw.eml.gz' in files:
+            # a message folder only holds its attachments
+            dirs[:] = []
+            yield root
+        else:
+            # the attachment store and the PDF queue
+            dirs[:] = [folder for folder in dirs if not folder.startswith('.imapbox-')]
+
+
+def is_stale(directory):
+    """Tell if the files of a message folder are missing or older than its raw.eml.gz"""
+    if os.path.isfile(os.path.join(directory, PENDING_FILE)):
+        return True
+    try:
+        stat = os.stat(os.path.join(directory, 'metadata.json'))
+    except FileNotFoundError:
+        return True
+    return stat.st_size == 0 or stat.st_mtime < os.stat(os.path.join(directory, 'raw.eml.gz')).st_mtime
+
+
+def read_metadata(directory):
+    """The id of a message and the metadata of its download, from its pending.json or metadata.json. (None, {}) without them"""
+    for name in (PENDING_FILE, 'metadata.json'):
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf8') as json_file:
+                data = json.load(json_file)
+        except (OSError, ValueError):
+            continue
+        return data.get('Id'), {key: value for key, value in data.items() if key not in MESSAGE_KEYS}
+    return None, {}
+
+
+def raw_digest(raw_path):
+    """The sha224 hex digest of a gzipped message, as used for the id of a message without a Message-Id"""
+    digest = hashlib.sha224()
+    with gzip.open(raw_path, 'rb') as raw:
+        for chunk in iter(lambda: raw.read(PARSE_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def rebuild_message(directory, pdf_queue=None, blob_dir=None, catalog_path=None, stream_bytes=0):
+    """Create the files of a message folder again from its raw.eml.gz. Returns False if it failed.
+    stream_bytes: messages bigger than this are parsed with the attachments decoded straight to disk, 0 to disable"""
+    raw_path = os.path.join(directory, 'raw.eml.gz')
+    msg = None
+    try:
+        message_id, metadata = read_metadata(directory)
+        if stream_bytes and raw_size(raw_path) > stream_bytes:
+            msg = parse_message_skeleton(raw_path, directory)
+        else:
+            msg = parse_message_file(raw_path)
+        if not message_id:
+            message_id = createReliableMessageId(msg['Message-Id'], None, raw_digest(raw_path))
+        msg['Message-Id'] = message_id
+
+        # files named after an older version of the message parsing
+        for name in DERIVED_FILES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(os.path.join(directory, 'attachments'), ignore_errors=True)
+
+        message = Message(directory, msg, message_id, metadata, blob_dir)
+        metadata = message.createMetaFile()
+        if catalog_path:
+            # the account and folder of the download are kept
+            open_catalog(catalog_path).add(directory, metadata, raw_size(raw_path))
+        message.extractAttachments()
+
+        if pdf_queue:
+            message.queuePdfFile(pdf_queue)
+
+        pending_path = os.path.join(directory, PENDING_FILE)
+        if os.path.exists(pending_path):
+            os.remove(pending_path)
+    except Exception as e:
+        errorHandler(e, f'\rError: rebuild_message() failed for {directory}', exitCode=None)
+        return False
+    finally:
+        if msg is not None:
+            discard_spooled(msg)
+    return True
+
+
+def do_rebuild(options):
+    """Create the files of the emails below the local folder from their raw.eml.gz, with a worker process per core (or processes).
+    Only missing and outdated ones (ex: saved with raw_only), or all of them with rebuild set to "all" (ex: after an update of imapbox)"""
+    local_folder = options['local_folder']
+    rebuild_all = options['rebuild'] == 'all'
+    directories = [directory for directory in find_messages(local_folder) if rebuild_all or is_stale(directory)]
+    if not directories:
+        print('No emails to rebuild in ' + local_folder)
+        sys.exit(0)
+
+    failed = rebuild_messages(directories, options)
+    sys.exit(1 if failed else 0)
+
+
+def rebuild_messages(directories, options):
+    """Create the files of message folders from their raw.eml.gz in a process pool, returns the number of failed ones"""
+    processes = options['processes'] or os.cpu_count() or 1
+    print('Rebuilding {} emails with {} processes'.format(len(directories), processes))
+
+    rebuild = functools.partial(rebuild_message, pdf_queue=options['pdf_queue'], blob_dir=options['blob_dir'], catalog_path=options['catalog_path'], stream_bytes=max(0, options['stream_mb']) * 1024 * 1024)
+    failed = 0
+    with multiprocessing.Pool(processes, initializer=ignore_sigint) as pool:
+        # started after the worker processes, since they are forked
+        if options['pdf_queue']:
+            pdf_renderer.start(options['pdf_queue'], options['wkhtmltopdf'], options['pdf_workers'] or os.cpu_count() or 1, options['pdf_timeout'])
+
+        for idx, success in enumerate(pool.imap_unordered(rebuild, directories, REBUILD_CHUNK), 1):
+            if not success:
+                failed += 1
+            if showProgress():
+                print('\r{0:.2f}%'.format(idx * 100 / len(directories)), end='')
+
+        # the workers end on their own, so they write the emails waiting for their catalog (the with block terminates them)
+        pool.close()
+        pool.join()
+
+    print('\r- Done. {} emails rebuilt, {} failed'.format(len(directories) - failed, failed))
+
+    if pdf_renderer.threads:
+        print('Waiting for the queued PDFs')
+        pdf_renderer.wait()
+        pdf_renderer.stop()
+    return failed
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+from utilities import get_log_prefix, set_log_prefix
+
+
+class HostLimiter:
+    """Limits the number of simultaneous connections per IMAP host"""
+
+    def __init__(self, limit=0):
+        # limit: 0 (or less) for no limit
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get_semaphore(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[host]
+
+    @contextmanager
+    def slot(self, host, cancel=None):
+        """Wait for a free connection slot for the host, and hold it while in the with block.
+
+        cancel: optional function, waiting stops if it returns True (the with block gets False then)
+        """
+        if self.limit <= 0:
+            yield True
+            return
+
+        semaphore = self.get_semaphore(str(host).lower())
+        while not semaphore.acquire(timeout=1):
+            if cancel is not None and cancel():
+                yield False
+                return
+        try:
+            yield True
+        finally:
+            semaphore.release()
+
+
+# shared by all accounts and folders, configured from the options
+connection_limiter = HostLimiter()
+
+
+def interleave_by_host(accounts):
+    """Order accounts round robin by host, so parallel workers do not all wait for the same host"""
+    by_host = {}
+    for account in accounts:
+        by_host.setdefault(str(account['host']).lower(), []).append(account)
+
+    ordered = []
+    groups = list(by_host.values())
+    while groups:
+        for group in groups:
+            ordered.append(group.pop(0))
+        groups = [group for group in groups if group]
+    return ordered
+
+
+def run_parallel(items, workers, handle, worker_context=None, first_resource=None):
+    """Call handle(item, resource) for all items, using up to workers threads taking the items from a queue.
+
+    worker_context: optional factory of a context manager, providing the resource of a worker thread (ex: an IMAP session).
+        It gets a function telling if the queue is empty, to stop waiting for the resource. The worker stops if the resource is None.
+    first_resource: optional resource for the first worker, instead of one from worker_context
+    """
+    item_queue = queue.Queue()
+    for item in items:
+        item_queue.put(item)
+
+    prefix = get_log_prefix()
+
+    def worker(index):
+        set_log_prefix(prefix)
+        if item_queue.empty():
+            return
+
+        if index == 0 and first_resource is not None:
+            context = nullcontext(first_resource)
+        elif worker_context is not None:
+            context = worker_context(item_queue.empty)
+        else:
+            context = nullcontext()
+
+        with context as resource:
+            if worker_context is not None and resource is None:
+                return
+            while True:
+                try:
+                    item = item_queue.get_nowait()
+                except queue.Empty:
+                    return
+                handle(item, resource)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
@@ -6,6 +6,7 @@ import json
 import os
 from fnmatch import fnmatch
 from utilities import errorHandler
+from segmentstore import SEGMENT_FOLDER, SegmentStore
 
 def do_search(options):
     # example:
@@ -36,21 +37,36 @@ def do_search(options):
                 json_path = os.path.join(root, file)
                 with open(json_path, 'r') as f:
                     json_content = json.load(f)
-                    if search_key in json_content:
-                        if isinstance(json_content[search_key], list):
-                            json_values = json_content[search_key]
-                        else:
-                            json_values = [json_content[search_key]]
-
-                        for json_value in json_values:
-                            if fnmatch(str(json_value), search_value):
-                                output_by(options['search_output'], 'item', {'json_path': json_path, 'json_content': json_content, 'count': count})
-                                count += 1
-                                break
+                    if matches(json_content, search_key, search_value):
+                        output_by(options['search_output'], 'item', {'json_path': json_path, 'json_content': json_content, 'count': count})
+                        count += 1
+
+    # the emails of the segment store, by the segment file holding their record
+    store = SegmentStore(os.path.join(options['local_folder'], SEGMENT_FOLDER))
+    for key, json_content, size in store.records():
+        if matches(json_content, search_key, search_value):
+            name, offset = store.locate(key)
+            json_path = os.path.join(store.directory, name + '.seg')
+            segment = {'key': key, 'offset': offset}
+            output_by(options['search_output'], 'item', {'json_path': json_path, 'json_content': json_content, 'segment': segment, 'count': count})
+            count += 1
     
     output_by(options['search_output'], 'end', {'count': count})
 
 
+def matches(json_content, search_key, search_value):
+    if search_key in json_content:
+        if isinstance(json_content[search_key], list):
+            json_values = json_content[search_key]
+        else:
+            json_values = [json_content[search_key]]
+
+        for json_value in json_values:
+            if fnmatch(str(json_value), search_value):
+                return True
+    return False
+
+
 def output_by(type, block, data):
     if type == 'json':
         if block == 'error':
@@ -74,6 +90,8 @@ def output_by(type, block, data):
                 "filename": data["json_path"],
                 "content": data["json_content"]
             }
+            if data.get("segment"):
+                json_item["segment"] = data["segment"]
             print(json.dumps(json_item, indent=4))
 
         elif block == 'end':
@@ -90,7 +108,10 @@ def output_by(type, block, data):
             print('Searching for {} = {}'.format(data["search_key"], data["search_value"]))
 
         elif block == 'item':
-            print('\n' + data["json_path"])
+            if data.get("segment"):
+                print('\n{} (record of {} at {})'.format(data["json_path"], data["segment"]["key"], data["segment"]["offset"]))
+            else:
+                print('\n' + data["json_path"])
             print(json.dumps(data["json_content"], indent=4))
 
         elif block == 'end':
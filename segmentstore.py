@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+import uuid
+try:
+    import fcntl
+except ImportError:
+    # ex: on Windows, each process starts a segment of its own
+    fcntl = None
+from utilities import errorHandler
+from catalog import catalog_message, raw_size
+from messageindex import remove_index
+
+# folder of the segments, within the local folder
+SEGMENT_FOLDER = '.imapbox-segments'
+# size of a segment file, before the next one is started
+SEGMENT_SIZE = 256 * 1024 * 1024
+# magic, length of the key, the metadata and the gzipped message of a record
+RECORD = struct.Struct('<4sHIQ')
+RECORD_MAGIC = b'IMB1'
+# digest of the key and offset of its record, per record of a segment in its .idx file
+INDEX_ENTRY = struct.Struct('<16sQ')
+# size of the chunks copied into a segment at once
+COPY_CHUNK = 1024 * 1024
+# messages migrated between the syncs to disk, the folders are only removed after them
+MIGRATE_BATCH = 100
+
+
+def key_digest(key):
+    return hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+
+
+class SegmentStore:
+    """Messages appended to big segment files, instead of a folder with several files per message.
+
+    A record holds the key of the message (the path of its folder in the folder layout, ex: INBOX/2024/<id>), its
+    metadata (the content of metadata.json) and its raw.eml.gz. The .idx file of a segment holds the offset of each
+    record, by the digest of its key. A process appends to a segment no other process writes to: the last one which is not
+    full and not locked by another process, else a new one. The other files of a message are created when it is exported (see do_export_segments)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.root = os.path.dirname(os.path.abspath(directory))
+        self.lock = threading.Lock()
+        # digest => (segment name, offset), loaded on first use
+        self.locations = None
+        # segment name => bytes of its .idx file in locations, the records appended by other processes are loaded later
+        self.loaded = {}
+        # the segment written by this process: name, segment file, index file, size
+        self.segment = None
+        # whether a missing key loads the indexes again, see refresh
+        self.stale = True
+        # modification time of the segment folder at the last load, changed by a new segment
+        self.directory_mtime = None
+
+    def keyOf(self, directory):
+        """The key of the message of a folder in the folder layout"""
+        return os.path.relpath(os.path.abspath(directory), self.root).replace(os.sep, '/')
+
+    def segmentNames(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(file[:-4] for file in os.listdir(self.directory) if file.endswith('.seg'))
+
+    def directoryMtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self):
+        """Load the index entries written since the last load, by this process or the others (ex: the workers saving emails)"""
+        if self.locations is None:
+            self.locations = {}
+        self.stale = False
+        self.directory_mtime = self.directoryMtime()
+        for name in self.segmentNames():
+            index_path = os.path.join(self.directory, name + '.idx')
+            try:
+                index_size = os.path.getsize(index_path)
+            except OSError:
+                continue
+            start = self.loaded.get(name, 0)
+            # without a torn last entry
+            end = index_size - index_size % INDEX_ENTRY.size
+            if end <= start:
+                continue
+            size = os.path.getsize(os.path.join(self.directory, name + '.seg'))
+            with open(index_path, 'rb') as fp:
+                fp.seek(start)
+                data = fp.read(end - start)
+            end = start + len(data) - len(data) % INDEX_ENTRY.size
+            for digest, offset in INDEX_ENTRY.iter_unpack(data[:end - start]):
+                if offset < size:
+                    self.locations[digest] = (name, offset)
+            self.loaded[name] = end
+
+    def locate(self, key):
+        """The (segment name, offset) of a key, None if it is not stored. Before telling it is missing, the indexes are
+        loaded again after a refresh or once another process started a segment"""
+        digest = key_digest(key)
+        with self.lock:
+            if self.locations is not None and digest in self.locations:
+                return self.locations[digest]
+            if self.locations is None or self.stale or self.directoryMtime() != self.directory_mtime:
+                self.load()
+            return self.locations.get(digest)
+
+    def refresh(self):
+        """Load the indexes again on the next missing key, for the records other processes appended to their segments
+        (ex: before checking which emails of a folder are stored, so long running processes like the server mode see them)"""
+        with self.lock:
+            self.stale = True
+
+    def contains(self, key):
+        return self.locate(key) is not None
+
+    def openSegment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is not None:
+            # the last segments are the ones which are not full
+            for name in reversed(self.segmentNames()):
+                self.segment = self.claimSegment(name)
+                if self.segment is not None:
+                    return
+        name = '{:013d}-{}-{}'.format(int(time.time() * 1000), os.getpid(), uuid.uuid4().hex[:8])
+        self.segment = self.claimSegment(name)
+
+    def claimSegment(self, name):
+        """Open a segment to append to, with a lock on its index file while this process writes to it. Returns
+        [name, segment file, index file, size], None if the segment is full, locked by another process or ends with a
+        torn record"""
+        segment_path = os.path.join(self.directory, name + '.seg')
+        index_path = os.path.join(self.directory, name + '.idx')
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= SEGMENT_SIZE:
+            return None
+        index_file = open(index_path, 'ab')
+        if fcntl is not None:
+            try:
+                fcntl.flock(index_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                index_file.close()
+                return None
+
+        segment_file = open(segment_path, 'ab')
+        end = self.indexedEnd(segment_path, index_path)
+        if end is None:
+            segment_file.close()
+            index_file.close()
+            return None
+        # without the record and index entry an interrupted run left incomplete
+        segment_file.truncate(end[0])
+        index_file.truncate(end[1])
+        return [name, segment_file, index_file, end[0]]
+
+    def indexedEnd(self, segment_path, index_path):
+        """The (end of the last record, end of the last entry) of the index of a segment, None if that record is torn"""
+        index_size = os.path.getsize(index_path)
+        index_size -= index_size % INDEX_ENTRY.size
+        if not index_size:
+            return (0, 0)
+        with open(index_path, 'rb') as fp:
+            fp.seek(index_size - INDEX_ENTRY.size)
+            offset = INDEX_ENTRY.unpack(fp.read(INDEX_ENTRY.size))[1]
+        size = os.path.getsize(segment_path)
+        with open(segment_path, 'rb') as fp:
+            fp.seek(offset)
+            header = fp.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        magic, key_length, metadata_length, raw_length = RECORD.unpack(header)
+        end = offset + RECORD.size + key_length + metadata_length + raw_length
+        if magic != RECORD_MAGIC or end > size:
+            return None
+        return (end, index_size)
+
+    def append(self, key, metadata, raw):
+        """Append a message, raw is its gzipped content or the path of its .eml.gz file"""
+        key_data = key.encode('utf-8', 'surrogateescape')
+        metadata_data = json.dumps(metadata, ensure_ascii=False).encode('utf-8')
+        raw_length = os.path.getsize(raw) if isinstance(raw, str) else len(raw)
+
+        with self.lock:
+            if self.locations is None:
+                self.load()
+            if self.segment is None or self.segment[3] >= SEGMENT_SIZE:
+                self.close()
+                self.openSegment()
+            name, segment_file, index_file, offset = self.segment
+
+            segment_file.write(RECORD.pack(RECORD_MAGIC, len(key_data), len(metadata_data), raw_length))
+            segment_file.write(key_data)
+            segment_file.write(metadata_data)
+            if isinstance(raw, str):
+                with open(raw, 'rb') as fp:
+                    shutil.copyfileobj(fp, segment_file, COPY_CHUNK)
+            else:
+                segment_file.write(raw)
+            # the record is complete before its index entry
+            segment_file.flush()
+
+            digest = key_digest(key)
+            index_file.write(INDEX_ENTRY.pack(digest, offset))
+            index_file.flush()
+            self.segment[3] = offset + RECORD.size + len(key_data) + len(metadata_data) + raw_length
+            self.locations[digest] = (name, offset)
+            self.loaded[name] = index_file.tell()
+
+    def sync(self):
+        """Write the appended records to the disk"""
+        with self.lock:
+            if self.segment is not None:
+                for fp in self.segment[1:3]:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+
+    def close(self):
+        if self.segment is not None:
+            self.segment[1].close()
+            self.segment[2].close()
+            self.segment = None
+
+    def readRecord(self, fp):
+        """Read the key and metadata of the record at the position of fp, which is left at its gzipped message.
+        Returns (key, metadata, length of the gzipped message) or None at the end of a segment"""
+        header = fp.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        magic, key_length, metadata_length, raw_length = RECORD.unpack(header)
+        if magic != RECORD_MAGIC:
+            raise ValueError('Invalid record at {} of {}'.format(fp.tell() - RECORD.size, fp.name))
+        key = fp.read(key_length).decode('utf-8', 'surrogateescape')
+        metadata = json.loads(fp.read(metadata_length).decode('utf-8'))
+        return (key, metadata, raw_length)
+
+    def read(self, key):
+        """The (metadata, gzipped message) of a key, None if it is not stored"""
+        location = self.locate(key)
+        if location is None:
+            return None
+        name, offset = location
+        with open(os.path.join(self.directory, name + '.seg'), 'rb') as fp:
+            fp.seek(offset)
+            key, metadata, raw_length = self.readRecord(fp)
+            return (metadata, fp.read(raw_length))
+
+    def records(self):
+        """All stored (key, metadata, size of the message), segment by segment, without reading the messages"""
+        for name in self.segmentNames():
+            path = os.path.join(self.directory, name + '.seg')
+            size = os.path.getsize(path)
+            with open(path, 'rb') as fp:
+                while True:
+                    try:
+                        record = self.readRecord(fp)
+                    except ValueError:
+                        # a torn last record, of an interrupted run
+                        break
+                    if record is None or fp.tell() + record[2] > size:
+                        break
+                    # the size is at the end of the gzipped message
+                    fp.seek(record[2] - 4, os.SEEK_CUR)
+                    yield (record[0], record[1], struct.unpack('<I', fp.read(4))[0])
+
+
+# one store per segment folder and process, the processes write to different segments
+stores = {}
+stores_lock = threading.Lock()
+
+
+def open_store(directory):
+    with stores_lock:
+        key = (os.getpid(), directory)
+        if key not in stores:
+            stores[key] = SegmentStore(directory)
+        return stores[key]
+
+
+def export_message(store, key, directory):
+    """Write the raw.eml.gz and metadata.json of a stored message into a folder, for rebuild_message"""
+    metadata, raw = store.read(key)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'raw.eml.gz'), 'wb') as fp:
+        fp.write(raw)
+    with open(os.path.join(directory, 'metadata.json'), 'w', encoding='utf8') as json_file:
+        json_file.write(json.dumps(metadata, indent=4, ensure_ascii=False))
+
+
+def do_export_segments(options):
+    """Export the messages of the segment store of the local folder into the folder layout, below the export_segments folder"""
+    # placed here, rebuild imports mailboxresource, which imports this module
+    from rebuild import rebuild_messages
+
+    directory = os.path.join(options['local_folder'], SEGMENT_FOLDER)
+    store = SegmentStore(directory)
+    if not store.segmentNames():
+        errorHandler(None, f'No segments found in {directory} (see the storage option)')
+
+    print('Exporting the segments of {} into {}'.format(directory, options['export_segments']))
+    directories = []
+    for key, metadata, size in store.records():
+        message_directory = os.path.join(options['export_segments'], *key.split('/'))
+        export_message(store, key, message_directory)
+        directories.append(message_directory)
+
+    # the other files of the messages, from raw.eml.gz
+    # the catalog of the local folder already has them
+    failed = rebuild_messages(directories, dict(options, catalog_path=None))
+    sys.exit(1 if failed else 0)
+
+
+def do_migrate_segments(options):
+    """Move the messages of the folder layout of the local folder into its segment store, removing their folders"""
+    # placed here, rebuild imports mailboxresource, which imports this module
+    from rebuild import find_messages, is_stale, rebuild_message
+
+    local_folder = options['local_folder']
+    store = SegmentStore(os.path.join(local_folder, SEGMENT_FOLDER))
+    migrated = 0
+    failed = 0
+    batch = []
+    # local folders of the moved emails (<local folder>/<year>/<email>), their indexes are removed
+    folders = set()
+
+    def remove_batch():
+        # only once their records are on the disk
+        store.sync()
+        for message_directory in batch:
+            shutil.rmtree(message_directory)
+            try:
+                os.removedirs(os.path.dirname(message_directory))
+            except OSError:
+                # not empty
+                pass
+        batch.clear()
+
+    print('Moving the emails of {} into {}'.format(local_folder, store.directory))
+    for message_directory in find_messages(local_folder):
+        try:
+            key = store.keyOf(message_directory)
+            if not store.contains(key):
+                # ex: saved with raw_only
+                if is_stale(message_directory) and not rebuild_message(message_directory):
+                    failed += 1
+                    continue
+                with open(os.path.join(message_directory, 'metadata.json'), 'r', encoding='utf8') as json_file:
+                    metadata = json.load(json_file)
+                store.append(key, metadata, os.path.join(message_directory, 'raw.eml.gz'))
+            batch.append(message_directory)
+            folders.add(os.path.dirname(os.path.dirname(message_directory)))
+            migrated += 1
+        except Exception as e:
+            errorHandler(e, f'Error while moving {message_directory}', exitCode=None)
+            failed += 1
+            continue
+
+        if len(batch) >= MIGRATE_BATCH:
+            remove_batch()
+    remove_batch()
+    store.close()
+    # they would tell the moved emails are still in the folders
+    for folder in folders:
+        remove_index(folder)
+
+    print('- Done. {} emails moved into segments, {} failed'.format(migrated, failed))
+    sys.exit(1 if failed else 0)
+
+
+def save_message_segment(segment_dir, directory, message, raw, catalog=None):
+    """Append a message to the segment store, by the folder `directory` it has in the folder layout. raw is the message
+    or the path of its .eml.gz file. Returns False if it is already stored"""
+    store = open_store(segment_dir)
+    key = store.keyOf(directory)
+    if store.contains(key):
+        return False
+
+    try:
+        metadata = message.getMetadata()
+    except Exception as e:
+        # ex: Unsupported charset on decode, the message is stored anyway
+        errorHandler(e, f'\rError: save_message_segment() failed for the metadata of {key}', exitCode=None)
+        metadata = dict(message.metadata, Id=message.message_id)
+    store.append(key, metadata, raw if isinstance(raw, str) else gzip.compress(raw))
+    catalog_message(catalog, directory, metadata, raw_size(raw) if isinstance(raw, str) else len(raw))
+    return True
+
+
+def refresh_store(segment_dir):
+    open_store(segment_dir).refresh()
+
+
+def is_stored(segment_dir, directory):
+    store = open_store(segment_dir)
+    return store.contains(store.keyOf(directory))
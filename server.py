@@ -2,34 +2,56 @@
 # -*- coding:utf-8 -*-
 
 
-from utilities import errorHandler
+from utilities import errorHandler, log, set_log_prefix, imaputf7decode
+from mailboxresource import open_session, IDLE_TIMEOUT
 import threading
 #from imapbox import do_accounts
 import croniter
 import datetime
 
+# seconds to wait before reconnecting a failed IDLE connection
+IDLE_RECONNECT = 60
+
 exit_flag = threading.Event()
-def start_server(options, do_accounts):
+# the IDLE watchers and the full passes do not save into the same folders at the same time
+sync_lock = threading.Lock()
+
+
+def start_server(options, do_accounts, idle_watches=None):
     """
     Starts a server, where the cron is checked every minute and the accounts are processed
 
+    With server set to "idle", the folders returned by idle_watches(options) are watched with IDLE and their new emails
+    are saved right away, the cron of the reconcile option runs the full pass of all accounts then.
+
     help: https://crontab.guru/
     """
+    idle = options['server'] == 'idle'
+    cron_string = options['reconcile'] if idle else options['server']
 
     # test cron expression
     try:
-        croniter.croniter(options['server'])
+        croniter.croniter(cron_string)
     except Exception as e:
         errorHandler(e, 'Invalid CRON expression')
-    
+
 
 
 
     print("Started server")
-    print("Cron: " + options['server'])
+    print("Cron: " + cron_string)
 
-    cron = croniter.croniter(options['server'], datetime.datetime.now())
+    cron = croniter.croniter(cron_string, datetime.datetime.now())
     next_cron = cron.get_next(datetime.datetime)
+
+    if idle:
+        # a full pass first, the watchers only need to fetch what arrives afterwards
+        with sync_lock:
+            do_accounts(options)
+
+        for account, folder_entry, sync in idle_watches(options):
+            threading.Thread(target=watch_folder, args=(account, options, folder_entry, sync), daemon=True).start()
+
     print("Waiting for first cron: " + str(next_cron))
 
     while not exit_flag.wait(60.0):
@@ -37,9 +59,39 @@ def start_server(options, do_accounts):
         if next_cron <= datetime.datetime.now():
 
             # do action
-            do_accounts(options)
+            with sync_lock:
+                do_accounts(options)
 
             # update next cron
             next_cron = cron.get_next(datetime.datetime)
             print("Done. Waiting for next cron: " + str(next_cron))
 
+
+def watch_folder(account, options, folder_entry, sync):
+    """Keep an IDLE connection on a folder, calling sync(session) for new emails. Reconnects until the server stops"""
+    set_log_prefix('[' + account['name'] + '/' + imaputf7decode(folder_entry).replace('"', '') + '] ')
+
+    while not exit_flag.is_set():
+        try:
+            with open_session(account, options, limited=False) as session:
+                # also catches up with the emails that arrived while not connected
+                with sync_lock:
+                    if sync(session) is None:
+                        errorHandler(None, 'Could not select the folder, not watching it', exitCode=None)
+                        return
+                log('Waiting for new emails (IDLE)')
+
+                while not exit_flag.is_set():
+                    # restarted after IDLE_TIMEOUT, so the server does not drop the connection
+                    if session.idle(IDLE_TIMEOUT):
+                        with sync_lock:
+                            sync(session)
+        except SystemExit:
+            # the error was already shown
+            pass
+        except Exception as e:
+            errorHandler(e, 'IDLE connection failed', exitCode=None)
+
+        if not exit_flag.is_set():
+            log('Reconnecting in {}s'.format(IDLE_RECONNECT))
+            exit_flag.wait(IDLE_RECONNECT)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of imapbox are run from its folder, not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
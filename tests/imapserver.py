@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import re
+import socket
+import socketserver
+import threading
+import zlib
+from mailboxresource import uid_set
+
+literal_re = re.compile(rb'\{(\d+)\}\r\n$')
+token_re = re.compile(rb'"((?:\\.|[^"\\])*)"|(\S+)')
+uid_range_re = re.compile(rb'\bUID (\S+)')
+return_re = re.compile(rb'\bRETURN \(([^)]*)\)')
+partial_re = re.compile(rb'BODY\.PEEK\[\]<(\d+)\.(\d+)>')
+header_fields_re = re.compile(rb'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]')
+
+DEFAULT_CAPABILITIES = ('IMAP4rev1', 'ESEARCH', 'CONDSTORE', 'ENABLE', 'COMPRESS=DEFLATE')
+
+
+class Literal:
+    """A command argument the client sent as literal"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+class StandInFolder:
+    def __init__(self, messages, uidvalidity=1, highestmodseq=1):
+        # uid => raw message
+        self.messages = dict(messages)
+        self.uidvalidity = uidvalidity
+        self.highestmodseq = highestmodseq
+
+    @property
+    def uidnext(self):
+        return max(self.messages, default=0) + 1
+
+    def uids(self, uid_set_text):
+        """The UIDs of a set like 1:5,8 or 3:*, like a server: n:* always matches the last message"""
+        uids = sorted(self.messages)
+        highest = uids[-1] if uids else 0
+        selected = set()
+        for part in uid_set_text.split(b','):
+            first, _, last = part.partition(b':')
+            first = highest if first == b'*' else int(first)
+            last = first if not last else (highest if last == b'*' else int(last))
+            low, high = min(first, last), max(first, last)
+            selected.update(uid for uid in uids if low <= uid <= high)
+        return sorted(selected)
+
+
+class StandInImapServer:
+    """A local IMAP server for the tests, with the commands imapbox uses: LOGIN (also with literals), CAPABILITY, LIST,
+    SELECT/EXAMINE, UID SEARCH (plain or ESEARCH), UID FETCH (headers, full and partial bodies), ENABLE, COMPRESS=DEFLATE.
+    It counts the bytes on the wire, and can drop the connection on the next fetches"""
+
+    def __init__(self, folders, username='user', password='secret', capabilities=DEFAULT_CAPABILITIES, refuse_compress=False):
+        self.folders = {name: folder if isinstance(folder, StandInFolder) else StandInFolder(folder) for name, folder in folders.items()}
+        self.username = username
+        self.password = password
+        self.capabilities = tuple(capabilities)
+        self.refuse_compress = refuse_compress
+        # connections closed on the next UID FETCH of message bodies
+        self.drop_fetches = 0
+        # next connections closed before the greeting
+        self.drop_connections = 0
+        # numbers of the login attempts (from 1 on) refused with login_refusal
+        self.refuse_logins = ()
+        self.login_refusal = b'NO [AUTHENTICATIONFAILED] Invalid credentials'
+        self.login_attempts = 0
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # (command name, arguments) of all connections, arguments sent as literals are Literal
+        self.commands = []
+        self.logins = 0
+        self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        imap = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    StandInConnection(imap, self.request).serve()
+                except (EOFError, OSError):
+                    pass
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def received(self, name, args):
+        with self.lock:
+            self.commands.append((name, args))
+
+    def commandNames(self):
+        with self.lock:
+            return [name for name, args in self.commands]
+
+    def countWire(self, sent=0, received=0):
+        with self.lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def resetCounters(self):
+        with self.lock:
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.commands = []
+
+
+class StandInConnection:
+    def __init__(self, imap, sock):
+        self.imap = imap
+        self.sock = sock
+        self.buffer = b''
+        self.inflater = None
+        self.deflater = None
+        self.folder = None
+        self.authenticated = False
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError()
+        self.imap.countWire(received=len(data))
+        if self.inflater is not None:
+            data = self.inflater.decompress(data)
+        self.buffer += data
+
+    def readline(self):
+        while b'\n' not in self.buffer:
+            self.fill()
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line + b'\n'
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send(self, data):
+        if self.deflater is not None:
+            data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.imap.countWire(sent=len(data))
+        self.sock.sendall(data)
+
+    def readCommand(self):
+        """The tag, the upper case name (ex: UID FETCH) and the arguments of the next command, with its literals"""
+        args = []
+        line = self.readline()
+        while True:
+            match = literal_re.search(line)
+            args.extend(tokenize(line[:match.start()] if match else line.rstrip(b'\r\n')))
+            if not match:
+                break
+            self.send(b'+ Ready for literal data\r\n')
+            args.append(Literal(self.read(int(match.group(1)))))
+            line = self.readline()
+
+        tag = args.pop(0)
+        name = args.pop(0).upper()
+        if name == b'UID' and args:
+            name += b' ' + args.pop(0).upper()
+        return tag, name.decode('ascii'), args
+
+    def serve(self):
+        with self.imap.lock:
+            dropped = self.imap.drop_connections > 0
+            if dropped:
+                self.imap.drop_connections -= 1
+        if dropped:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            return
+        self.send(b'* OK Stand-in IMAP server ready\r\n')
+        while True:
+            tag, name, args = self.readCommand()
+            self.imap.received(name, args)
+            handler = getattr(self, 'do_' + name.replace(' ', '_'), None)
+            if handler is None:
+                self.send(tag + b' BAD Unknown command\r\n')
+                continue
+            if not self.authenticated and name not in ('CAPABILITY', 'NOOP', 'LOGIN', 'LOGOUT'):
+                self.send(tag + b' BAD Not authenticated\r\n')
+                continue
+            if handler(tag, args) is False:
+                return
+
+    def ok(self, tag, text=b'completed'):
+        self.send(tag + b' OK ' + text + b'\r\n')
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(b'* CAPABILITY ' + ' '.join(self.imap.capabilities).encode('ascii') + b'\r\n')
+        self.ok(tag)
+
+    def do_NOOP(self, tag, args):
+        self.ok(tag)
+
+    def do_LOGIN(self, tag, args):
+        username, password = (arg.data.decode('utf-8') if isinstance(arg, Literal) else unquote(arg) for arg in args)
+        with self.imap.lock:
+            self.imap.login_attempts += 1
+            refused = self.imap.login_attempts in self.imap.refuse_logins
+        if refused:
+            self.send(tag + b' ' + self.imap.login_refusal + b'\r\n')
+            return
+        if username != self.imap.username or password != self.imap.password:
+            self.send(tag + b' NO [AUTHENTICATIONFAILED] Invalid credentials\r\n')
+            return
+        self.authenticated = True
+        with self.imap.lock:
+            self.imap.logins += 1
+        self.ok(tag, b'LOGIN completed')
+
+    def do_LOGOUT(self, tag, args):
+        self.send(b'* BYE Logging out\r\n')
+        self.ok(tag)
+        return False
+
+    def do_ENABLE(self, tag, args):
+        self.send(b'* ENABLED ' + b' '.join(args) + b'\r\n')
+        self.ok(tag)
+
+    def do_COMPRESS(self, tag, args):
+        if 'COMPRESS=DEFLATE' not in self.imap.capabilities:
+            self.send(tag + b' BAD Unknown command\r\n')
+        elif self.imap.refuse_compress:
+            self.send(tag + b' NO Compression is not available\r\n')
+        else:
+            self.ok(tag, b'DEFLATE active')
+            self.deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            self.inflater = zlib.decompressobj(-15)
+
+    def do_LIST(self, tag, args):
+        for name in self.imap.folders:
+            encoded = name.encode('ascii')
+            if b'"' in encoded or b'\\' in encoded:
+                self.send(b'* LIST (\\HasNoChildren) "/" {%d}\r\n' % len(encoded) + encoded + b'\r\n')
+            else:
+                self.send(b'* LIST (\\HasNoChildren) "/" "' + encoded + b'"\r\n')
+        self.ok(tag)
+
+    def do_EXAMINE(self, tag, args):
+        arg = args[0]
+        name = arg.data.decode('ascii') if isinstance(arg, Literal) else unquote(arg)
+        folder = self.imap.folders.get(name)
+        if folder is None:
+            self.send(tag + b' NO Mailbox does not exist\r\n')
+            return
+        self.folder = folder
+        self.send(b'* %d EXISTS\r\n* 0 RECENT\r\n' % len(folder.messages))
+        self.send(b'* OK [UIDVALIDITY %d] UIDs valid\r\n* OK [UIDNEXT %d] Predicted next UID\r\n' % (folder.uidvalidity, folder.uidnext))
+        if 'CONDSTORE' in self.imap.capabilities:
+            self.send(b'* OK [HIGHESTMODSEQ %d] Highest\r\n' % folder.highestmodseq)
+        self.ok(tag, b'[READ-ONLY] EXAMINE completed')
+
+    do_SELECT = do_EXAMINE
+
+    def do_UID_SEARCH(self, tag, args):
+        criteria = b' '.join(arg for arg in args if not isinstance(arg, Literal))
+        match = uid_range_re.search(criteria)
+        uids = self.folder.uids(match.group(1) if match else b'1:*')
+
+        returns = return_re.search(criteria)
+        if returns is None:
+            self.send(b'* SEARCH' + b''.join(b' %d' % uid for uid in uids) + b'\r\n')
+        else:
+            if 'ESEARCH' not in self.imap.capabilities:
+                self.send(tag + b' BAD RETURN is not supported\r\n')
+                return
+            result = b'* ESEARCH (TAG "' + tag + b'") UID'
+            items = returns.group(1).split()
+            if uids and b'MIN' in items:
+                result += b' MIN %d' % uids[0]
+            if uids and b'MAX' in items:
+                result += b' MAX %d' % uids[-1]
+            if b'COUNT' in items:
+                result += b' COUNT %d' % len(uids)
+            if uids and b'ALL' in items:
+                result += b' ALL ' + uid_set(uids).encode('ascii')
+            self.send(result + b'\r\n')
+        self.ok(tag)
+
+    def do_UID_FETCH(self, tag, args):
+        items = b' '.join(args[1:])
+        if b'BODY.PEEK[]' in items and self.imap.drop_fetches > 0:
+            with self.imap.lock:
+                self.imap.drop_fetches -= 1
+            self.sock.shutdown(socket.SHUT_RDWR)
+            return False
+
+        uids = sorted(self.folder.messages)
+        for uid in self.folder.uids(args[0]):
+            raw = self.folder.messages[uid]
+            attributes = b'UID %d' % uid
+            if b'RFC822.SIZE' in items:
+                attributes += b' RFC822.SIZE %d' % len(raw)
+            section = None
+            fields = header_fields_re.search(items)
+            partial = partial_re.search(items)
+            if fields:
+                section = (b'BODY[HEADER.FIELDS (' + fields.group(1) + b')]', header_fields(raw, fields.group(1).split()))
+            elif partial:
+                start, length = int(partial.group(1)), int(partial.group(2))
+                section = (b'BODY[]<%d>' % start, raw[start:start + length])
+            elif b'BODY.PEEK[]' in items:
+                section = (b'BODY[]', raw)
+
+            response = b'* %d FETCH (' % (uids.index(uid) + 1) + attributes
+            if section:
+                response += b' ' + section[0] + b' {%d}\r\n' % len(section[1]) + section[1]
+            self.send(response + b')\r\n')
+        self.ok(tag)
+
+
+def tokenize(line):
+    return [match.group(0) for match in token_re.finditer(line)]
+
+
+def unquote(arg):
+    if arg.startswith(b'"') and arg.endswith(b'"'):
+        arg = re.sub(rb'\\(.)', rb'\1', arg[1:-1])
+    return arg.decode('utf-8')
+
+
+def header_fields(raw, names):
+    """The header lines of a raw message with the given names, and the blank line"""
+    header = re.split(rb'\r?\n\r?\n', raw, 1)[0]
+    names = {name.upper() for name in names}
+    lines = re.split(rb'\r?\n(?![ \t])', header)
+    return b''.join(line + b'\r\n' for line in lines if line.split(b':', 1)[0].strip().upper() in names) + b'\r\n'
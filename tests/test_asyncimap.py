@@ -0,0 +1,334 @@
+import asyncio
+import gzip
+import os
+
+import pytest
+
+import asyncimap
+from asyncimap import AsyncImapClient, AsyncImapError, retry_fetch, save_account, AsyncHostLimiter
+from folderstate import FolderState
+from throttle import throttles
+from imapserver import StandInImapServer
+
+
+def make_message(n, body=b'Hello'):
+    return (b'Message-Id: <message-%d@example.com>\r\n' % n
+            + b'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n'
+            + b'From: Sender <sender@example.com>\r\n'
+            + b'To: receiver@example.com\r\n'
+            + b'Subject: Message %d\r\n' % n
+            + b'\r\n' + body + b' %d\r\n' % n)
+
+
+MESSAGES = {uid: make_message(uid) for uid in (1, 2, 3, 5, 8)}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # a dropped connection counts as throttling, the tests do not wait for the backoff
+    async def sleep(seconds):
+        pass
+    monkeypatch.setattr(asyncimap, 'sleep', sleep)
+    throttles.throttles.clear()
+
+
+@pytest.fixture
+def server():
+    with StandInImapServer({'INBOX': MESSAGES, 'Archive': {}}) as server:
+        yield server
+
+
+def client_for(server, password='secret', compress=True):
+    return AsyncImapClient('127.0.0.1', server.port, 'user', password, False, compress)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def connected(server, **kwargs):
+    client = client_for(server, **kwargs)
+    await client.connect()
+    return client
+
+
+def test_login_with_literal_password():
+    password = 'pässwörd "x"'
+    with StandInImapServer({'INBOX': {}}, password=password) as server:
+        async def login():
+            client = await connected(server, password=password)
+            await client.logout()
+        run(login())
+
+        name, args = server.commands[0]
+        assert name == 'LOGIN'
+        assert args[1].data == password.encode('utf-8')
+        assert server.logins == 1
+
+
+def test_login_failure(server):
+    with pytest.raises(AsyncImapError):
+        run(connected(server, password='wrong'))
+
+
+def test_list():
+    folders = {'INBOX': {}, 'Sent Items': {}, 'Quote"d': {}, '&AMQ-rger': {}}
+    with StandInImapServer(folders) as server:
+        async def list_folders():
+            client = await connected(server)
+            try:
+                return await client.list()
+            finally:
+                await client.logout()
+
+        assert run(list_folders()) == [
+            b'(\\HasNoChildren) "/" "INBOX"',
+            b'(\\HasNoChildren) "/" "Sent Items"',
+            # sent as literal
+            b'(\\HasNoChildren) "/" "Quote"d"',
+            b'(\\HasNoChildren) "/" "&AMQ-rger"',
+        ]
+
+
+def test_examine(server):
+    server.folders['INBOX'].highestmodseq = 42
+
+    async def examine():
+        client = await connected(server)
+        try:
+            return await client.examine('"INBOX"'), client.exists, await client.examine('"Missing"')
+        finally:
+            await client.logout()
+
+    assert run(examine()) == ((1, 9, 42), 5, None)
+    assert 'ENABLE' in server.commandNames()
+
+
+def test_examine_without_condstore():
+    with StandInImapServer({'INBOX': MESSAGES}, capabilities=('IMAP4rev1',)) as server:
+        async def examine():
+            client = await connected(server)
+            try:
+                return await client.examine('INBOX')
+            finally:
+                await client.logout()
+
+        assert run(examine()) == (1, 9, None)
+        assert 'ENABLE' not in server.commandNames()
+
+
+async def search_all(server, first_uid):
+    client = await connected(server)
+    try:
+        await client.examine('INBOX')
+        total, uids = await client.search('ALL', first_uid=first_uid)
+        return total, [uid async for uid in uids]
+    finally:
+        await client.logout()
+
+
+def test_search_with_esearch(server):
+    assert run(search_all(server, 3)) == (3, [3, 5, 8])
+    searches = [args for name, args in server.commands if name == 'UID SEARCH']
+    assert all(b'RETURN' in args for args in searches)
+
+
+def test_search_with_esearch_nothing_new(server):
+    # 9:* matches the last message, which is not new
+    assert run(search_all(server, 9)) == (0, [])
+
+
+def test_search_without_esearch():
+    with StandInImapServer({'INBOX': MESSAGES}, capabilities=('IMAP4rev1',)) as server:
+        total, uids = run(search_all(server, 3))
+        assert uids == [3, 5, 8]
+        # estimated from UIDNEXT
+        assert total == 5
+        searches = [args for name, args in server.commands if name == 'UID SEARCH']
+        assert searches and all(b'RETURN' not in args for args in searches)
+
+
+def test_fetch_batched(server):
+    async def fetch():
+        client = await connected(server)
+        try:
+            await client.examine('INBOX')
+            return await client.fetchHeaders([1, 2, 3, 5]), await client.fetchMessages([1, 2, 3, 5])
+        finally:
+            await client.logout()
+
+    headers, messages = run(fetch())
+    assert messages == {uid: MESSAGES[uid] for uid in (1, 2, 3, 5)}
+    assert headers[5][0] == len(MESSAGES[5])
+    assert headers[5][1].startswith(b'Message-Id: <message-5@example.com>\r\nDate: ')
+    # one command per batch
+    assert server.commandNames().count('UID FETCH') == 2
+
+
+def test_fetch_streamed(tmp_path, monkeypatch):
+    body = os.urandom(5000).hex().encode('ascii')
+    with StandInImapServer({'INBOX': {1: make_message(1, body)}}) as server:
+        monkeypatch.setattr(asyncimap, 'STREAM_CHUNK', 1000)
+
+        async def stream():
+            client = await connected(server)
+            try:
+                await client.examine('INBOX')
+                return await client.streamMessage(1, str(tmp_path))
+            finally:
+                await client.logout()
+
+        raw_file = run(stream())[1]
+        with gzip.open(raw_file.path, 'rb') as fp:
+            assert fp.read() == make_message(1, body)
+        assert raw_file.header.startswith(b'Message-Id: <message-1@example.com>')
+        # partial fetches of 1000 bytes
+        assert server.commandNames().count('UID FETCH') == len(make_message(1, body)) // 1000 + 1
+
+
+def test_reconnect_after_dropped_connection(server, tmp_path):
+    server.drop_fetches = 1
+
+    async def fetch():
+        client = await connected(server)
+        try:
+            await client.examine('INBOX')
+            return await retry_fetch(client, FolderState(str(tmp_path)), client.fetchMessages, [1, 2])
+        finally:
+            await client.logout()
+
+    assert run(fetch()) == {1: MESSAGES[1], 2: MESSAGES[2]}
+    assert server.logins == 2
+    # the folder is selected again on the new connection
+    assert server.commandNames().count('EXAMINE') == 2
+
+
+def test_retries_exhausted_fails_the_folder(server, tmp_path):
+    server.drop_fetches = 100
+    state = FolderState(str(tmp_path))
+    state.uidvalidity = 1
+
+    async def fetch():
+        client = await connected(server)
+        try:
+            await client.examine('INBOX')
+            return await retry_fetch(client, state, client.fetchMessages, [1, 2])
+        finally:
+            await client.logout()
+
+    # not a SystemExit, which would stop all accounts on the event loop
+    with pytest.raises(AsyncImapError):
+        run(fetch())
+    assert os.path.exists(state.path)
+
+
+def account_options(local_folder, **options):
+    defaults = {
+        'days': None, 'full_sync': False, 'specific_folders': False, 'parallel_folders': 1, 'batch_size': 2,
+        'batch_mb': 16, 'stream_mb': 0, 'pdf_queue': None, 'blob_dir': None, 'raw_only': False, 'segment_dir': None,
+        'catalog_path': None, 'local_folder': local_folder,
+    }
+    defaults.update(options)
+    return defaults
+
+
+def account(server, remote_folder='__ALL__'):
+    return {'name': 'test', 'host': '127.0.0.1', 'port': server.port, 'username': 'user', 'password': 'secret',
+            'ssl': False, 'remote_folder': remote_folder, 'exclude_folder': None}
+
+
+def saved_ids(local_folder):
+    return sorted(name for root, dirs, files in os.walk(local_folder) for name in dirs if name.startswith('message-'))
+
+
+def test_save_account(server, tmp_path):
+    local_folder = str(tmp_path)
+    run(save_account(account(server), account_options(local_folder), local_folder, AsyncHostLimiter()))
+    assert saved_ids(local_folder) == ['message-{}example.com'.format(uid) for uid in (1, 2, 3, 5, 8)]
+
+    # the next run only checks for new emails
+    server.resetCounters()
+    server.folders['INBOX'].messages[9] = make_message(9)
+    server.folders['INBOX'].highestmodseq += 1
+    run(save_account(account(server, 'INBOX'), account_options(local_folder), local_folder, AsyncHostLimiter()))
+    assert 'message-9example.com' in saved_ids(local_folder)
+    fetches = [args for name, args in server.commands if name == 'UID FETCH']
+    assert [args[0] for args in fetches] == [b'9', b'9']
+
+
+def test_save_account_continues_after_a_failed_folder(tmp_path, capsys):
+    folders = {'Broken': MESSAGES, 'INBOX': {1: make_message(1)}}
+    with StandInImapServer(folders) as server:
+        # every fetch of the first folder loses the connection
+        server.drop_fetches = asyncimap.MAX_RETRIES
+        local_folder = str(tmp_path)
+        run(save_account(account(server), account_options(local_folder), local_folder, AsyncHostLimiter()))
+
+        assert saved_ids(local_folder) == ['message-1example.com']
+        assert 'Maximum retries reached' in capsys.readouterr().err
+
+
+def test_save_account_without_another_connection(tmp_path, capsys):
+    with StandInImapServer({'INBOX': MESSAGES, 'Sent': MESSAGES, 'Archive': MESSAGES}) as server:
+        # the second connection cannot log in, its folders are copied by the others
+        server.refuse_logins = {2}
+        local_folder = str(tmp_path)
+        options = account_options(local_folder, parallel_folders=3)
+        run(asyncio.wait_for(save_account(account(server), options, local_folder, AsyncHostLimiter()), 30))
+
+        assert len(saved_ids(local_folder)) == 3 * len(MESSAGES)
+        output = capsys.readouterr()
+        assert 'Could not open another connection' in output.err
+        assert 'All 3 folders done. 15 emails created' in output.out
+
+
+def test_failed_reconnect_fails_the_folder(tmp_path, capsys):
+    with StandInImapServer({'INBOX': {uid: make_message(uid) for uid in range(1, 41)}}) as server:
+        # one dropped fetch, then no login succeeds anymore
+        server.drop_fetches = 1
+        server.refuse_logins = range(2, 100)
+        local_folder = str(tmp_path)
+        run(save_account(account(server, 'INBOX'), account_options(local_folder), local_folder, AsyncHostLimiter()))
+
+        output = capsys.readouterr()
+        assert 'Could not reconnect' in output.err
+        assert 'FAILED' in output.err
+        assert 'No new emails' not in output.out
+        # the UIDs up to the failed batch were not moved over, so the next run fetches them again
+        state = FolderState(os.path.join(local_folder, 'INBOX'))
+        assert state.last_uid == 0 and not state.failed_uids
+
+
+def test_throttled_login_is_retried(server):
+    server.refuse_logins = {1, 2}
+    server.login_refusal = b'NO [UNAVAILABLE] Too many connections'
+
+    async def login():
+        client = await connected(server)
+        await client.logout()
+    run(login())
+
+    assert server.login_attempts == 3
+    assert server.logins == 1
+    assert throttles.get('127.0.0.1').backoffDelay() > 0
+
+
+def test_refused_login_is_not_retried(server):
+    server.refuse_logins = {1}
+    with pytest.raises(AsyncImapError, match='Login failed'):
+        run(connected(server))
+    assert server.login_attempts == 1
+
+
+def test_dropped_connections_are_retried(server):
+    server.drop_connections = 2
+
+    async def login():
+        client = await connected(server)
+        await client.logout()
+    run(login())
+    assert server.logins == 1
+
+    server.drop_connections = asyncimap.MAX_RETRIES
+    with pytest.raises(AsyncImapError, match='Maximum retries reached'):
+        run(connected(server))
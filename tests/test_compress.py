@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from asyncimap import AsyncImapClient
+from mailboxresource import MailboxClient
+from throttle import throttles
+from imapserver import StandInImapServer
+
+# compressible like most emails: headers and text
+MESSAGES = {uid: (b'Message-Id: <message-%d@example.com>\r\nDate: Mon, 1 Jan 2024 10:00:00 +0000\r\nSubject: Report %d\r\n\r\n' % (uid, uid)
+                  + b'The quarterly report is attached, please review it before the meeting.\r\n' * 200) for uid in range(1, 21)}
+UIDS = sorted(MESSAGES)
+WITHOUT_COMPRESS = ('IMAP4rev1', 'ESEARCH')
+
+
+@pytest.fixture(autouse=True)
+def reset_throttles():
+    throttles.throttles.clear()
+
+
+def fetch_imaplib(server, compress):
+    client = MailboxClient('127.0.0.1', server.port, 'user', 'secret', 'INBOX', False, compress=compress)
+    try:
+        return client.fetchMessages(UIDS)
+    finally:
+        client.mailbox.logout()
+
+
+def fetch_asyncio(server, compress):
+    async def fetch():
+        client = AsyncImapClient('127.0.0.1', server.port, 'user', 'secret', False, compress)
+        await client.connect()
+        try:
+            await client.examine('INBOX')
+            return await client.fetchMessages(UIDS)
+        finally:
+            await client.logout()
+    return asyncio.run(fetch())
+
+
+def wire_bytes(fetch, compress, **server_options):
+    """The bytes the server sent for the fetch, and the fetched messages"""
+    with StandInImapServer({'INBOX': MESSAGES}, **server_options) as server:
+        messages = fetch(server, compress)
+        return server.bytes_sent, messages, server.commandNames()
+
+
+@pytest.mark.parametrize('fetch', [fetch_imaplib, fetch_asyncio])
+def test_compress_sends_fewer_bytes(fetch):
+    plain, plain_messages, plain_commands = wire_bytes(fetch, False)
+    compressed, compressed_messages, compressed_commands = wire_bytes(fetch, True)
+
+    assert plain_messages == compressed_messages == MESSAGES
+    assert 'COMPRESS' not in plain_commands
+    assert 'COMPRESS' in compressed_commands
+    assert plain > sum(len(raw) for raw in MESSAGES.values())
+    assert compressed < plain / 10
+
+
+@pytest.mark.parametrize('fetch', [fetch_imaplib, fetch_asyncio])
+def test_server_without_compress(fetch):
+    plain, messages, commands = wire_bytes(fetch, False, capabilities=WITHOUT_COMPRESS)
+    sent, messages, commands = wire_bytes(fetch, True, capabilities=WITHOUT_COMPRESS)
+
+    assert messages == MESSAGES
+    assert 'COMPRESS' not in commands
+    assert sent == plain
+
+
+@pytest.mark.parametrize('fetch', [fetch_imaplib, fetch_asyncio])
+def test_server_refusing_compress(fetch, capsys):
+    sent, messages, commands = wire_bytes(fetch, True, refuse_compress=True)
+
+    assert messages == MESSAGES
+    assert 'COMPRESS' in commands
+    assert sent > sum(len(raw) for raw in MESSAGES.values())
+    assert 'refused COMPRESS=DEFLATE' in capsys.readouterr().err
@@ -0,0 +1,51 @@
+import email
+import email.policy
+import os
+
+from message import Message
+
+
+def make_message(content_type, body, extra=b''):
+    raw = (b'Message-Id: <message-1@example.com>\r\n'
+           + b'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n'
+           + b'From: Sender <sender@example.com>\r\n'
+           + b'Subject: Message 1\r\n'
+           + b'MIME-Version: 1.0\r\n'
+           + b'Content-Type: ' + content_type + b'\r\n'
+           + extra + b'\r\n' + body)
+    return email.message_from_bytes(raw, policy=email.policy.default)
+
+
+def extract(tmp_path, msg):
+    message = Message(str(tmp_path), msg, 'message-1example.com')
+    message.extractAttachments()
+    with open(os.path.join(str(tmp_path), 'message.html'), encoding='utf-8') as fp:
+        return message, fp.read()
+
+
+def test_text_is_escaped(tmp_path):
+    body = b'if a < b and <![ INCLUDE [ x ]]> & <b>not bold</b>\r\n'
+    message, content = extract(tmp_path, make_message(b'text/plain; charset=utf-8', body))
+
+    assert '<pre>if a &lt; b and &lt;![ INCLUDE [ x ]]&gt; &amp; &lt;b&gt;not bold&lt;/b&gt;\n</pre>' in content
+    assert message.getMetadata()['Body'] == body.decode('utf-8')
+
+
+def test_unparsable_html_is_kept(tmp_path, capsys):
+    body = b'<html><body><p>Hello</p><![ INCLUDE [ x ]]></body></html>'
+    message, content = extract(tmp_path, make_message(b'text/html; charset=utf-8', body))
+
+    assert body.decode('utf-8') in content
+    assert 'Hello' in message.getMetadata()['Body']
+
+
+def test_cid_is_case_insensitive(tmp_path):
+    boundary = b'b1'
+    body = (b'--b1\r\nContent-Type: text/html; charset=utf-8\r\n\r\n'
+            + b'<html><body><img src="cid:Logo.PNG@Example"><img src=\'CID:logo.png@example\'></body></html>\r\n'
+            + b'--b1\r\nContent-Type: image/png\r\nContent-Id: <logo.png@EXAMPLE>\r\nContent-Disposition: inline; filename="logo.png"\r\n'
+            + b'Content-Transfer-Encoding: base64\r\n\r\niVBORw0KGgo=\r\n--b1--\r\n')
+    message, content = extract(tmp_path, make_message(b'multipart/related; boundary="' + boundary + b'"', body))
+
+    assert content.count('src="attachments/logo.png"') == 2
+    assert 'cid:' not in content.lower()
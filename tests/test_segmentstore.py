@@ -0,0 +1,120 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import segmentstore
+from segmentstore import SegmentStore
+
+pytestmark = pytest.mark.skipif(segmentstore.fcntl is None, reason='segments are only continued with file locks')
+
+
+def append(store, n):
+    store.append('INBOX/2024/message-%d' % n, {'Id': 'message-%d' % n}, gzip.compress(b'Message %d' % n))
+
+
+def test_next_run_continues_the_segment(tmp_path):
+    directory = str(tmp_path / 'segments')
+    first = SegmentStore(directory)
+    append(first, 1)
+    first.close()
+
+    second = SegmentStore(directory)
+    append(second, 2)
+    second.close()
+
+    assert len(second.segmentNames()) == 1
+    assert [record[0] for record in SegmentStore(directory).records()] == ['INBOX/2024/message-1', 'INBOX/2024/message-2']
+
+
+def test_segment_of_another_writer_is_not_continued(tmp_path):
+    directory = str(tmp_path / 'segments')
+    first = SegmentStore(directory)
+    second = SegmentStore(directory)
+    append(first, 1)
+    append(second, 2)
+
+    assert len(first.segmentNames()) == 2
+    first.close()
+    second.close()
+
+
+def test_full_segment_is_not_continued(tmp_path, monkeypatch):
+    monkeypatch.setattr(segmentstore, 'SEGMENT_SIZE', 10)
+    directory = str(tmp_path / 'segments')
+    first = SegmentStore(directory)
+    append(first, 1)
+    first.close()
+
+    second = SegmentStore(directory)
+    append(second, 2)
+    second.close()
+    assert len(second.segmentNames()) == 2
+
+
+def test_torn_record_is_cut(tmp_path):
+    directory = str(tmp_path / 'segments')
+    first = SegmentStore(directory)
+    append(first, 1)
+    name = first.segment[0]
+    first.close()
+    # a record without its index entry, and half an index entry
+    with open(os.path.join(directory, name + '.seg'), 'ab') as fp:
+        fp.write(b'IMB1 torn')
+    with open(os.path.join(directory, name + '.idx'), 'ab') as fp:
+        fp.write(b'torn')
+
+    second = SegmentStore(directory)
+    append(second, 2)
+    second.close()
+
+    assert second.segmentNames() == [name]
+    store = SegmentStore(directory)
+    assert [record[0] for record in store.records()] == ['INBOX/2024/message-1', 'INBOX/2024/message-2']
+    assert store.read('INBOX/2024/message-2')[1] == gzip.compress(b'Message 2')
+
+
+def test_missing_key_loads_again_after_refresh(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'segments')
+    writer = SegmentStore(directory)
+    append(writer, 1)
+    writer.close()
+
+    reader = SegmentStore(directory)
+    loads = []
+    load = reader.load
+    monkeypatch.setattr(reader, 'load', lambda: loads.append(1) or load())
+    assert reader.contains('INBOX/2024/message-1')
+    assert not reader.contains('INBOX/2024/message-2')
+    assert not reader.contains('INBOX/2024/message-3')
+    assert len(loads) == 1
+
+    # continues the same segment, the folder is unchanged
+    writer = SegmentStore(directory)
+    append(writer, 2)
+    writer.close()
+    assert not reader.contains('INBOX/2024/message-2')
+    reader.refresh()
+    assert reader.contains('INBOX/2024/message-2')
+    assert len(loads) == 2
+
+
+def test_search_points_to_the_segment(tmp_path, capsys):
+    from search import do_search
+
+    store = SegmentStore(os.path.join(str(tmp_path), segmentstore.SEGMENT_FOLDER))
+    append(store, 1)
+    append(store, 2)
+    name = store.segment[0]
+    store.close()
+
+    with pytest.raises(SystemExit):
+        do_search({'local_folder': str(tmp_path), 'search_filter': 'Id,message-2', 'search_output': 'json'})
+    result = json.loads(capsys.readouterr().out)
+
+    item, = result['items']
+    assert os.path.isfile(item['filename'])
+    assert item['filename'] == os.path.join(store.directory, name + '.seg')
+    assert item['segment'] == {'key': 'INBOX/2024/message-2', 'offset': store.locate('INBOX/2024/message-2')[1]}
+    assert item['content'] == {'Id': 'message-2'}
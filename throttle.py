@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+import random
+import re
+import threading
+import time
+
+# backoff after throttling: doubled for each throttling in a row (up to the max), with jitter
+BACKOFF_START = 2
+BACKOFF_MAX = 300
+# on throttling the rates are multiplied by DECREASE, each successful command adds INCREASE of the lowered rate again
+DECREASE = 0.5
+INCREASE = 0.05
+# lowest rates the adaption goes down to
+MIN_COMMANDS = 0.1
+MIN_BYTES = 10 * 1024
+# seconds the current rates are measured over
+RATE_WINDOW = 10
+
+throttle_re = re.compile(r'\[(THROTTLED|UNAVAILABLE|LIMIT)\]|too many|rate limit|throttl|RequestLimitExceeded', re.I)
+
+
+def is_throttling(text):
+    """Tell if a response text (or an error) of the server is about throttling"""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    return bool(throttle_re.search(str(text)))
+
+
+class TokenBucket:
+    """A rate limit, take() returns how long to wait before using the taken amount"""
+
+    def __init__(self, rate=0, minimum=0):
+        # rate: per second, 0 for no limit
+        self.rate = rate
+        # configured rate, the adaption never goes above it
+        self.ceiling = rate
+        self.minimum = minimum
+        self.step = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def take(self, amount):
+        now = time.monotonic()
+        if not self.rate:
+            self.updated = now
+            return 0
+
+        # allows bursts of up to one second
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def decrease(self, measured):
+        """Lower the rate, starting from the measured one if there was no limit yet"""
+        rate = self.rate or measured
+        if rate:
+            self.rate = max(rate * DECREASE, self.minimum)
+            self.step = self.rate * INCREASE
+
+    def increase(self):
+        if self.step:
+            self.rate += self.step
+            if self.ceiling:
+                self.rate = min(self.rate, self.ceiling)
+
+
+class RateMeter:
+    """Measures a rate over the last RATE_WINDOW seconds"""
+
+    def __init__(self):
+        # [second, amount], one entry per second
+        self.seconds = []
+        self.started = time.monotonic()
+
+    def add(self, amount):
+        second = int(time.monotonic())
+        if self.seconds and self.seconds[-1][0] == second:
+            self.seconds[-1][1] += amount
+        else:
+            self.seconds.append([second, amount])
+            self.prune(second)
+
+    def prune(self, second):
+        while self.seconds and self.seconds[0][0] <= second - RATE_WINDOW:
+            self.seconds.pop(0)
+
+    def rate(self):
+        now = time.monotonic()
+        self.prune(int(now))
+        # a run shorter than the window is measured over its time so far
+        return sum(amount for second, amount in self.seconds) / max(1, min(RATE_WINDOW, now - self.started))
+
+
+class HostThrottle:
+    """Rate limits and backoff of an IMAP host, shared by all its connections (threads or tasks).
+    Methods return the seconds to wait, so the caller can sleep the way it needs to"""
+
+    def __init__(self, host, commands_per_second=0, bytes_per_second=0):
+        self.host = host
+        self.lock = threading.Lock()
+        self.commands = TokenBucket(commands_per_second, MIN_COMMANDS)
+        self.bytes = TokenBucket(bytes_per_second, MIN_BYTES)
+        self.command_rate = RateMeter()
+        self.byte_rate = RateMeter()
+        self.backoff = 0
+        self.backoff_until = 0
+
+    def backoffDelay(self):
+        """Seconds left of the current backoff"""
+        with self.lock:
+            return max(0, self.backoff_until - time.monotonic())
+
+    def command(self):
+        """Count a command, returns the seconds to wait before sending it"""
+        with self.lock:
+            self.command_rate.add(1)
+            return max(self.commands.take(1), self.backoff_until - time.monotonic(), 0)
+
+    def received(self, size):
+        """Count received bytes, returns the seconds to wait before reading on"""
+        with self.lock:
+            self.byte_rate.add(size)
+            return self.bytes.take(size)
+
+    def throttled(self, reason):
+        """The server throttled us (or dropped the connection): back off and lower the rates. Returns the backoff"""
+        with self.lock:
+            now = time.monotonic()
+            # throttling while still backing off comes from commands sent at the old rates, so the rates are lowered once
+            if now >= self.backoff_until:
+                self.commands.decrease(self.command_rate.rate())
+                self.bytes.decrease(self.byte_rate.rate())
+
+            self.backoff = min(BACKOFF_MAX, self.backoff * 2 if self.backoff else BACKOFF_START)
+            # jitter within the upper half, so connections of the same host do not retry in lockstep
+            delay = random.uniform(self.backoff / 2, self.backoff)
+            self.backoff_until = max(self.backoff_until, now + delay)
+            return delay
+
+    def succeeded(self):
+        with self.lock:
+            self.backoff = 0
+            self.commands.increase()
+            self.bytes.increase()
+
+    def status(self):
+        """Current rates and backoff, for the progress output"""
+        with self.lock:
+            text = '{:.1f} cmd/s {:.2f} MB/s'.format(self.command_rate.rate(), self.byte_rate.rate() / 1024 / 1024)
+            if self.commands.step or self.bytes.step:
+                text += ' (limited to {:.1f} cmd/s {:.2f} MB/s)'.format(self.commands.rate, self.bytes.rate / 1024 / 1024)
+            wait = self.backoff_until - time.monotonic()
+            if wait > 0:
+                text += ' backoff {:.0f}s'.format(wait)
+            return text
+
+
+class ThrottleRegistry:
+    """The HostThrottle of each host, configured from the options"""
+
+    def __init__(self):
+        self.commands_per_second = 0
+        self.bytes_per_second = 0
+        self.throttles = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        host = str(host).lower()
+        with self.lock:
+            if host not in self.throttles:
+                self.throttles[host] = HostThrottle(host, self.commands_per_second, self.bytes_per_second)
+            return self.throttles[host]
+
+
+# shared by all accounts and folders
+throttles = ThrottleRegistry()
@@ -3,6 +3,33 @@
 
 
 import sys
+import threading
+import contextvars
+
+# Prefix of the log lines of the current thread or asyncio task, to keep parallel output readable
+log_prefix = contextvars.ContextVar('log_prefix', default='')
+
+def set_log_prefix(prefix):
+    log_prefix.set(prefix)
+
+def get_log_prefix():
+    return log_prefix.get()
+
+# Add the log prefix of the current thread or task to a message
+def prefixed(message):
+    prefix = get_log_prefix()
+    if not prefix:
+        return message
+    # keep carriage returns (progress output) and leading new lines in front
+    message = str(message)
+    stripped = message.lstrip('\r\n')
+    return message[:len(message) - len(stripped)] + prefix + stripped
+
+# Print a log line, prefixed with the log prefix of the current thread or task
+def log(*args, **kwargs):
+    if args:
+        args = (prefixed(args[0]),) + args[1:]
+    print(*args, **kwargs)
 
 # Print an error message
 #
@@ -17,6 +44,8 @@ def errorHandler(e, caption, exitCode=1):
     else:
         msg = e
     
+    caption = prefixed(caption) if caption else caption
+
     if e is not None:
         # show error details, and in red
         print('\x1b[31;20m{}:'.format(caption), msg, '\x1b[0m', file=sys.stderr)
@@ -82,12 +111,15 @@ def imaputf7encode(s):
 import re
 import hashlib
 
-def createReliableMessageId(message_id, data):
+def createReliableMessageId(message_id, data, digest=None):
+    # digest: sha224 hex digest of the data, if it was already computed while streaming it
     if message_id and len(message_id.strip()) > 10:
         msg_id_safe = re.sub(r'[^a-zA-Z0-9_\-\.() ]+', '', message_id.strip())
     else:
         try:
-            if type(data) is list:
+            if digest:
+                msg_id_safe = digest
+            elif type(data) is list:
                 msg_id_safe = hashlib.sha224(data[1]).hexdigest()
             else:
                 msg_id_safe = hashlib.sha224(data).hexdigest()
@@ -98,13 +130,15 @@ def createReliableMessageId(message_id, data):
 
     return msg_id_safe
 
-def createReliableFoldername(message_id, data):
+def createReliableFoldername(message_id, data, digest=None):
     # 255 is the max filename length on all systems
     if message_id and len(message_id.strip()) < 255:
         foldername = re.sub(r'[^a-zA-Z0-9_\-\.() ]+', '', message_id.strip())
     else:
         try:
-            if type(data) is list:
+            if digest:
+                foldername = digest
+            elif type(data) is list:
                 foldername = hashlib.sha224(data[1]).hexdigest()
             else:
                 foldername = hashlib.sha224(data).hexdigest()
@@ -116,4 +150,8 @@ def createReliableFoldername(message_id, data):
     return foldername
 
 def hasTTY():
-    return sys.stdin and sys.stdin.isatty()
\ No newline at end of file
+    return sys.stdin and sys.stdin.isatty()
+
+# progress output is only shown on a terminal and not from parallel workers, since their lines would be mixed up
+def showProgress():
+    return hasTTY() and threading.current_thread() is threading.main_thread()
\ No newline at end of file